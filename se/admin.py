@@ -31,7 +31,7 @@ from django.template import defaultfilters, response
 from .document import Document
 from .forms import AddToQueueForm
 from .html_asset import HTMLAsset
-from .models import AuthField, DomainSetting, CrawlPolicy, SearchEngine, Cookie, ExcludedUrl, WorkerStats
+from .models import AuthField, DomainSetting, CrawlPolicy, SearchEngine, Cookie, ExcludedUrl, WorkerStats, WWWFragment
 from .utils import human_datetime, human_dt, reverse_no_escape
 
 
@@ -102,6 +102,10 @@ class SearchEngineAdmin(admin.ModelAdmin):
     search_fields = ('short_name', 'shortcut')
     list_filter = (ConflictingSearchEngineFilter,)
 
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        SearchEngine.clear_shortcuts()
+
 
 class DocumentErrorFilter(admin.SimpleListFilter):
     title = 'error'
@@ -245,7 +249,7 @@ class DocumentAdmin(admin.ModelAdmin):
 
         if request.POST.get('action') == 'Confirm':
             crawl_recurse = form.cleaned_data.get('crawl_depth') or 0
-            doc, created = Document.objects.get_or_create(url=form.cleaned_data['url'], defaults={'crawl_recurse': crawl_recurse})
+            doc, created = Document.objects.get_or_create(**Document.url_lookup(form.cleaned_data['url']), defaults={'crawl_recurse': crawl_recurse})
             if not created:
                 doc.crawl_next = now()
                 if crawl_recurse:
@@ -375,7 +379,7 @@ class DocumentAdmin(admin.ModelAdmin):
     @staticmethod
     def fav(obj):
         if obj.favicon and not obj.favicon.missing:
-            return format_html('<img src="{}" style="widgth: 16px; height: 16px">', reverse('favicon', args=(obj.favicon.id,)))
+            return format_html('<img src="{}" style="widgth: 16px; height: 16px">', obj.favicon.get_absolute_url())
 
     @staticmethod
     def link(obj):
@@ -387,8 +391,9 @@ class DocumentAdmin(admin.ModelAdmin):
 
     @staticmethod
     def domain(obj):
-        crawl_policy = CrawlPolicy.get_from_url(obj.url)
-        dom = DomainSetting.get_from_url(obj.url, crawl_policy.default_browse_mode)
+        dom = DomainSetting.get_existing_from_url(obj.url)
+        if dom is None:
+            return '-'
         return format_html('<a href="{}">{}</a>', reverse('admin:se_domainsetting_change', args=(dom.id,)), dom)
 
     @staticmethod
@@ -412,7 +417,7 @@ class DocumentAdmin(admin.ModelAdmin):
 
     @staticmethod
     def crawl_policy(obj):
-        policy = CrawlPolicy.get_from_url(obj.url)
+        policy = CrawlPolicy.get_from_url_cached(obj.url)
         return format_html('<a href="{}">{}</a>', reverse('admin:se_crawlpolicy_change', args=(policy.id,)), policy)
 
     @staticmethod
@@ -442,13 +447,17 @@ class DocumentAdmin(admin.ModelAdmin):
     def delete_model(self, request, obj):
         obj.delete_html()
         obj.delete_screenshot()
-        return super().delete_model(request, obj)
+        WWWFragment.clear_linking_to([obj])
+        super().delete_model(request, obj)
+        Document.bump_index_generation()
 
     def delete_queryset(self, request, queryset):
         for obj in queryset.all():
             obj.delete_html()
             obj.delete_screenshot()
-        return super().delete_queryset(request, queryset)
+        WWWFragment.clear_linking_to(queryset)
+        super().delete_queryset(request, queryset)
+        Document.bump_index_generation()
 
 
 class InlineAuthField(admin.TabularInline):
@@ -523,6 +532,10 @@ class CrawlPolicyAdmin(admin.ModelAdmin):
             return False
         return super().has_delete_permission(request, obj)
 
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        CrawlPolicy.clear_url_cache()
+
     @staticmethod
     def documents(obj):
         params = urlencode({'q': obj.url_regex})
@@ -583,5 +596,5 @@ if settings.DEBUG:
     class HTMLAssetAdmin(admin.ModelAdmin):
         list_display = ('url', 'filename', 'ref_count')
         search_fields = ('url', 'filename')
-        ordering = ('url', 'filename', 'ref_count')
+        ordering = ('url', 'filename')
         exclude = tuple()
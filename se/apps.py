@@ -22,6 +22,13 @@ class SEConfig(AppConfig):
     verbose_name = 'Search Engine'
     default_auto_field = 'django.db.models.AutoField'
 
+    def ready(self):
+        from django.db import models
+        from .lookups import ILike, ILikeContains
+        for field_class in (models.CharField, models.TextField):
+            field_class.register_lookup(ILike)
+            field_class.register_lookup(ILikeContains)
+
 
 class SEAdminConfig(AdminConfig):
     default_site = 'se.admin.get_admin'
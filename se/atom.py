@@ -18,15 +18,24 @@ from lxml.etree import Element, tostring
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse
+from django.db.models import F, Func
+from django.http import HttpResponse, StreamingHttpResponse
 from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
+from .document import Document
 from .forms import SearchForm
 from .models import SearchEngine
+from .paginator import InvalidCursor, decode_cursor, encode_cursor, keyset_filter
 from .search import get_documents
 from .utils import reverse_no_escape
 
 
+# First lines of the content, so that the whole content is not fetched
+FIRST_LINES = "array_to_string((string_to_array(%(expressions)s, E'\\n'))[1:5], E'\\n')"
+
+
 def elem(tag, text, **attr):
     e = Element(tag, **attr)
     if text is not None:
@@ -55,6 +64,31 @@ def atom_is_allowed(request):
     return False
 
 
+def atom_entries(docs, key, cached_page, base_url):
+    for doc in docs.iterator():
+        entry = Element('entry')
+        entry.append(elem('title', doc.title))
+        if cached_page == '0':
+            url = doc.url
+        else:
+            url = base_url + reverse_no_escape('www', args=[doc.url])
+        entry.append(elem('link', None, href=url))
+        entry.append(elem('id', str_to_uuid(url)))
+        entry.append(elem('updated', getattr(doc, key).isoformat()))
+
+        content = '\n'.join(doc.summary.splitlines()[:5])
+        entry.append(elem('summary', content))
+        yield tostring(entry, pretty_print=True, encoding='unicode')
+
+
+def atom_feed(header, entries):
+    yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    for e in header:
+        yield tostring(e, pretty_print=True, encoding='unicode')
+    yield from entries
+    yield '</feed>\n'
+
+
 def atom(request):
     results = None
     q = None
@@ -80,41 +114,56 @@ def atom(request):
 
         param = {'%s__isnull' % key: True}
         results = results.exclude(**param)
-        results = results.order_by('-' + key)
+        ordering = ('-' + key, '-id')
+        results = results.order_by(*ordering)
+
+        page_number = 1
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                page_number, _, cursor_key = decode_cursor(cursor)
+                results = keyset_filter(results, ordering, cursor_key)
+            except InvalidCursor:
+                return HttpResponse('Invalid cursor', content_type='text/plain', status=400)
+
+        # Only the ordering values are fetched first, so that unchanged feeds are answered without reading documents
+        keys = list(results.values_list(key, 'id')[:settings.SOSSE_ATOM_FEED_SIZE + 1])
+        has_next = len(keys) > settings.SOSSE_ATOM_FEED_SIZE
+        keys = keys[:settings.SOSSE_ATOM_FEED_SIZE]
+
+        etag = md5((request.META['QUERY_STRING'] + repr(keys)).encode('utf-8')).hexdigest()
+        etag = quote_etag(etag)
+        last_modified = None
+        if keys:
+            last_modified = int(keys[0][0].timestamp())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
 
         base_url = request.META['REQUEST_SCHEME'] + '://' + request.META['HTTP_HOST']
         cached_page = request.GET.get('cached', '0')
 
-        feed = Element('feed')
-        feed.attrib['xmlns'] = 'http://www.w3.org/2005/Atom'
-        feed.append(elem('title', f'SOSSE · {q}'))
-        feed.append(elem('description', f'SOSSE search results for {q}'))
+        header = []
+        header.append(elem('title', f'SOSSE · {q}'))
+        header.append(elem('description', f'SOSSE search results for {q}'))
         url = base_url + reverse('search') + '?' + request.META['QUERY_STRING']
-        feed.append(elem('link', None, href=url))
-        if len(results):
-            feed.append(elem('updated', getattr(results[0], key).isoformat()))
+        header.append(elem('link', None, href=url))
+        if has_next:
+            params = request.GET.copy()
+            params['cursor'] = encode_cursor(page_number + 1, False, list(keys[-1]))
+            header.append(elem('link', None, rel='next', href=base_url + request.path + '?' + params.urlencode()))
+        if keys:
+            header.append(elem('updated', keys[0][0].isoformat()))
         feed_id = 'SOSSE' + request.META['QUERY_STRING']
-        feed.append(elem('id', str_to_uuid(feed_id)))
-        feed.append(elem('icon', base_url + settings.STATIC_URL + 'logo.svg'))
-
-        for doc in results[:settings.SOSSE_ATOM_FEED_SIZE]:
-            entry = Element('entry')
-            entry.append(elem('title', doc.title))
-            if cached_page == '0':
-                url = doc.url
-            else:
-                url = base_url + reverse_no_escape('www', args=[doc.url])
-            entry.append(elem('link', None, href=url))
-            entry.append(elem('id', str_to_uuid(url)))
-            entry.append(elem('updated', getattr(doc, key).isoformat()))
-
-            content = ''
-            lines = doc.content.splitlines()
-            if lines:
-                content = '\n'.join(lines[:5])
-            entry.append(elem('summary', content))
-            feed.append(entry)
-
-        return HttpResponse(tostring(feed, pretty_print=True), content_type='text/plain')
+        header.append(elem('id', str_to_uuid(feed_id)))
+        header.append(elem('icon', base_url + settings.STATIC_URL + 'logo.svg'))
+
+        docs = Document.objects.filter(id__in=[doc_id for _, doc_id in keys]).order_by(*ordering)
+        docs = docs.only('url', 'title', key).annotate(summary=Func(F('content'), template=FIRST_LINES))
+        response = StreamingHttpResponse(atom_feed(header, atom_entries(docs, key, cached_page, base_url)), content_type='text/plain')
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
 
     return HttpResponse('Invalid query parameters', content_type='text/plain', status=400)
@@ -13,11 +13,15 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from functools import wraps
+from hashlib import md5
 from urllib.parse import unquote, urlparse
 
 from django.conf import settings
-from django.shortcuts import redirect, render, reverse
+from django.shortcuts import redirect, render
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.html import format_html
+from django.utils.http import http_date, quote_etag
 
 from .document import Document, extern_link_flags
 from .models import CrawlPolicy
@@ -25,9 +29,22 @@ from .url import sanitize_url, url_beautify
 from .utils import reverse_no_escape
 
 
+def _split_page(request):
+    # Paginated views have the page number before the url, as the url may have a query string
+    url = request.META['REQUEST_URI'].split('/', 2)[-1]
+    page, _, page_url = url.partition('/')
+    if page.isdigit():
+        return int(page), page_url
+    return 1, url
+
+
+def page_from_request(request):
+    return _split_page(request)[0]
+
+
 def url_from_request(request):
     # Keep the url with parameters
-    url = request.META['REQUEST_URI'].split('/', 2)[-1]
+    _, url = _split_page(request)
 
     # re-establish double //
     scheme, url = url.split('/', 1)
@@ -41,12 +58,13 @@ def url_from_request(request):
     return sanitize_url(url)
 
 
-def get_cached_doc(request, view_name):
-    doc = get_document(request)
+def get_cached_doc(request, view_name, doc_id):
+    # The document was resolved from the url by conditional_cached_doc
+    doc = Document.objects.filter(id=doc_id).first()
     if doc is None:
         return unknown_url_view(request)
     if settings.SOSSE_CACHE_FOLLOWS_REDIRECT and doc.redirect_url:
-        new_doc = Document.objects.filter(url=doc.redirect_url).first()
+        new_doc = Document.objects.filter(**Document.url_lookup(doc.redirect_url)).first()
         if new_doc:
             return redirect(new_doc.get_absolute_url())
         return redirect(reverse_no_escape(view_name, args=[doc.redirect_url]))
@@ -55,17 +73,51 @@ def get_cached_doc(request, view_name):
 
 def get_document(request):
     url = url_from_request(request)
-    return Document.objects.filter(url=url).first()
-
-
-def get_context(doc, view_name):
-    crawl_policy = CrawlPolicy.get_from_url(doc.url)
+    return Document.objects.filter(**Document.url_lookup(url)).first()
+
+
+def conditional_cached_doc(func):
+    # Answers conditional requests to pages of a cached document using only the document's content hash, crawl date
+    # and links modification date, and adds the validators to the page. The id of the document is passed to the view
+    @wraps(func)
+    def _view(request, *args, **kwargs):
+        doc = Document.objects.filter(**Document.url_lookup(url_from_request(request)))
+        doc = doc.values('id', 'content_hash', 'crawl_last', 'links_modified').first()
+        if doc is None or doc['crawl_last'] is None:
+            return func(request, *args, doc_id=doc and doc['id'], **kwargs)
+
+        # The page also displays the user's menu
+        links_modified = doc['links_modified'].isoformat() if doc['links_modified'] else ''
+        etag = '%s-%s-%s-%s-%s' % (doc['id'], doc['content_hash'], doc['crawl_last'].isoformat(), links_modified, request.user.id)
+        etag = quote_etag(md5(etag.encode('utf-8')).hexdigest())
+        last_modified = max(doc['crawl_last'], doc['links_modified'] or doc['crawl_last'])
+        last_modified = int(last_modified.timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = func(request, *args, doc_id=doc['id'], **kwargs)
+            if response.status_code != 200:
+                return response
+
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        # Proxies and browsers must check the page is still valid before using their copy
+        if settings.SOSSE_ANONYMOUS_SEARCH:
+            patch_cache_control(response, public=True, no_cache=True)
+        else:
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return _view
+
+
+def get_context(doc, view_name, request):
+    crawl_policy = CrawlPolicy.get_from_url_cached(doc.url, request)
     beautified_url = url_beautify(doc.url)
     title = doc.title or beautified_url
     page_title = None
     favicon = None
     if doc.favicon and not doc.favicon.missing:
-        favicon = reverse('favicon', args=(doc.favicon.id,))
+        favicon = doc.favicon.get_absolute_url()
         page_title = format_html('<img src="{}" style="height: 32px; width: 32px; vertical-align: bottom" alt="icon"> {}', favicon, title)
     else:
         page_title = title
@@ -111,7 +163,7 @@ def unknown_url_view(request):
         'url': url,
         'title': beautified_url,
         'beautified_url': beautified_url,
-        'crawl_policy': CrawlPolicy.get_from_url(url),
+        'crawl_policy': CrawlPolicy.get_from_url_cached(url, request),
         'extern_link_flags': extern_link_flags,
     }
     return render(request, 'se/unknown_url.html', context)
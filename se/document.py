@@ -25,6 +25,7 @@ from traceback import format_exc
 
 from bs4 import Comment, Doctype, Tag
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
 from django.db import connection, models
@@ -53,6 +54,36 @@ def remove_accent(s):
     return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
 
+def remove_accent_offsets(s):
+    # Positions in the normalized version of s where its offset to s changes, as a flat list of
+    # (normalized position, offset) pairs, this is empty when characters map one to one
+    offsets = []
+    if s.isascii():
+        return offsets
+
+    norm_pos = 0
+    offset = 0
+    for pos, c in enumerate(s):
+        if c.isascii():
+            norm_pos += 1
+            continue
+        norm_pos += len(remove_accent(c))
+        if pos + 1 - norm_pos != offset:
+            offset = pos + 1 - norm_pos
+            offsets += [norm_pos, offset]
+    return offsets
+
+
+def content_pos(offsets, norm_pos):
+    # Converts a position in the normalized content to a position in the content
+    offset = 0
+    for i in range(0, len(offsets), 2):
+        if offsets[i] > norm_pos:
+            break
+        offset = offsets[i + 1]
+    return norm_pos + offset
+
+
 class RegConfigField(models.Field):
     def db_type(self, connection):
         return 'regconfig'
@@ -76,13 +107,17 @@ class Document(models.Model):
     )
 
     # Document info
-    url = models.TextField(unique=True, validators=[validate_url])
+    url = models.TextField(validators=[validate_url])
+    # Uniqueness and lookups rely on the md5 digest of the url, since urls can be too long for an index
+    url_hash = models.BinaryField(max_length=16, unique=True, editable=False)
 
     normalized_url = models.TextField()
     title = models.TextField()
     normalized_title = models.TextField()
     content = models.TextField()
     normalized_content = models.TextField()
+    # Offsets between normalized_content and content, None when unknown
+    normalized_offsets = ArrayField(models.IntegerField(), null=True, blank=True)
     content_hash = models.TextField(null=True, blank=True)
     vector = SearchVectorField(null=True, blank=True)
     lang_iso_639_1 = models.CharField(max_length=6, null=True, blank=True, verbose_name='Language')
@@ -109,6 +144,8 @@ class Document(models.Model):
     crawl_next = models.DateTimeField(blank=True, null=True, verbose_name='Crawl next')
     crawl_dt = models.DurationField(blank=True, null=True, verbose_name='Crawl DT')
     crawl_recurse = models.PositiveIntegerField(default=0, verbose_name='Recursion remaining')
+    # Last time the links displayed on the text view were saved, or one of their targets changed
+    links_modified = models.DateTimeField(blank=True, null=True)
     error = models.TextField(blank=True, default='')
     error_hash = models.TextField(blank=True, default='')
     show_on_homepage = models.BooleanField(default=False, help_text='Display this document on the homepage')
@@ -116,6 +153,8 @@ class Document(models.Model):
     worker_no = models.PositiveIntegerField(blank=True, null=True)
 
     supported_langs = None
+    # Number of documents indexed by this process since the index generation was last bumped
+    _indexed_count = 0
 
     class Meta:
         indexes = [GinIndex(fields=(('vector',)))]
@@ -124,6 +163,19 @@ class Document(models.Model):
         super().__init__(*args, **kwargs)
         self._image_name = None
 
+    def save(self, *args, **kwargs):
+        self.url_hash = self.url_hash_digest(self.url)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def url_hash_digest(url):
+        return md5(url.encode('utf-8')).digest()
+
+    @staticmethod
+    def url_lookup(url):
+        # Lookup arguments matching a url through the hash index, the url is also compared in case of collision
+        return {'url_hash': Document.url_hash_digest(url), 'url': url}
+
     def __str__(self):
         return self.url
 
@@ -210,6 +262,29 @@ class Document(models.Model):
 
         return settings.HASHING_ALGO(content).hexdigest()
 
+    @staticmethod
+    def index_generation():
+        # The generation changes each time documents are reindexed or deleted, it is used to invalidate cached
+        # search results
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM se_index_generation')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def bump_index_generation():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval('se_index_generation')")
+
+    @staticmethod
+    def flush_index_generation():
+        # Crawlers bump the generation once per batch of indexed documents (when the queue is empty, or every
+        # minute) so that cached search results are not invalidated after each document
+        if Document._indexed_count == 0:
+            return False
+        Document._indexed_count = 0
+        Document.bump_index_generation()
+        return True
+
     def _index_log(self, s, stats, verbose):
         if not verbose:
             return
@@ -323,11 +398,12 @@ class Document(models.Model):
                     links['text'] += '\n'
 
     def _clear_content(self):
-        from .models import Link
+        from .models import Link, WWWFragment
         self.redirect_url = None
         self.too_many_redirects = False
         self.content = ''
         self.normalized_content = ''
+        self.normalized_offsets = []
         self.title = ''
         self.normalized_title = ''
         self.robotstxt_rejected = False
@@ -336,6 +412,18 @@ class Document(models.Model):
         self.delete_screenshot()
         self.delete_thumbnail()
         Link.objects.filter(doc_from=self).delete()
+        WWWFragment.objects.filter(doc=self).delete()
+
+    def _save_links(self, links):
+        from .models import Link, WWWFragment
+        Link.objects.filter(doc_from=self).delete()
+        # The bulk request triggers a deadlock
+        # Link.objects.bulk_create(links)
+        for link in links:
+            link.save()
+        # The text view is rendered again with the new links
+        WWWFragment.objects.filter(doc=self).delete()
+        self.links_modified = now()
 
     def _parse_xml(self, page, crawl_policy, stats, verbose):
         parsed = feedparser.parse(page.content)
@@ -380,13 +468,11 @@ class Document(models.Model):
 
         self.content = text
         self.normalized_content = remove_accent(text)
+        self.normalized_offsets = remove_accent_offsets(text)
         self.lang_iso_639_1, self.vector_lang = self._get_lang((page.title or '') + '\n' + text)
         self._index_log('remove accent', stats, verbose)
 
-        # The bulk request triggers a deadlock
-        # Link.objects.bulk_create(links['links'])
-        for link in links['links']:
-            link.save()
+        self._save_links(links['links'])
         self._index_log('bulk', stats, verbose)
 
         FavIcon.extract(self, page)
@@ -510,21 +596,21 @@ class Document(models.Model):
 
         if crawl_policy.condition == CrawlPolicy.CRAWL_ALL or parent is None:
             crawl_logger.debug('%s -> always crawl' % url)
-            return Document.objects.get_or_create(url=url)[0]
+            return Document.objects.get_or_create(**Document.url_lookup(url))[0]
 
         if crawl_policy.condition == CrawlPolicy.CRAWL_NEVER:
             crawl_logger.debug('%s -> never crawl' % url)
-            return Document.objects.filter(url=url).first()
+            return Document.objects.filter(**Document.url_lookup(url)).first()
 
         doc = None
         url_depth = None
 
         if parent_policy.condition == CrawlPolicy.CRAWL_ALL and parent_policy.crawl_depth > 0:
-            doc = Document.objects.get_or_create(url=url)[0]
+            doc = Document.objects.get_or_create(**Document.url_lookup(url))[0]
             url_depth = max(parent_policy.crawl_depth, doc.crawl_recurse)
             crawl_logger.debug('%s -> recurse for %s' % (url, url_depth))
         elif parent_policy.condition == CrawlPolicy.CRAWL_ON_DEPTH and parent.crawl_recurse > 1:
-            doc = Document.objects.get_or_create(url=url)[0]
+            doc = Document.objects.get_or_create(**Document.url_lookup(url))[0]
             url_depth = max(parent.crawl_recurse - 1, doc.crawl_recurse)
             crawl_logger.debug('%s -> recurse at %s' % (url, url_depth))
         else:
@@ -534,7 +620,7 @@ class Document(models.Model):
             doc.crawl_recurse = url_depth
             doc.save()
 
-        doc = doc or Document.objects.filter(url=url).first()
+        doc = doc or Document.objects.filter(**Document.url_lookup(url)).first()
         return doc
 
     def _schedule_next(self, changed, crawl_policy):
@@ -561,7 +647,7 @@ class Document(models.Model):
 
     @staticmethod
     def crawl(worker_no):
-        from .models import CrawlPolicy, DomainSetting, Link, WorkerStats
+        from .models import CrawlPolicy, DomainSetting, Link, WorkerStats, WWWFragment
         doc = Document.pick_queued(worker_no)
         if doc is None:
             return False
@@ -621,7 +707,12 @@ class Document(models.Model):
                         doc.index(page, crawl_policy)
                         doc.set_error('')
                         doc.save()
-                        Link.objects.filter(extern_url=doc.url).update(extern_url=None, doc_to=doc)
+                        Document._indexed_count += 1
+                        # The text of documents linking to the url as an external link is rendered again
+                        extern_links = Link.objects.filter(**Link.extern_url_lookup(doc.url))
+                        WWWFragment.clear_linking_extern(extern_links)
+                        extern_links.update(extern_url=None, extern_url_hash=None, doc_to=doc)
+                        WWWFragment.clear_linking_to([doc])
                         break
                     else:
                         if not page.redirect_count:
@@ -630,6 +721,7 @@ class Document(models.Model):
                         doc._schedule_next(doc.url != page.url, crawl_policy)
                         doc._clear_content()
                         doc.redirect_url = page.url
+                        WWWFragment.clear_linking_to([doc])
                         doc.save()
                         doc = Document.pick_or_create(page.url, worker_no)
                         if doc is None:
@@ -682,7 +774,7 @@ class Document(models.Model):
 
     @staticmethod
     def pick_or_create(url, worker_no):
-        doc, created = Document.objects.get_or_create(url=url,
+        doc, created = Document.objects.get_or_create(**Document.url_lookup(url),
                                                       defaults={'worker_no': worker_no})
         if created:
             return doc
@@ -91,7 +91,8 @@ class SearchForm(forms.Form):
                     order_by = (order, '-rank')
                 else:
                     order_by = (order,)
-        cleaned_data['order_by'] = order_by
+        # the id makes the ordering total, as required by cursor pagination
+        cleaned_data['order_by'] = order_by + ('id',)
 
         cleaned_data['c'] = bool(cleaned_data['c'])
         return cleaned_data
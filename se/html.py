@@ -15,29 +15,32 @@
 
 import os
 
+from mimetypes import guess_type
+
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.shortcuts import redirect, render
 
-from .cached import get_cached_doc, get_context, url_from_request
-from .html_asset import HTMLAsset
+from .cached import conditional_cached_doc, get_cached_doc, get_context, url_from_request
+from .html_asset import HTMLCacheIndex, html_asset_file_exists, read_html_asset_file
 from .login import login_required
 from .models import CrawlPolicy
 
 
 @login_required
-def html(request):
-    doc = get_cached_doc(request, 'html')
+@conditional_cached_doc
+def html(request, doc_id):
+    doc = get_cached_doc(request, 'html', doc_id)
     if isinstance(doc, HttpResponse):
         return doc
 
     url = url_from_request(request)
-    asset = HTMLAsset.objects.filter(url=url).order_by('download_date').last()
+    asset = HTMLCacheIndex.get_asset(url)
 
-    if not asset or not os.path.exists(settings.SOSSE_HTML_SNAPSHOT_DIR + asset.filename):
+    if not asset or not html_asset_file_exists(settings.SOSSE_HTML_SNAPSHOT_DIR + asset.filename):
         return redirect(doc.get_absolute_url())
 
-    context = get_context(doc, 'html')
+    context = get_context(doc, 'html', request)
     context['url'] = request.build_absolute_uri(settings.SOSSE_HTML_SNAPSHOT_URL) + asset.filename
     return render(request, 'se/embed.html', context)
 
@@ -54,3 +57,22 @@ def html_excluded(request, crawl_policy, method):
         'method': method
     }
     return render(request, 'se/html_excluded.html', context)
+
+
+def html_pack(request, filename):
+    # Serves HTML snapshot files when the web server passes these requests to SOSSE, as needed by pack files,
+    # files stored before packs were enabled are read from the disk
+    path = os.path.normpath(os.path.join(settings.SOSSE_HTML_SNAPSHOT_DIR, filename))
+    if not path.startswith(settings.SOSSE_HTML_SNAPSHOT_DIR) or path.startswith(os.path.join(settings.SOSSE_HTML_SNAPSHOT_DIR, 'packs', '')):
+        raise Http404()
+
+    try:
+        content = read_html_asset_file(path)
+    except (FileNotFoundError, IsADirectoryError):
+        raise Http404()
+
+    content_type, _ = guess_type(filename)
+    response = HttpResponse(content, content_type=content_type or 'application/octet-stream')
+    # The filename contains a hash of the content
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
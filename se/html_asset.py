@@ -13,13 +13,18 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import fcntl
+import gzip
 import logging
 import os
+import shutil
 from datetime import timedelta
+from hashlib import md5
 
 from bs4 import BeautifulSoup
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import connection, models, transaction
 from django.utils import timezone
 
 from .url import sanitize_url
@@ -28,13 +33,61 @@ from .utils import http_date_parser
 logger = logging.getLogger('html_snapshot')
 
 
+# Text assets that can be stored compressed, to be served by Nginx with gzip_static
+COMPRESSED_EXTENSIONS = ('.css', '.htm', '.html', '.js', '.json', '.svg', '.txt', '.xml')
+
+
+def is_compressible(filename):
+    return filename.endswith(COMPRESSED_EXTENSIONS)
+
+
+def read_html_asset_file(fn):
+    try:
+        with open(fn, 'rb') as fd:
+            return fd.read()
+    except FileNotFoundError:
+        pass
+
+    if is_compressible(fn) and os.path.exists(fn + '.gz'):
+        with gzip.open(fn + '.gz', 'rb') as fd:
+            return fd.read()
+
+    content = HTMLAssetFile.read_packed(fn[len(settings.SOSSE_HTML_SNAPSHOT_DIR):])
+    if content is None:
+        raise FileNotFoundError(fn)
+    return content
+
+
+def html_asset_file_exists(fn):
+    if os.path.exists(fn) or (is_compressible(fn) and os.path.exists(fn + '.gz')):
+        return True
+    filename = fn[len(settings.SOSSE_HTML_SNAPSHOT_DIR):]
+    return HTMLAssetFile.objects.filter(filename=filename, pack__isnull=False).exists()
+
+
+def compress_html_asset_file(fn):
+    # Returns the number of bytes saved
+    tmp_fn = fn + '.gz.tmp'
+    with open(fn, 'rb') as src, gzip.open(tmp_fn, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.rename(tmp_fn, fn + '.gz')
+    saved = os.path.getsize(fn) - os.path.getsize(fn + '.gz')
+    os.unlink(fn)
+    return saved
+
+
 def remove_html_asset_file(fn):
     try:
         logger.debug('deleting %s', fn)
         os.unlink(fn)
     except OSError:
-        # should not happen
+        # should not happen, unless the file is stored compressed
         pass
+    if is_compressible(fn) and os.path.exists(fn + '.gz'):
+        try:
+            os.unlink(fn + '.gz')
+        except OSError:
+            pass
     try:
         dn = os.path.dirname(fn)
         logger.debug('rmdir start %s', dn)
@@ -47,10 +100,214 @@ def remove_html_asset_file(fn):
         pass
 
 
+class HTMLPack(models.Model):
+    # Append-only file storing multiple assets, used when the html_snapshot_pack_size option is set
+    size = models.PositiveBigIntegerField(default=0)
+    dead_bytes = models.PositiveBigIntegerField(default=0)
+    sealed = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.path()
+
+    def path(self):
+        return os.path.join(settings.SOSSE_HTML_SNAPSHOT_DIR, 'packs', '%08i.pack' % self.id)
+
+    @staticmethod
+    def create():
+        # The pack is unsealed once the file exists, so that writers never have to create it
+        pack = HTMLPack.objects.create()
+        os.makedirs(os.path.dirname(pack.path()), 0o755, exist_ok=True)
+        open(pack.path(), 'xb').close()
+        HTMLPack.objects.filter(id=pack.id).update(sealed=False)
+        return pack
+
+    @staticmethod
+    def store(content):
+        # Appends content to a pack, returns the pack and the offset of the content.
+        # Writers are serialized by a lock on the file, and don't write to packs sealed by a concurrent writer.
+        while True:
+            pack = HTMLPack.objects.filter(sealed=False).order_by('id').first()
+            if pack is None:
+                pack = HTMLPack.create()
+
+            try:
+                fd = open(pack.path(), 'r+b')
+            except FileNotFoundError:
+                logger.error('pack %s is missing', pack.path())
+                HTMLPack.objects.filter(id=pack.id).update(sealed=True)
+                continue
+
+            with fd:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if not HTMLPack.objects.filter(id=pack.id, sealed=False).exists():
+                    continue
+
+                offset = fd.seek(0, os.SEEK_END)
+                fd.write(content)
+                fd.flush()
+                size = offset + len(content)
+                HTMLPack.objects.filter(id=pack.id).update(size=size,
+                                                           sealed=size >= settings.SOSSE_HTML_SNAPSHOT_PACK_SIZE * 1024 * 1024)
+            return pack, offset
+
+    @staticmethod
+    def append(filename, content):
+        if HTMLAssetFile.objects.filter(filename=filename, pack__isnull=False).exists():
+            # The filename contains a hash of the content, it is already stored
+            return
+
+        pack, offset = HTMLPack.store(content)
+        count = HTMLAssetFile.objects.filter(filename=filename, pack__isnull=True).update(
+            pack=pack, offset=offset, length=len(content))
+        if count == 0:
+            # Stored concurrently, or garbage collected
+            HTMLPack.add_dead_bytes(pack.id, len(content))
+
+    @staticmethod
+    def add_dead_bytes(pack_id, length):
+        HTMLPack.objects.filter(id=pack_id).update(dead_bytes=models.F('dead_bytes') + length)
+
+    @staticmethod
+    def compact(dead_ratio):
+        # Moves live assets of sealed packs having too many dead bytes to the current pack.
+        # Returns the number of packs removed, and the number of bytes reclaimed.
+        packs = HTMLPack.objects.filter(sealed=True, size__gt=0, dead_bytes__gte=models.F('size') * dead_ratio).order_by('id')
+        count = 0
+        reclaimed = 0
+        for pack in packs:
+            entries = HTMLAssetFile.objects.filter(pack=pack).order_by('offset').values_list('id', 'offset', 'length')
+            with open(pack.path(), 'rb') as src:
+                for asset_file_id, offset, length in entries.iterator():
+                    src.seek(offset)
+                    content = src.read(length)
+                    new_pack, new_offset = HTMLPack.store(content)
+                    moved = HTMLAssetFile.objects.filter(id=asset_file_id, pack=pack).update(pack=new_pack, offset=new_offset)
+                    if moved == 0:
+                        HTMLPack.add_dead_bytes(new_pack.id, length)
+
+            if HTMLAssetFile.objects.filter(pack=pack).exists():
+                continue
+            HTMLPack.objects.filter(id=pack.id).delete()
+            os.unlink(pack.path())
+            logger.debug('pack %s compacted', pack.path())
+            count += 1
+            reclaimed += pack.dead_bytes
+        return count, reclaimed
+
+
+class HTMLAssetFile(models.Model):
+    filename = models.TextField(unique=True)
+    ref_count = models.PositiveBigIntegerField(default=0)
+    # Files referenced by an HTML snapshot, None when unknown
+    assets = ArrayField(models.TextField(), null=True, blank=True)
+    # Location of the file when stored in a pack
+    pack = models.ForeignKey(HTMLPack, null=True, blank=True, on_delete=models.PROTECT)
+    offset = models.PositiveBigIntegerField(null=True, blank=True)
+    length = models.PositiveBigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return self.filename
+
+    @staticmethod
+    def add_refs(filenames):
+        # Creates the files entries if they don't exist, increment their reference count otherwise.
+        # This must be called before writing the file, so that the garbage collector does not delete it.
+        filenames = sorted(set(filenames))
+        if not filenames:
+            return
+
+        table = HTMLAssetFile._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'''INSERT INTO {table} (filename, ref_count)
+                                SELECT unnest(%s::text[]), 1
+                              ON CONFLICT (filename) DO UPDATE SET ref_count = {table}.ref_count + 1''', [filenames])
+        logger.debug('refcount added for %s', filenames)
+
+    @staticmethod
+    def acquire(filename):
+        # Increments the reference count of an existing file, returns False when the file
+        # was garbage collected
+        count = HTMLAssetFile.objects.filter(filename=filename).update(ref_count=models.F('ref_count') + 1)
+        logger.debug('%s refcount incremented for %s', count, filename)
+        return count != 0
+
+    @staticmethod
+    def remove_refs(filenames):
+        filenames = set(filenames)
+        if not filenames:
+            return 0
+        count = HTMLAssetFile.objects.filter(filename__in=filenames, ref_count__gt=0).update(ref_count=models.F('ref_count') - 1)
+        logger.debug('%s refcount removed for %s', count, filenames)
+        return count
+
+    @staticmethod
+    def remove_snapshot_ref(filename):
+        # Removes a reference on a snapshot, returns whether the snapshot was referenced and its
+        # list of assets (None if the manifest is unknown)
+        table = HTMLAssetFile._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'''UPDATE {table} SET ref_count = ref_count - 1
+                              WHERE filename = %s AND ref_count > 0
+                              RETURNING assets''', [filename])
+            row = cursor.fetchone()
+
+        if row is None:
+            return False, None
+        return True, row[0]
+
+    @staticmethod
+    def read_packed(filename):
+        # Returns None if the file is not stored in a pack, retries when it is moved by a concurrent compaction
+        for _ in range(2):
+            asset_file = HTMLAssetFile.objects.filter(filename=filename, pack__isnull=False).select_related('pack').first()
+            if asset_file is None:
+                return None
+            try:
+                with open(asset_file.pack.path(), 'rb') as fd:
+                    fd.seek(asset_file.offset)
+                    return fd.read(asset_file.length)
+            except FileNotFoundError:
+                pass
+        return None
+
+    @staticmethod
+    def set_manifest(filename, assets):
+        HTMLAssetFile.objects.filter(filename=filename).update(assets=sorted(set(assets)))
+
+    @staticmethod
+    def gc(batch_size=1000):
+        # Files are removed lazily, concurrent reference increments on the locked rows wait for the transaction
+        # to complete, and won't match the deleted rows afterward
+        count = 0
+        while True:
+            with transaction.atomic():
+                files = list(HTMLAssetFile.objects.select_for_update(skip_locked=True).filter(ref_count=0)
+                             .order_by('id').values_list('id', 'filename', 'pack_id', 'length')[:batch_size])
+                if not files:
+                    break
+
+                ids = [f[0] for f in files]
+                filenames = [f[1] for f in files]
+                HTMLAsset.objects.filter(filename__in=filenames).delete()
+                HTMLAssetFile.objects.filter(id__in=ids).delete()
+
+                for _, filename, pack_id, length in files:
+                    if pack_id is not None:
+                        # The space is reclaimed by the pack compaction
+                        HTMLPack.add_dead_bytes(pack_id, length)
+                        continue
+                    logger.debug('removing file %s', filename)
+                    remove_html_asset_file(settings.SOSSE_HTML_SNAPSHOT_DIR + filename)
+            count += len(files)
+
+            if len(files) < batch_size:
+                break
+        return count
+
+
 class HTMLAsset(models.Model):
     url = models.TextField()
     filename = models.TextField()
-    ref_count = models.PositiveBigIntegerField(default=0)
     download_date = models.DateTimeField(blank=True, null=True)
     last_modified = models.DateTimeField(blank=True, null=True)
     max_age = models.PositiveBigIntegerField(blank=True, null=True)
@@ -60,16 +317,14 @@ class HTMLAsset(models.Model):
     class Meta:
         unique_together = (('url', 'filename'),)
 
-    def init_ref_count(self):
-        # TODO: fix the race condition below
-        max_ref_count = HTMLAsset.objects.filter(filename=self.filename).aggregate(models.Max('ref_count'))
-        max_ref_count = max_ref_count.get('ref_count__max') or 0
-        HTMLAsset.objects.filter(id=self.id).update(ref_count=max_ref_count)
-        logger.debug('refcount initialized for %s', self.url)
+    def ref_count(self):
+        asset_file = HTMLAssetFile.objects.filter(filename=self.filename).first()
+        if asset_file:
+            return asset_file.ref_count
+        return 0
 
     def increment_ref(self):
-        count = HTMLAsset.objects.filter(filename=self.filename).update(ref_count=models.F('ref_count') + 1)
-        logger.debug('%s refcount incremented for %s', count, self.filename)
+        return HTMLAssetFile.acquire(self.filename)
 
     def update_values(self, **kwargs):
         HTMLAsset.objects.filter(id=self.id).update(**kwargs)
@@ -77,40 +332,33 @@ class HTMLAsset(models.Model):
     @staticmethod
     def html_delete_url(url):
         url = sanitize_url(url)
-        for asset in HTMLAsset.objects.filter(url=url):
+        live_files = HTMLAssetFile.objects.filter(ref_count__gt=0).values('filename')
+        for asset in HTMLAsset.objects.filter(url=url, filename__in=live_files):
             asset.html_delete()
 
     def html_delete(self):
+        # Remove references on the sub-assets only when the snapshot itself was still referenced,
+        # so that they don't get dereferenced twice
+        removed, assets = HTMLAssetFile.remove_snapshot_ref(self.filename)
+        if not removed:
+            return
+
+        if assets is None:
+            # Snapshots created before manifests were stored
+            assets = self.extract_file_assets()
+        HTMLAssetFile.remove_refs(assets)
+
+    def extract_file_assets(self):
         fn = settings.SOSSE_HTML_SNAPSHOT_DIR + self.filename
         try:
-            content = open(fn, 'rb').read()
-            assets = HTMLAsset.html_extract_assets(content)
-            for asset in assets:
-                HTMLAsset.remove_file_ref(asset)
+            content = read_html_asset_file(fn)
+            return HTMLAsset.html_extract_assets(content)
         except OSError:
-            pass
-
-        self.remove_ref()
+            return set()
 
     def remove_ref(self):
-        # TODO: fix the race condition below
         logger.debug('removing ref on url %s', self.url)
-        HTMLAsset.remove_file_ref(self.filename)
-
-    @staticmethod
-    def remove_file_ref(filename):
-        logger.debug('removing ref on %s', filename)
-        # TODO: fix the race condition below
-        HTMLAsset.objects.filter(filename=filename, ref_count__gt=0).update(ref_count=models.F('ref_count') - 1)
-        refs_count = HTMLAsset.objects.filter(filename=filename).aggregate(models.Sum('ref_count'))
-        refs_count = refs_count.get('ref_count__sum')
-
-        # refs_count is None when HTMLAsset.objects.filter(...) returns an empty set
-        if refs_count is None or refs_count <= 0:
-            logger.debug('removing file %s', filename)
-            remove_html_asset_file(settings.SOSSE_HTML_SNAPSHOT_DIR + filename)
-
-        HTMLAsset.objects.filter(filename=filename, ref_count=0).delete()
+        return HTMLAssetFile.remove_refs([self.filename])
 
     @staticmethod
     def html_extract_assets(content):
@@ -151,32 +399,11 @@ class HTMLAsset(models.Model):
 
                     if url.endswith('.css'):
                         filename = settings.SOSSE_HTML_SNAPSHOT_DIR + filename
-                        assets |= css_parser().css_extract_assets(open(filename).read(), False)
+                        content = read_html_asset_file(filename).decode('utf-8')
+                        assets |= css_parser().css_extract_assets(content, False)
 
         return assets
 
-    def add_refs_from_cache(self):
-        from .html_snapshot import css_parser
-        self.add_file_ref(self.filename)
-
-        if '.' not in self.filename:
-            return
-        _, extension = self.filename.rsplit('.', 1)
-
-        if extension not in ('css', 'htm', 'html'):
-            return
-
-        filename = settings.SOSSE_HTML_SNAPSHOT_DIR + self.filename
-        with open(filename, 'rb') as f:
-            content = f.read()
-
-        if extension == 'css':
-            assets = css_parser().css_extract_assets(content, False)
-        else:
-            assets = HTMLAsset.html_extract_assets(content)
-        for asset in assets:
-            HTMLAsset.remove_file_ref(asset)
-
     def update_from_page(self, page):
         download_date = http_date_parser(page.headers.get('Date')) or timezone.now()
         last_modified = http_date_parser(page.headers.get('Last-Modified'))
@@ -230,3 +457,33 @@ class HTMLAsset(models.Model):
                            max_age=max_age,
                            has_cache_control=has_cache_control,
                            etag=etag)
+        self.download_date = download_date
+        self.last_modified = last_modified
+        self.max_age = max_age
+        self.has_cache_control = has_cache_control
+        self.etag = etag
+
+
+class HTMLCacheIndex(models.Model):
+    # Latest asset downloaded for an url, looked up by the md5 digest of the url since urls can be too long for an index
+    url_hash = models.BinaryField(max_length=16, unique=True)
+    asset = models.ForeignKey(HTMLAsset, on_delete=models.CASCADE)
+
+    @staticmethod
+    def url_hash_digest(url):
+        return md5(url.encode('utf-8')).digest()
+
+    @staticmethod
+    def get_asset(url):
+        entry = HTMLCacheIndex.objects.filter(url_hash=HTMLCacheIndex.url_hash_digest(url)).select_related('asset').first()
+        if entry is None or entry.asset.url != url:
+            return None
+        return entry.asset
+
+    @staticmethod
+    def set_asset(asset):
+        table = HTMLCacheIndex._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f'''INSERT INTO {table} (url_hash, asset_id) VALUES (%s, %s)
+                              ON CONFLICT (url_hash) DO UPDATE SET asset_id = EXCLUDED.asset_id''',
+                           [HTMLCacheIndex.url_hash_digest(asset.url), asset.id])
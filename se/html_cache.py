@@ -13,9 +13,11 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import gzip
 import logging
 import os
 
+from collections import OrderedDict
 from datetime import timedelta
 from hashlib import md5
 from mimetypes import guess_extension
@@ -25,7 +27,7 @@ from django.conf import settings
 from django.utils import timezone
 
 from .browser import RequestBrowser
-from .html_asset import HTMLAsset
+from .html_asset import HTMLAsset, HTMLAssetFile, HTMLCacheIndex, HTMLPack, is_compressible
 from .url import sanitize_url
 from .utils import http_date_format
 
@@ -35,6 +37,10 @@ logger = logging.getLogger('html_snapshot')
 # https://developer.mozilla.org/en-US/docs/Web/HTTP/Caching#heuristic_caching
 HEURISTIC_CACHE_THRESHOLD_PERCENT = 10
 HTML_SNAPSHOT_HASH_LEN = 10
+WORKER_CACHE_SIZE = 1024
+
+# Fresh assets recently hit by this worker, they are served without querying the database until they expire
+worker_cache = OrderedDict()
 
 
 def max_filename_size():
@@ -106,9 +112,53 @@ class HTMLCache():
                 logger.debug('cache miss, heuristic_caching, %s + %s < %s', asset.download_date, dt, timezone.now())
                 raise CacheMiss()
 
+    @staticmethod
+    def _fresh_until(asset):
+        # Date until which the asset is served without validation, following the rules of _max_age_check and _heuristic_check
+        if (asset.max_age and asset.last_modified) or asset.etag:
+            if asset.max_age and asset.last_modified:
+                return asset.last_modified + timedelta(seconds=asset.max_age)
+            return None
+
+        if asset.download_date and asset.last_modified:
+            dt = asset.download_date - asset.last_modified
+            dt = (dt.total_seconds() * HEURISTIC_CACHE_THRESHOLD_PERCENT) / 100
+            return asset.download_date + timedelta(seconds=dt)
+        return None
+
+    @staticmethod
+    def _worker_cache_get(url):
+        entry = worker_cache.get(url)
+        if entry is None:
+            return None
+
+        asset, fresh_until = entry
+        if fresh_until <= timezone.now():
+            del worker_cache[url]
+            return None
+
+        worker_cache.move_to_end(url)
+        return asset
+
+    @staticmethod
+    def _worker_cache_set(asset):
+        fresh_until = HTMLCache._fresh_until(asset)
+        if fresh_until is None or fresh_until <= timezone.now():
+            return
+
+        worker_cache[asset.url] = (asset, fresh_until)
+        worker_cache.move_to_end(asset.url)
+        if len(worker_cache) > WORKER_CACHE_SIZE:
+            worker_cache.popitem(last=False)
+
     @staticmethod
     def _cache_check(url, max_file_size):
-        asset = HTMLAsset.objects.filter(url=url).order_by('download_date').last()
+        asset = HTMLCache._worker_cache_get(url)
+        if asset:
+            logger.debug('cache hit, worker cache')
+            raise CacheHit(asset)
+
+        asset = HTMLCacheIndex.get_asset(url)
 
         if not asset:
             logger.debug('cache miss, asset does not exist')
@@ -128,8 +178,11 @@ class HTMLCache():
         try:
             HTMLCache._cache_check(url, max_file_size)
         except CacheHit as e:
-            e.asset.increment_ref()
-            raise
+            if e.asset.increment_ref():
+                HTMLCache._worker_cache_set(e.asset)
+                raise
+            worker_cache.pop(url, None)
+            logger.debug('cache miss, file was garbage collected')
         except CacheRefresh as e:
             return e.page
         except CacheMiss:
@@ -143,15 +196,11 @@ class HTMLCache():
 
     @staticmethod
     def create_cache_entry(url, filename, page=None):
-        asset, created = HTMLAsset.objects.get_or_create(url=url, filename=filename)
-
-        if created:
-            asset.init_ref_count()
-
-        asset.increment_ref()
+        asset, _ = HTMLAsset.objects.get_or_create(url=url, filename=filename)
 
         if page:
             asset.update_from_page(page)
+            HTMLCacheIndex.set_asset(asset)
 
         return asset
 
@@ -179,10 +228,23 @@ class HTMLCache():
 
         url = sanitize_url(url)
         filename_url = HTMLCache.html_filename(url, _hash, extension)
+
+        # Reference the file before writing it, so that it does not get garbage collected
+        HTMLAssetFile.add_refs([filename_url])
+
+        if settings.SOSSE_HTML_SNAPSHOT_PACK_SIZE:
+            HTMLPack.append(filename_url, content)
+            return HTMLCache.create_cache_entry(url, filename_url, page)
+
         dest = os.path.join(settings.SOSSE_HTML_SNAPSHOT_DIR, filename_url)
         dest_dir, _ = dest.rsplit('/', 1)
         os.makedirs(dest_dir, 0o755, exist_ok=True)
 
+        if settings.SOSSE_HTML_SNAPSHOT_COMPRESS and is_compressible(dest):
+            # Served by Nginx with gzip_static
+            dest += '.gz'
+            content = gzip.compress(content)
+
         with open(dest, 'wb') as fd:
             fd.write(content)
 
@@ -25,6 +25,7 @@ from django.shortcuts import reverse
 from django.utils.html import format_html
 
 from .browser import SkipIndexing
+from .html_asset import HTMLAssetFile
 from .html_cache import HTMLCache, CacheHit
 from .url import absolutize_url, has_browsable_scheme
 
@@ -184,8 +185,7 @@ class HTMLSnapshot:
         self.base_url = page.base_url()
 
     def _clear_assets(self):
-        for asset in self.assets:
-            asset.remove_ref()
+        HTMLAssetFile.remove_refs([asset.filename for asset in self.assets])
         self.assets = set()
         self.asset_urls = set()
 
@@ -198,7 +198,8 @@ class HTMLSnapshot:
         try:
             self.sanitize()
             self.handle_assets()
-            HTMLCache.write_asset(self.page.url, self.page.dump_html(), self.page, extension='.html')
+            asset = HTMLCache.write_asset(self.page.url, self.page.dump_html(), self.page, extension='.html')
+            HTMLAssetFile.set_manifest(asset.filename, [a.filename for a in self.assets])
         except Exception as e:  # noqa
             if getattr(settings, 'TEST_MODE', False) and not getattr(settings, 'TEST_HTML_ERROR_HANDLING', False):
                 raise
@@ -206,8 +207,9 @@ class HTMLSnapshot:
             content = 'An error occured while downloading %s:\n%s' % (self.page.url, format_exc())
             content = format_html('<pre>{}</pre>', content)
             content = content.encode('utf-8')
-            HTMLCache.write_asset(self.page.url, content, self.page, extension='.html')
+            asset = HTMLCache.write_asset(self.page.url, content, self.page, extension='.html')
             self._clear_assets()
+            HTMLAssetFile.set_manifest(asset.filename, [])
 
         logger.debug('html_snapshot of %s done' % self.page.url)
 
@@ -0,0 +1,34 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.db.models.lookups import PatternLookup
+
+
+class ILike(PatternLookup):
+    # Case insensitive match, unlike iexact and icontains lookups (using UPPER(...) LIKE UPPER(...)), it can use
+    # trigram indexes
+    lookup_name = 'ilike'
+    param_pattern = '%s'
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, params = self.process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        params.extend(rhs_params)
+        return f'{lhs_sql} ILIKE {rhs_sql}', params
+
+
+class ILikeContains(ILike):
+    lookup_name = 'ilike_contains'
+    param_pattern = '%%%s%%'
@@ -0,0 +1,54 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.core.management.base import BaseCommand
+
+from ...document import remove_accent
+from ...search import rank_documents
+
+
+class Command(BaseCommand):
+    help = 'Compares the latency and precision of search results ranked with a limited number of candidates.'
+    doc = '''Runs the searches provided as arguments, ranking all matching documents, then only ``--candidates``
+    candidates as done with the :ref:`search_rank_candidates <conf_option_search_rank_candidates>` option.
+    The precision is the ratio of the first results ranking all documents that are also returned ranking the candidates.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('query', nargs='+', help='Search terms.')
+        parser.add_argument('--candidates', type=int, default=1000, help='Number of candidates to rank (defaults to 1000).')
+        parser.add_argument('--top', type=int, default=10, help='Number of results to compare (defaults to 10).')
+        parser.add_argument('--lang', default=settings.SOSSE_FAIL_OVER_LANG, help=f'Language of the search (defaults to {settings.SOSSE_FAIL_OVER_LANG}).')
+
+    def _search(self, query, candidates, top):
+        t = perf_counter()
+        results = rank_documents(query, candidates).order_by('-rank', 'id').values_list('id', flat=True)[:top]
+        results = list(results)
+        return results, perf_counter() - t
+
+    def handle(self, *args, **options):
+        top = options['top']
+        for q in options['query']:
+            query = SearchQuery(remove_accent(q), config=options['lang'], search_type='websearch')
+            reference, ref_time = self._search(query, 0, top)
+            results, time = self._search(query, options['candidates'], top)
+
+            precision = 1.0
+            if reference:
+                precision = len(set(reference) & set(results)) / len(reference)
+            self.stdout.write(f'{q}: all documents {ref_time * 1000:.1f}ms, {options["candidates"]} candidates {time * 1000:.1f}ms, precision {precision:.2f}')
@@ -20,6 +20,9 @@ from ...html_asset import HTMLAsset
 
 class Command(BaseCommand):
     help = 'Clears the browsing cache used when making HTML snapshots.'
+    doc = '''Clears the browsing cache used when making HTML snapshots.
+
+    Running crawlers may still use the assets they keep in memory until they expire.'''
 
     def handle(self, *args, **options):
         self.stdout.write('Clearing cache, please wait...')
@@ -0,0 +1,32 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from ...html_asset import HTMLPack
+from ...utils import human_filesize
+
+
+class Command(BaseCommand):
+    help = 'Compacts the pack files of HTML snapshots.'
+    doc = '''Rewrites the live content of the pack files of HTML snapshots having a high ratio of deleted content, see :ref:`HTML snapshots <archive_html_packs>`.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ratio', type=float, default=0.5, help='Minimum ratio of deleted content of packs to compact (defaults to 0.5).')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Compacting HTML packs, please wait...')
+        count, reclaimed = HTMLPack.compact(options['ratio'])
+        self.stdout.write(f'Done, {count} packs removed, {human_filesize(reclaimed)} reclaimed.')
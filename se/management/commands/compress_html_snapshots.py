@@ -0,0 +1,43 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...html_asset import HTMLAssetFile, compress_html_asset_file, is_compressible
+from ...utils import human_filesize
+
+
+class Command(BaseCommand):
+    help = 'Compresses the text files of HTML snapshots stored uncompressed.'
+    doc = '''Compresses the text files of HTML snapshots stored uncompressed, see :ref:`HTML snapshots <archive_html_compression>`.'''
+
+    def handle(self, *args, **options):
+        self.stdout.write('Compressing HTML snapshots, please wait...')
+        count = 0
+        saved = 0
+        for filename in HTMLAssetFile.objects.values_list('filename', flat=True).iterator():
+            if not is_compressible(filename):
+                continue
+
+            fn = settings.SOSSE_HTML_SNAPSHOT_DIR + filename
+            if not os.path.exists(fn):
+                continue
+
+            saved += compress_html_asset_file(fn)
+            count += 1
+        self.stdout.write(f'Done, {count} files compressed, {human_filesize(saved)} saved.')
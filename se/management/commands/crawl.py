@@ -26,7 +26,8 @@ from django.core.management.base import BaseCommand
 from django.utils.timezone import now
 
 from ...browser import Browser
-from ...models import CrawlerStats, Document, CrawlPolicy, MINUTELY, WorkerStats
+from ...html_asset import HTMLAssetFile
+from ...models import CrawlerStats, Document, CrawlPolicy, FavIcon, MINUTELY, WorkerStats
 
 crawl_logger = logging.getLogger('crawler')
 
@@ -66,17 +67,24 @@ class Command(BaseCommand):
                     next_stat = now()
                 next_stat += timedelta(minutes=1)
 
+            next_flush = now() + timedelta(minutes=1)
             sleep_count = 0
             while True:
-                if worker_no == 0:
-                    t = now()
-                    if next_stat < t:
-                        CrawlerStats.create(t)
-                        next_stat = t + timedelta(minutes=1)
+                t = now()
+                if worker_no == 0 and next_stat < t:
+                    CrawlerStats.create(t)
+                    HTMLAssetFile.gc()
+                    next_stat = t + timedelta(minutes=1)
+
+                if next_flush < t:
+                    Document.flush_index_generation()
+                    next_flush = t + timedelta(minutes=1)
 
                 worker_stats = WorkerStats.get_worker(worker_no)
 
                 if worker_stats.state == 'paused' or not Document.crawl(worker_no):
+                    # The batch is over, cached search results are invalidated
+                    Document.flush_index_generation()
                     if worker_stats.state == 'running':
                         worker_stats.update_state('idle')
                     if sleep_count % 60 == 0:
@@ -92,6 +100,21 @@ class Command(BaseCommand):
             crawl_logger.error(format_exc())
             raise
 
+    @staticmethod
+    def favicon_process():
+        # Favicons are downloaded apart from the crawlers, so that slow servers don't delay indexing
+        try:
+            crawl_logger.info('Favicon worker starting')
+            connection.close()
+            connection.connect()
+
+            while True:
+                if not FavIcon.fetch_queued():
+                    sleep(1)
+        except Exception:
+            crawl_logger.error(format_exc())
+            raise
+
     def handle(self, *args, **options):
         Document.objects.exclude(worker_no=None).update(worker_no=None)
         CrawlPolicy.create_default()
@@ -106,7 +129,8 @@ class Command(BaseCommand):
         WorkerStats.objects.filter(worker_no__gte=worker_count).delete()
         crawl_logger.info('Starting %i crawlers' % worker_count)
 
-        workers = []
+        workers = [Process(target=self.favicon_process)]
+        workers[0].start()
         for crawler_no in range(worker_count):
             p = Process(target=self.process, args=(crawler_no, options))
             p.start()
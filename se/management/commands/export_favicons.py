@@ -0,0 +1,33 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from ...models import FavIcon
+
+
+class Command(BaseCommand):
+    help = 'Exports favicons stored in the database to files served by the webserver.'
+    doc = '''Favicons of pages crawled by previous versions are stored in the database only, this command writes them to
+    the favicon directory, so that they can be served directly by the webserver.'''
+
+    def handle(self, *args, **options):
+        count = 0
+        for favicon in FavIcon.objects.filter(missing=False, filename__isnull=True).iterator():
+            favicon.export()
+            if favicon.filename:
+                favicon.save(update_fields=['filename'])
+                count += 1
+        self.stdout.write(f'{count} favicons exported')
@@ -0,0 +1,32 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+
+from ...html_asset import HTMLAsset, HTMLAssetFile
+
+
+class Command(BaseCommand):
+    help = 'Stores the list of assets of HTML snapshots created with older versions, so that they don\'t need to be parsed when deleted.'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Updating HTML snapshot manifests, please wait...')
+        asset_files = HTMLAssetFile.objects.filter(assets__isnull=True, filename__regex=r'\.html?$')
+        count = 0
+        for asset_file in asset_files.iterator():
+            assets = HTMLAsset(filename=asset_file.filename).extract_file_assets()
+            HTMLAssetFile.set_manifest(asset_file.filename, assets)
+            count += 1
+        self.stdout.write(f'Done, {count} snapshots updated.')
@@ -0,0 +1,36 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import WordStats
+
+
+class Command(BaseCommand):
+    help = 'Updates the frequency of words among all documents.'
+    doc = '''Counts the number of documents containing each word, this is used to sort words statistics of searches when the
+    :ref:`word_stats_idf <conf_option_word_stats_idf>` option is enabled. The counts are estimated on a sample of the documents,
+    the command can be run periodically to follow changes of the index.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', type=float, default=10, help='Percentage of the documents analyzed (defaults to 10).')
+
+    def handle(self, *args, **options):
+        sample = options['sample']
+        if sample <= 0 or sample > 100:
+            raise CommandError('The sample must be a percentage between 0 and 100')
+
+        WordStats.refresh(sample)
+        self.stdout.write(f'{WordStats.objects.count()} words counted')
@@ -0,0 +1,236 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 3.2.25 on 2026-10-19 11:44
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+import se.url
+
+
+def forward_asset_files(apps, schema_editor):
+    HTMLAsset = apps.get_model('se', 'HTMLAsset')
+    HTMLAssetFile = apps.get_model('se', 'HTMLAssetFile')
+    files = HTMLAsset.objects.values('filename').annotate(ref_count=models.Max('ref_count'))
+    HTMLAssetFile.objects.bulk_create([HTMLAssetFile(filename=f['filename'], ref_count=f['ref_count']) for f in files], batch_size=1000)
+
+
+def reverse_asset_files(apps, schema_editor):
+    HTMLAsset = apps.get_model('se', 'HTMLAsset')
+    HTMLAssetFile = apps.get_model('se', 'HTMLAssetFile')
+    for asset_file in HTMLAssetFile.objects.all():
+        HTMLAsset.objects.filter(filename=asset_file.filename).update(ref_count=asset_file.ref_count)
+
+
+def forward_lang_stats(apps, schema_editor):
+    Document = apps.get_model('se', 'Document')
+    LangStats = apps.get_model('se', 'LangStats')
+    counts = Document.objects.exclude(lang_iso_639_1__isnull=True).values('lang_iso_639_1').annotate(count=models.Count('id')).order_by()
+    LangStats.objects.bulk_create([LangStats(lang_iso_639_1=c['lang_iso_639_1'], doc_count=c['count']) for c in counts])
+
+
+# Index the most recently downloaded asset of each url
+FORWARD_CACHE_INDEX = '''INSERT INTO se_htmlcacheindex (url_hash, asset_id)
+    SELECT DISTINCT ON (url) decode(md5(url), 'hex'), id FROM se_htmlasset
+    ORDER BY url, download_date DESC NULLS LAST, id DESC'''
+
+
+# Trigram indexes used by search filters, pg_trgm is part of Postgres contrib modules and may not be available
+TRGM_INDEXES = (
+    ('se_document', 'content'),
+    ('se_document', 'title'),
+    ('se_document', 'url'),
+    ('se_document', 'mimetype'),
+    ('se_link', 'text'),
+    ('se_link', 'extern_url'),
+)
+
+FORWARD_TRGM_INDEXES = '''DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        %s
+    END IF;
+EXCEPTION WHEN insufficient_privilege THEN
+    RAISE NOTICE 'pg_trgm could not be installed, search filters will not use indexes';
+END
+$$''' % '\n        '.join([f'CREATE INDEX IF NOT EXISTS {table}_{col}_trgm ON {table} USING gin ({col} gin_trgm_ops);' for table, col in TRGM_INDEXES])
+
+REVERSE_TRGM_INDEXES = '\n'.join([f'DROP INDEX IF EXISTS {table}_{col}_trgm;' for table, col in TRGM_INDEXES])
+
+# Documents per language are counted when documents are added, deleted or change language
+FORWARD_LANG_STATS_TRIGGER = '''CREATE FUNCTION se_langstats_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.lang_iso_639_1 IS NOT DISTINCT FROM NEW.lang_iso_639_1 THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.lang_iso_639_1 IS NOT NULL THEN
+        UPDATE se_langstats SET doc_count = doc_count - 1 WHERE lang_iso_639_1 = OLD.lang_iso_639_1;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.lang_iso_639_1 IS NOT NULL THEN
+        INSERT INTO se_langstats (lang_iso_639_1, doc_count) VALUES (NEW.lang_iso_639_1, 1)
+            ON CONFLICT (lang_iso_639_1) DO UPDATE SET doc_count = se_langstats.doc_count + 1;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER langstats_trigger AFTER INSERT OR DELETE OR UPDATE OF lang_iso_639_1 ON se_document
+    FOR EACH ROW EXECUTE PROCEDURE se_langstats_count();'''
+
+REVERSE_LANG_STATS_TRIGGER = '''DROP TRIGGER langstats_trigger ON se_document;
+DROP FUNCTION se_langstats_count;'''
+
+FORWARD_DOCUMENT_URL_HASH = "UPDATE se_document SET url_hash = decode(md5(url), 'hex')"
+FORWARD_LINK_URL_HASH = "UPDATE se_link SET extern_url_hash = decode(md5(extern_url), 'hex') WHERE extern_url IS NOT NULL"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('se', '0008_sosse_1_6_0'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HTMLAssetFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.TextField(unique=True)),
+                ('ref_count', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(forward_asset_files, reverse_asset_files),
+        migrations.RemoveField(
+            model_name='htmlasset',
+            name='ref_count',
+        ),
+        migrations.AddField(
+            model_name='htmlassetfile',
+            name='assets',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, null=True, size=None),
+        ),
+        migrations.CreateModel(
+            name='HTMLCacheIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url_hash', models.BinaryField(max_length=16, unique=True)),
+                ('asset', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='se.htmlasset')),
+            ],
+        ),
+        migrations.RunSQL(FORWARD_CACHE_INDEX, migrations.RunSQL.noop),
+        migrations.CreateModel(
+            name='HTMLPack',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('dead_bytes', models.PositiveBigIntegerField(default=0)),
+                ('sealed', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='htmlassetfile',
+            name='length',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='htmlassetfile',
+            name='offset',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='htmlassetfile',
+            name='pack',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='se.htmlpack'),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='normalized_offsets',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), blank=True, null=True, size=None),
+        ),
+        migrations.RunSQL('CREATE SEQUENCE se_index_generation', 'DROP SEQUENCE se_index_generation'),
+        migrations.CreateModel(
+            name='LangStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lang_iso_639_1', models.CharField(max_length=6, unique=True)),
+                ('doc_count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.RunSQL(FORWARD_TRGM_INDEXES, REVERSE_TRGM_INDEXES),
+        migrations.CreateModel(
+            name='WordStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('word', models.TextField(unique=True)),
+                ('ndoc', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='WWWFragment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.TextField(blank=True, null=True)),
+                ('content', models.BinaryField()),
+                ('doc', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='se.document')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='favicon',
+            name='filename',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='favicon',
+            name='fetch_next',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='favicon',
+            name='fetch_retries',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='url_hash',
+            field=models.BinaryField(max_length=16, null=True),
+        ),
+        migrations.RunSQL(FORWARD_DOCUMENT_URL_HASH, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='document',
+            name='url_hash',
+            field=models.BinaryField(max_length=16, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='url',
+            field=models.TextField(validators=[se.url.validate_url]),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='extern_url_hash',
+            field=models.BinaryField(blank=True, db_index=True, max_length=16, null=True),
+        ),
+        migrations.RunSQL(FORWARD_LINK_URL_HASH, migrations.RunSQL.noop),
+        migrations.RunPython(forward_lang_stats, migrations.RunPython.noop),
+        migrations.RunSQL(FORWARD_LANG_STATS_TRIGGER, REVERSE_LANG_STATS_TRIGGER),
+        migrations.AddField(
+            model_name='document',
+            name='links_modified',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunSQL('CREATE SEQUENCE se_crawl_policy_generation', 'DROP SEQUENCE se_crawl_policy_generation'),
+    ]
@@ -17,18 +17,27 @@ import os
 import re
 import urllib.parse
 import logging
+import mimetypes
+import zlib
 
 from base64 import b64encode, b64decode
+from collections import OrderedDict
+from copy import copy
 from datetime import timedelta
 from defusedxml import ElementTree
 from hashlib import md5
+from time import monotonic
 from urllib.parse import urlparse
 
 from django.core.exceptions import ValidationError
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connection, models, transaction
 from django.http import QueryDict
+from django.shortcuts import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from publicsuffix2 import get_public_suffix, PublicSuffixList
 import requests
@@ -47,11 +56,23 @@ class Link(models.Model):
     pos = models.PositiveIntegerField()
     link_no = models.PositiveIntegerField()
     extern_url = models.TextField(null=True, blank=True)
+    # md5 digest of extern_url, to resolve external links once their target gets indexed
+    extern_url_hash = models.BinaryField(max_length=16, null=True, blank=True, db_index=True, editable=False)
     screen_pos = models.CharField(max_length=64, null=True, blank=True)
 
     class Meta:
         unique_together = ('doc_from', 'link_no')
 
+    def save(self, *args, **kwargs):
+        self.extern_url_hash = None
+        if self.extern_url is not None:
+            self.extern_url_hash = Document.url_hash_digest(self.extern_url)
+        super().save(*args, **kwargs)
+
+    @staticmethod
+    def extern_url_lookup(url):
+        return {'extern_url_hash': Document.url_hash_digest(url), 'extern_url': url}
+
     def pos_left(self):
         if not self.screen_pos:
             return 0
@@ -78,6 +99,77 @@ class Link(models.Model):
         return self.screen_pos.split(',')[3]
 
 
+class WWWFragment(models.Model):
+    # Compressed HTML content of the text view of a document, rendered once per content hash. Fragments are deleted
+    # when the links of the document are saved again, or when the target of one of its links changes
+    doc = models.OneToOneField(Document, on_delete=models.CASCADE)
+    content_hash = models.TextField(null=True, blank=True)
+    content = models.BinaryField()
+
+    @staticmethod
+    def render(doc):
+        content = []
+        content_pos = 0
+
+        # All links are fetched in a single query, the large fields of the linked documents are not needed
+        links = Link.objects.filter(doc_from=doc).order_by('link_no').select_related('doc_to')
+        links = list(links.defer('doc_to__content', 'doc_to__normalized_content', 'doc_to__vector'))
+        links_count = len(links)
+        link_no = 0
+        for line in doc.content.splitlines():
+            while link_no < links_count and links[link_no].pos < content_pos + len(line):
+                link = links[link_no]
+                link_pos = link.pos - content_pos
+                txt = line[:link_pos]
+                line = line[link_pos + len(link.text or ''):]
+                content_pos += len(txt) + len(link.text or '')
+
+                if link.doc_to:
+                    content.append(format_html('{}<a href="{}">{}</a> · <a href="{}">🌍</a>',
+                                               txt,
+                                               link.doc_to.get_absolute_url(),
+                                               link.text or '<no text link>',
+                                               link.doc_to.url))
+                else:
+                    content.append(format_html('{} [{}] · <a href="{}">🌍</a>',
+                                               txt,
+                                               link.text or '<no text link>',
+                                               link.extern_url))
+                link_no += 1
+
+            content_pos += len(line) + 1  # +1 for the \n stripped by splitlines()
+            content.append(format_html('{}<br/>', line))
+        return ''.join(content)
+
+    @staticmethod
+    def get(doc):
+        fragment = WWWFragment.objects.filter(doc=doc).first()
+        if fragment is None or fragment.content_hash != doc.content_hash:
+            content = zlib.compress(WWWFragment.render(doc).encode('utf-8'))
+            fragment, _ = WWWFragment.objects.update_or_create(doc=doc, defaults={
+                'content_hash': doc.content_hash,
+                'content': content
+            })
+        return fragment
+
+    @staticmethod
+    def _clear(docs):
+        # The modification date of the links is part of the validators of the cached pages
+        WWWFragment.objects.filter(doc__in=docs).delete()
+        Document.objects.filter(id__in=docs.values('id')).update(links_modified=now())
+
+    @staticmethod
+    def clear_linking_to(docs):
+        WWWFragment._clear(Document.objects.filter(links_to__doc_to__in=docs))
+
+    @staticmethod
+    def clear_linking_extern(links):
+        WWWFragment._clear(Document.objects.filter(links_to__in=links))
+
+    def get_content(self):
+        return mark_safe(zlib.decompress(self.content).decode('utf-8'))
+
+
 class AuthField(models.Model):
     key = models.CharField(max_length=256, verbose_name='<input> name attribute')
     value = models.CharField(max_length=256)
@@ -170,6 +262,41 @@ class CrawlerStats(models.Model):
                                     freq=MINUTELY)
 
 
+class LangStats(models.Model):
+    # Number of documents per language, maintained by a database trigger on se_document
+    lang_iso_639_1 = models.CharField(max_length=6, unique=True)
+    doc_count = models.PositiveIntegerField()
+
+    CACHE_TIMEOUT = 60
+    cached_langs = None
+    cached_until = None
+
+    @classmethod
+    def get_langs(cls):
+        # Languages of the indexed documents, cached by the process for CACHE_TIMEOUT seconds
+        t = monotonic()
+        if cls.cached_langs is None or cls.cached_until < t:
+            cls.cached_langs = set(cls.objects.filter(doc_count__gt=0).values_list('lang_iso_639_1', flat=True))
+            cls.cached_until = t + cls.CACHE_TIMEOUT
+        return cls.cached_langs
+
+
+class WordStats(models.Model):
+    # Number of documents containing each word, estimated on a sample of documents by the update_word_stats command
+    word = models.TextField(unique=True)
+    ndoc = models.PositiveIntegerField()
+
+    @staticmethod
+    def refresh(sample):
+        # sample is the percentage of the documents analyzed
+        with transaction.atomic():
+            WordStats.objects.all().delete()
+            with connection.cursor() as cursor:
+                cursor.execute('''INSERT INTO se_wordstats (word, ndoc)
+                    SELECT lexeme, round(count(*) * 100.0 / %s) FROM se_document TABLESAMPLE SYSTEM (%s), unnest(vector)
+                    GROUP BY lexeme''', (sample, sample))
+
+
 def validate_search_url(value):
     if '{searchTerms}' not in value and '{searchTermsBase64}' not in value:
         raise ValidationError('This field must contain the search url with a {searchTerms} or a {searchTermsBase64} string parameter')
@@ -226,53 +353,81 @@ class SearchEngine(models.Model):
 
         cls.parse_odf(buf)
 
-    def get_search_url(self, query):
+    SHORTCUTS_CACHE_TIMEOUT = 60
+    shortcuts = None
+    shortcuts_until = None
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        SearchEngine.clear_shortcuts()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        SearchEngine.clear_shortcuts()
+        return ret
+
+    @classmethod
+    def clear_shortcuts(cls):
+        cls.shortcuts = None
+
+    @classmethod
+    def get_shortcuts(cls):
+        # Returns search engines by shortcut and by short name, cached by the process for SHORTCUTS_CACHE_TIMEOUT
+        # seconds since other processes may update them
+        t = monotonic()
+        if cls.shortcuts is None or cls.shortcuts_until < t:
+            by_shortcut = {}
+            by_name = {}
+            for se in cls.objects.order_by('id'):
+                by_shortcut.setdefault(se.shortcut, se)
+                by_name[se.short_name] = se
+            cls.shortcuts = (by_shortcut, by_name)
+            cls.shortcuts_until = t + cls.SHORTCUTS_CACHE_TIMEOUT
+        return cls.shortcuts
+
+    @cached_property
+    def _template(self):
+        # The template split in parts, with the location of the search terms placeholder
         se_url = urllib.parse.urlsplit(self.html_template)
+        for part in ('path', 'fragment'):
+            for placeholder in ('{searchTerms}', '{searchTermsBase64}'):
+                if placeholder in getattr(se_url, part):
+                    return se_url, part, placeholder, None
+
+        se_params = urllib.parse.parse_qs(se_url.query)
+        for key, val in se_params.items():
+            for placeholder in ('{searchTerms}', '{searchTermsBase64}'):
+                if placeholder in val[0]:
+                    return se_url, 'query', placeholder, key
+        raise Exception('could not find {searchTerms} or {searchTermsBase64} parameter')
+
+    def get_search_url(self, query):
+        se_url, part, placeholder, param = self._template
+
+        if placeholder == '{searchTermsBase64}':
+            query = b64encode(query.encode('utf-8')).decode('utf-8')
 
         # In url path
-        if '{searchTerms}' in se_url.path:
-            query = urllib.parse.quote_plus(query)
-            se_url_path = se_url.path.replace('{searchTerms}', query)
-            se_url = se_url._replace(path=se_url_path)
-            return urllib.parse.urlunsplit(se_url)
-
-        if '{searchTermsBase64}' in se_url.path:
-            query = urllib.parse.quote_plus(b64encode(query.encode('utf-8')).decode('utf-8'))
-            se_url_path = se_url.path.replace('{searchTermsBase64}', query)
-            se_url = se_url._replace(path=se_url_path)
-            return urllib.parse.urlunsplit(se_url)
+        if part == 'path':
+            se_url_path = se_url.path.replace(placeholder, urllib.parse.quote_plus(query))
+            return urllib.parse.urlunsplit(se_url._replace(path=se_url_path))
 
         # In url fragment (the part after #)
-        if '{searchTerms}' in se_url.fragment:
-            query = urllib.parse.quote_plus(query)
-            se_url_frag = se_url.fragment.replace('{searchTerms}', query)
-            se_url = se_url._replace(fragment=se_url_frag)
-            return urllib.parse.urlunsplit(se_url)
-
-        if '{searchTermsBase64}' in se_url.fragment:
-            se_url_frag = se_url.fragment.replace('{searchTermsBase64}', b64encode(query.encode('utf-8')).decode('utf-8'))
-            se_url = se_url._replace(fragment=se_url_frag)
-            return urllib.parse.urlunsplit(se_url)
+        if part == 'fragment':
+            if placeholder == '{searchTerms}':
+                query = urllib.parse.quote_plus(query)
+            se_url_frag = se_url.fragment.replace(placeholder, query)
+            return urllib.parse.urlunsplit(se_url._replace(fragment=se_url_frag))
 
         # In url parameters
         se_params = urllib.parse.parse_qs(se_url.query)
-        for key, val in se_params.items():
-            val = val[0]
-            if '{searchTerms}' in val:
-                se_params[key] = [val.replace('{searchTerms}', query)]
-                break
-            if '{searchTermsBase64}' in val:
-                se_params[key] = [val.replace('{searchTermsBase64}', b64encode(query.encode('utf-8')).decode('utf-8'))]
-                break
-        else:
-            raise Exception('could not find {searchTerms} or {searchTermsBase64} parameter')
-
+        se_params[param] = [se_params[param][0].replace(placeholder, query)]
         se_url_query = urllib.parse.urlencode(se_params, doseq=True)
-        se_url = se_url._replace(query=se_url_query)
-        return urllib.parse.urlunsplit(se_url)
+        return urllib.parse.urlunsplit(se_url._replace(query=se_url_query))
 
     @classmethod
     def should_redirect(cls, query):
+        by_shortcut, by_name = cls.get_shortcuts()
         se = None
         for i, w in enumerate(query.split()):
             if not w.startswith(settings.SOSSE_SEARCH_SHORTCUT_CHAR):
@@ -282,7 +437,7 @@ class SearchEngine(models.Model):
             if settings.SOSSE_DEFAULT_SEARCH_REDIRECT and se_str == settings.SOSSE_SOSSE_SHORTCUT:
                 return
 
-            se = SearchEngine.objects.filter(shortcut=se_str).first()
+            se = by_shortcut.get(se_str)
             if se is None:
                 continue
 
@@ -293,7 +448,7 @@ class SearchEngine(models.Model):
         else:
             # Follow the default redirect if a query was provided
             if settings.SOSSE_DEFAULT_SEARCH_REDIRECT and query.strip():
-                se = SearchEngine.objects.filter(short_name=settings.SOSSE_DEFAULT_SEARCH_REDIRECT).first()
+                se = by_name.get(settings.SOSSE_DEFAULT_SEARCH_REDIRECT)
 
         if se:
             return se.get_search_url(query)
@@ -304,6 +459,36 @@ class FavIcon(models.Model):
     content = models.BinaryField(null=True, blank=True)
     mimetype = models.CharField(max_length=64, null=True, blank=True)
     missing = models.BooleanField(default=True)
+    # Name of the file exported in SOSSE_FAVICONS_DIR, derived from the content
+    filename = models.TextField(null=True, blank=True)
+    # Next download attempt, None when the favicon is not queued
+    fetch_next = models.DateTimeField(null=True, blank=True, db_index=True)
+    fetch_retries = models.PositiveIntegerField(default=0)
+
+    # Delay before downloading again a missing favicon, doubled after each failure
+    FETCH_RETRY_DELAY = timedelta(hours=1)
+    FETCH_MAX_RETRIES = 5
+
+    def get_absolute_url(self):
+        if self.filename:
+            return settings.SOSSE_FAVICONS_URL + self.filename
+        return reverse('favicon', args=(self.id,))
+
+    def export(self):
+        # Writes the content to a file named after its digest, so that it can be cached forever by browsers
+        if self.missing or not self.content:
+            return
+
+        content = bytes(self.content)
+        filename = md5(content).hexdigest() + (mimetypes.guess_extension(self.mimetype or '') or '')
+        path = os.path.join(settings.SOSSE_FAVICONS_DIR, filename)
+        if not os.path.exists(path):
+            os.makedirs(settings.SOSSE_FAVICONS_DIR, exist_ok=True)
+            tmp_path = '%s.%i.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        self.filename = filename
 
     @classmethod
     def extract(cls, doc, page):
@@ -315,6 +500,11 @@ class FavIcon(models.Model):
         url = absolutize_url(doc.url, url)
         url = url_remove_query_string(url_remove_fragment(url))
 
+        if not url.startswith('data:'):
+            # The favicon is downloaded later by the favicon worker of the crawl command, see fetch_queued()
+            doc.favicon, _ = FavIcon.objects.get_or_create(url=url, defaults={'fetch_next': now()})
+            return
+
         favicon, created = FavIcon.objects.get_or_create(url=url)
         doc.favicon = favicon
 
@@ -322,27 +512,68 @@ class FavIcon(models.Model):
             return
 
         try:
-            if url.startswith('data:'):
-                data = url.split(':', 1)[1]
-                mimetype, data = data.split(';', 1)
-                encoding, data = data.split(',', 1)
-                if encoding != 'base64':
-                    raise Exception('encoding %s not supported' % encoding)
-                data = b64decode(data)
-                favicon.mimetype = mimetype
-                favicon.content = data
+            data = url.split(':', 1)[1]
+            mimetype, data = data.split(';', 1)
+            encoding, data = data.split(',', 1)
+            if encoding != 'base64':
+                raise Exception('encoding %s not supported' % encoding)
+            data = b64decode(data)
+            favicon.mimetype = mimetype
+            favicon.content = data
+            favicon.missing = False
+            favicon.export()
+        except Exception:
+            pass
+
+        favicon.save()
+
+    @staticmethod
+    def _host_prefix(url):
+        parsed = urlparse(url)
+        return f'{parsed.scheme}://{parsed.netloc}/'
+
+    @staticmethod
+    def fetch_queued():
+        # Downloads the next favicon waiting in the queue, returns False when there is none
+        while True:
+            favicon = FavIcon.objects.filter(fetch_next__lte=now()).order_by('fetch_next', 'id').first()
+            if favicon is None:
+                return False
+
+            # The favicon is rescheduled before the download, so that it is retried if the download is interrupted
+            updated = FavIcon.objects.filter(id=favicon.id,
+                                             fetch_next=favicon.fetch_next).update(fetch_next=now() + FavIcon.FETCH_RETRY_DELAY)
+            if updated:
+                break
+
+        host_failed = False
+        try:
+            page = RequestBrowser.get(favicon.url, check_status=True)
+            from magic import from_buffer as magic_from_buffer
+            favicon.mimetype = magic_from_buffer(page.content, mime=True)
+            if favicon.mimetype.startswith('image/'):
+                favicon.content = page.content
                 favicon.missing = False
-            else:
-                page = RequestBrowser.get(url, check_status=True)
-                from magic import from_buffer as magic_from_buffer
-                favicon.mimetype = magic_from_buffer(page.content, mime=True)
-                if favicon.mimetype.startswith('image/'):
-                    favicon.content = page.content
-                    favicon.missing = False
+                favicon.export()
+        except (requests.ConnectionError, requests.Timeout):
+            host_failed = True
         except Exception:
             pass
 
+        favicon.fetch_next = None
+        if favicon.missing:
+            favicon.fetch_retries += 1
+            retry_next = now() + FavIcon.FETCH_RETRY_DELAY * 2 ** (favicon.fetch_retries - 1)
+            if favicon.fetch_retries < FavIcon.FETCH_MAX_RETRIES:
+                favicon.fetch_next = retry_next
+            crawl_logger.debug('favicon %s could not be downloaded (%i failures)', favicon.url, favicon.fetch_retries)
+
+            if host_failed:
+                # The other favicons of an unreachable host are postponed too, so that it stalls a single download
+                FavIcon.objects.filter(fetch_next__lt=retry_next,
+                                       url__startswith=FavIcon._host_prefix(favicon.url)).exclude(id=favicon.id).update(fetch_next=retry_next)
         favicon.save()
+        return True
 
     @classmethod
     def _get_url(cls, page):
@@ -542,6 +773,11 @@ class DomainSetting(models.Model):
         return DomainSetting.objects.get_or_create(domain=domain,
                                                    defaults={'browse_mode': default_browse_mode})[0]
 
+    @staticmethod
+    def get_existing_from_url(url):
+        # Read only lookup, returns None when the domain has not been crawled yet
+        return DomainSetting.objects.filter(domain=urlparse(url).netloc).first()
+
 
 class Cookie(models.Model):
     TLDS = PublicSuffixList().tlds
@@ -732,9 +968,64 @@ class CrawlPolicy(models.Model):
     class Meta:
         verbose_name_plural = 'crawl policies'
 
+    # Policies matching urls, cached by the process to display documents until the generation of the policies changes
+    URL_CACHE_SIZE = 1000
+    url_cache = OrderedDict()
+    url_cache_generation = None
+
     def __str__(self):
         return f'「{self.url_regex}」'
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        CrawlPolicy.clear_url_cache()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        CrawlPolicy.clear_url_cache()
+        return ret
+
+    @staticmethod
+    def generation():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM se_crawl_policy_generation')
+            return cursor.fetchone()[0]
+
+    @staticmethod
+    def bump_generation():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT nextval('se_crawl_policy_generation')")
+
+    @classmethod
+    def clear_url_cache(cls):
+        cls.url_cache.clear()
+        # Other processes drop their cache once the new policies are visible to them
+        transaction.on_commit(CrawlPolicy.bump_generation)
+
+    @classmethod
+    def get_from_url_cached(cls, url, request=None):
+        # Same as get_from_url(), returns a copy of the policy. The generation is read once per request when one is
+        # provided, the crawler must not use it
+        generation = getattr(request, '_crawl_policy_generation', None)
+        if generation is None:
+            generation = cls.generation()
+            if request is not None:
+                request._crawl_policy_generation = generation
+
+        if generation != cls.url_cache_generation:
+            cls.url_cache.clear()
+            cls.url_cache_generation = generation
+
+        policy = cls.url_cache.get(url)
+        if policy is None:
+            policy = cls.get_from_url(url)
+            cls.url_cache[url] = policy
+            if len(cls.url_cache) > cls.URL_CACHE_SIZE:
+                cls.url_cache.popitem(last=False)
+        else:
+            cls.url_cache.move_to_end(url)
+        return copy(policy)
+
     @staticmethod
     def create_default():
         # mandatory default policy
@@ -0,0 +1,233 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import binascii
+import json
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.core.paginator import EmptyPage, InvalidPage, Page, Paginator
+from django.db import connection, models
+from django.utils.functional import cached_property
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(number, reverse, key):
+    # Opaque token locating a page by the ordering values of the row preceding it (or following it when reverse
+    # is set), and its page number
+    # datetimes are serialized with their microseconds, unlike with DjangoJSONEncoder
+    cursor = json.dumps([number, reverse, key], default=lambda o: o.isoformat())
+    return urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        cursor += '=' * (-len(cursor) % 4)
+        number, reverse, key = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+
+    if not isinstance(number, int) or number < 1 or not isinstance(reverse, bool) or not isinstance(key, list):
+        raise InvalidCursor('Invalid cursor')
+    return number, reverse, key
+
+
+def row_key(row, ordering):
+    return [getattr(row, order.lstrip('-')) for order in ordering]
+
+
+def keyset_filter(queryset, ordering, key, reverse=False):
+    # Filters the rows following the row having the ordering values key, or preceding it when reverse is set
+    if len(key) != len(ordering):
+        raise InvalidCursor('Invalid cursor')
+
+    after = models.Q(pk__in=[])
+    equal = models.Q()
+    for order, value in zip(ordering, key):
+        field = order.lstrip('-')
+        desc = order.startswith('-') != reverse
+
+        # Like Postgres, NULL values are sorted last in ascending order and first in descending order
+        if value is None:
+            if desc:
+                after |= equal & models.Q(**{field + '__isnull': False})
+            equal &= models.Q(**{field + '__isnull': True})
+        else:
+            if desc:
+                after |= equal & models.Q(**{field + '__lt': value})
+            else:
+                after |= equal & (models.Q(**{field + '__gt': value}) | models.Q(**{field + '__isnull': True}))
+            equal &= models.Q(**{field: value})
+    return queryset.filter(after)
+
+
+def estimate_count(queryset):
+    # Number of rows estimated by the query planner
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_results(queryset):
+    # Returns the number of results, and whether it is exact, following the result_count option
+    if settings.SOSSE_RESULT_COUNT == 'exact':
+        return queryset.count(), True
+
+    cap = settings.SOSSE_RESULT_COUNT_CAP
+    count = queryset.order_by()[:cap + 1].count()
+    if count <= cap:
+        return count, True
+
+    if settings.SOSSE_RESULT_COUNT == 'estimate':
+        return max(estimate_count(queryset), cap), False
+    return cap, False
+
+
+class CachedResults:
+    # Search results backed by a cached list of (document id, rank), only the rows of the requested slice are
+    # fetched. Results past the cached ids are fetched from the queryset returned by get_queryset()
+    def __init__(self, ranks, count_info, ordering, rows, get_queryset):
+        self.ranks = ranks
+        self.count_info = count_info
+        self.ordering = ordering
+        self.rows = rows
+        self.get_queryset = get_queryset
+
+    def is_complete(self):
+        count, exact = self.count_info
+        return exact and count <= len(self.ranks)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError('CachedResults only supports slicing')
+
+        if key.stop is not None and key.stop > len(self.ranks) and not self.is_complete():
+            return list(self.get_queryset()[key])
+
+        ranks = self.ranks[key]
+        docs = self.rows.in_bulk([doc_id for doc_id, _ in ranks])
+        results = []
+        for doc_id, rank in ranks:
+            doc = docs.get(doc_id)
+            if doc is None:
+                # deleted since the results were cached
+                continue
+            if rank is not None:
+                doc.rank = rank
+            results.append(doc)
+        return results
+
+
+class SearchPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+    def next_cursor(self):
+        return encode_cursor(self.number + 1, False, row_key(self.object_list[-1], self.paginator.ordering))
+
+    def previous_cursor(self):
+        return encode_cursor(self.number - 1, True, row_key(self.object_list[0], self.paginator.ordering))
+
+
+class SearchPaginator(Paginator):
+    # Paginator that only fetches the rows of the requested page, the count may be a lower bound or an
+    # estimation so the page following the last one counted can still be browsed
+    @cached_property
+    def count_info(self):
+        if isinstance(self.object_list, CachedResults):
+            return self.object_list.count_info
+        return count_results(self.object_list)
+
+    @cached_property
+    def count(self):
+        return self.count_info[0]
+
+    @cached_property
+    def ordering(self):
+        if isinstance(self.object_list, CachedResults):
+            return self.object_list.ordering
+        return self.object_list.query.order_by
+
+    @cached_property
+    def count_is_exact(self):
+        return self.count_info[1]
+
+    def validate_number(self, number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.count_is_exact or int(number) < 1:
+                raise
+            return int(number)
+
+    def get_page(self, number):
+        try:
+            return super().get_page(number)
+        except EmptyPage:
+            return self.page(self.num_pages)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not object_list and number > 1:
+            raise EmptyPage('That page contains no results')
+        has_next = len(object_list) > self.per_page
+        return SearchPage(object_list[:self.per_page], number, self, has_next)
+
+    def get_cursor_page(self, cursor):
+        # Returns the page located by a cursor, filtering on the ordering columns instead of using an offset
+        try:
+            number, reverse, key = decode_cursor(cursor)
+        except InvalidCursor:
+            return self.get_page(1)
+
+        try:
+            return self.cursor_page(number, reverse, key)
+        except (EmptyPage, InvalidCursor):
+            return self.get_page(number)
+
+    def cursor_page(self, number, reverse, key):
+        queryset = self.object_list
+        if isinstance(queryset, CachedResults):
+            if queryset.is_complete() or number * self.per_page < len(queryset.ranks):
+                return self.page(number)
+            queryset = queryset.get_queryset()
+
+        queryset = keyset_filter(queryset, self.ordering, key, reverse)
+        if reverse:
+            queryset = queryset.reverse()
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if not object_list:
+            raise EmptyPage('That page contains no results')
+
+        if reverse:
+            object_list.reverse()
+            return SearchPage(object_list, number, self, True)
+        return SearchPage(object_list, number, self, has_more)
@@ -17,17 +17,18 @@ from django.conf import settings
 from django.http import HttpResponse
 from django.shortcuts import render
 
-from .cached import get_cached_doc, get_context, url_from_request
+from .cached import conditional_cached_doc, get_cached_doc, get_context, url_from_request
 from .login import login_required
 
 
 @login_required
-def screenshot(request):
-    doc = get_cached_doc(request, 'screenshot')
+@conditional_cached_doc
+def screenshot(request, doc_id):
+    doc = get_cached_doc(request, 'screenshot', doc_id)
     if isinstance(doc, HttpResponse):
         return doc
 
-    context = get_context(doc, 'screenshot')
+    context = get_context(doc, 'screenshot', request)
     context.update({
         'url': request.build_absolute_uri('/screenshot_full/') + url_from_request(request)
     })
@@ -35,12 +36,13 @@ def screenshot(request):
 
 
 @login_required
-def screenshot_full(request):
-    doc = get_cached_doc(request, 'screenshot')
+@conditional_cached_doc
+def screenshot_full(request, doc_id):
+    doc = get_cached_doc(request, 'screenshot', doc_id)
     if isinstance(doc, HttpResponse):
         return doc
 
-    context = get_context(doc, 'screenshot')
+    context = get_context(doc, 'screenshot', request)
     context.update({
         'screenshot': settings.SOSSE_SCREENSHOTS_URL + '/' + doc.image_name(),
         'screenshot_size': doc.screenshot_size.split('x'),
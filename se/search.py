@@ -13,17 +13,24 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import logging
 import re
 import uuid
 
+from hashlib import md5
+
 from django.conf import settings
-from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
-from django.db import models
+from django.core.cache import caches
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVectorField
+from django.db import connection, models
+from django.db.models.functions import Cast
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 
-from .document import Document, remove_accent
+from .document import Document, content_pos, remove_accent, remove_accent_offsets
+from .models import Link, WordStats
+from .paginator import CachedResults, count_results, estimate_count
 
 
 logger = logging.getLogger('web')
@@ -31,31 +38,14 @@ logger = logging.getLogger('web')
 FILTER_RE = '(ft|ff|fo|fv|fc)[0-9]+$'
 
 
-def get_documents(request, form, stats_call=False):
-    REQUIRED_KEYS = ('ft', 'ff', 'fo', 'fv')
-
-    results = Document.objects.all()
-    has_query = False
-
-    q = form.cleaned_data['q']
-    q = remove_accent(q)
-    query = None
-    if q:
-        has_query = True
-        lang = form.cleaned_data['l']
-        query = SearchQuery(q, config=lang, search_type='websearch')
-        all_results = Document.objects.filter(vector=query).annotate(
-            rank=SearchRank(models.F('vector'), query),
-        )
-        results = all_results.exclude(rank__lte=0.01)
+# Columns not required to render a result page, the headline is computed by get_headlines()
+RESULT_DEFERRED_FIELDS = ('content', 'normalized_content', 'normalized_title', 'normalized_url', 'normalized_offsets',
+                          'vector', 'error', 'favicon__content')
 
-        if results.count() == 0:
-            results = all_results
 
-    if settings.SOSSE_EXCLUDE_NOT_INDEXED:
-        results = results.exclude(crawl_last__isnull=True)
-    if settings.SOSSE_EXCLUDE_REDIRECT:
-        results = results.filter(redirect_url__isnull=True)
+def get_filters(request):
+    # Returns the filters of the query, ignoring incomplete ones
+    REQUIRED_KEYS = ('ft', 'ff', 'fo', 'fv')
 
     filters = {}
     for key, val in request.GET.items():
@@ -67,16 +57,108 @@ def get_documents(request, form, stats_call=False):
         f[key[:2]] = val
         filters[filter_no] = f
 
-    for f in filters.values():
-        cont = True
-        for k in REQUIRED_KEYS:
-            if not f.get(k):
-                break
+    return [f for f in filters.values() if all(f.get(k) for k in REQUIRED_KEYS)]
+
+
+def get_query(form):
+    q = remove_accent(form.cleaned_data['q'])
+    if q:
+        return SearchQuery(q, config=form.cleaned_data['l'], search_type='websearch')
+    return None
+
+
+def search_cache_key(request, form):
+    filters = sorted((f['ft'], f['ff'], f['fo'], f['fv'], bool(f.get('fc'))) for f in get_filters(request))
+    key = json.dumps({
+        'q': ' '.join(remove_accent(form.cleaned_data['q']).split()),
+        'l': form.cleaned_data['l'],
+        'doc_lang': form.cleaned_data.get('doc_lang') or '',
+        'order_by': form.cleaned_data['order_by'],
+        'filters': filters
+    }, sort_keys=True)
+    key = md5(key.encode('utf-8')).hexdigest()
+    return 'search:%i:%s' % (Document.index_generation(), key)
+
+
+def get_results(request, form):
+    # Returns the results to display on a search page, the ranked document ids are cached by query
+    query = get_query(form)
+    has_query = query is not None or bool(get_filters(request))
+
+    def get_queryset():
+        _, results, _ = get_documents(request, form)
+        return results.select_related('favicon').defer(*RESULT_DEFERRED_FIELDS)
+
+    if not has_query or not settings.SOSSE_SEARCH_CACHE_TIMEOUT:
+        return has_query, get_queryset(), query
+
+    cache = caches['search']
+    key = search_cache_key(request, form)
+    cached = cache.get(key)
+    if cached is None:
+        logger.debug('search cache miss %s', key)
+        results = get_queryset()
+        cap = settings.SOSSE_RESULT_COUNT_CAP
+        if query:
+            ranks = list(results.values_list('id', 'rank')[:cap + 1])
         else:
-            cont = False
-        if cont:
-            continue
+            ranks = [(doc_id, None) for doc_id in results.values_list('id', flat=True)[:cap + 1]]
+
+        if len(ranks) <= cap:
+            count_info = (len(ranks), True)
+        else:
+            ranks = ranks[:cap]
+            count_info = count_results(results)
+        cached = {
+            'ranks': ranks,
+            'count_info': count_info
+        }
+        cache.set(key, cached)
+
+    rows = Document.objects.select_related('favicon').defer(*RESULT_DEFERRED_FIELDS)
+    return has_query, CachedResults(cached['ranks'], cached['count_info'], form.cleaned_data['order_by'], rows, get_queryset), query
+
+
+def rank_documents(query, candidates=0):
+    # Returns the documents matching the query annotated with their rank. When candidates is set, only this number
+    # of matching documents is ranked: documents matching the query in their title or url (weight A) come first, then
+    # other matching documents in no particular order
+    results = Document.objects.filter(vector=query)
+    if candidates:
+        matches = results.order_by()
+        title_vector = models.Func(models.F('vector'), models.Value('{a}'), function='ts_filter', output_field=SearchVectorField())
+        candidate_ids = matches.annotate(title_vector=title_vector).filter(title_vector=query)
+        candidate_ids = list(candidate_ids.values_list('id', flat=True)[:candidates])
+        if len(candidate_ids) < candidates:
+            others = matches.exclude(id__in=candidate_ids).values_list('id', flat=True)[:candidates - len(candidate_ids)]
+            candidate_ids += list(others)
+        results = Document.objects.filter(id__in=candidate_ids)
+
+    # the rank is cast to double precision so that it can be compared with cursor values without loss
+    rank = SearchRank(models.F('vector'), query)
+    all_results = results.annotate(rank=Cast(rank, models.FloatField()))
+    results = all_results.exclude(rank__lte=0.01)
+
+    if not results.exists():
+        results = all_results
+    return results
+
 
+def get_documents(request, form, stats_call=False):
+    results = Document.objects.all()
+    has_query = False
+
+    query = get_query(form)
+    if query:
+        has_query = True
+        results = rank_documents(query, settings.SOSSE_SEARCH_RANK_CANDIDATES)
+
+    if settings.SOSSE_EXCLUDE_NOT_INDEXED:
+        results = results.exclude(crawl_last__isnull=True)
+    if settings.SOSSE_EXCLUDE_REDIRECT:
+        results = results.filter(redirect_url__isnull=True)
+
+    for f in get_filters(request):
         has_query = True
         ftype = f['ft']
         field = f['ff']
@@ -84,10 +166,11 @@ def get_documents(request, form, stats_call=False):
         value = f['fv']
         case = f.get('fc', False) and True
 
+        # The lookups used can all be served by trigram indexes
         if operator == 'contain' and case:
             param = '__contains'
         elif operator == 'contain' and not case:
-            param = '__icontains'
+            param = '__ilike_contains'
         elif operator == 'regexp' and case:
             param = '__regex'
         elif operator == 'regexp' and not case:
@@ -95,7 +178,7 @@ def get_documents(request, form, stats_call=False):
         elif operator == 'equal' and case:
             param = '__exact'
         elif operator == 'equal' and not case:
-            param = '__iexact'
+            param = '__ilike'
         else:
             raise Exception('Unknown operation %s' % operator)
 
@@ -105,16 +188,16 @@ def get_documents(request, form, stats_call=False):
             url_param = {'url' + param: value}
             qf = models.Q(**content_param) | models.Q(**title_param) | models.Q(**url_param)
         elif field in ('lto_url', 'lto_txt', 'lby_url', 'lby_txt'):
+            # Links are filtered in subqueries, so that indexes on links and on the linked documents can be used
             field, rel_field = field.split('_')
-            subfield = 'doc_to' if field == 'lto' else 'doc_from'
-            field = 'links_to' if field == 'lto' else 'linked_from'
+            doc_field = 'doc_from' if field == 'lto' else 'doc_to'
+            rel_doc_field = 'doc_to' if field == 'lto' else 'doc_from'
+            links = Link.objects.filter(**{doc_field + '__isnull': False}).values(doc_field)
             if rel_field == 'url':
-                key1 = f'{field}__{subfield}__url{param}'
-                key2 = f'{field}__extern_url{param}'
-                qf = models.Q(**{key1: value}) | models.Q(**{key2: value})
+                qf = models.Q(id__in=links.filter(**{f'{rel_doc_field}__url{param}': value}))
+                qf |= models.Q(id__in=links.filter(**{f'extern_url{param}': value}))
             else:
-                key = f'{field}__text{param}'
-                qf = models.Q(**{key: value})
+                qf = models.Q(id__in=links.filter(**{f'text{param}': value}))
         else:
             qparams = {field + param: value}
             qf = models.Q(**qparams)
@@ -143,55 +226,162 @@ def get_documents(request, form, stats_call=False):
     return has_query, results, query
 
 
-def fallback_headline(doc):
-    lines = doc.content.splitlines()
-    if lines:
-        return lines[0]
-    return ''
+WORD_STATS_SQL = '''SELECT lexeme, count(*) AS ndoc FROM (%s) AS docs, unnest(docs.vector)
+    GROUP BY lexeme ORDER BY ndoc DESC, lexeme ASC LIMIT %%s'''
+
+# Words are weighted by their inverse document frequency among all documents
+WORD_STATS_IDF_SQL = '''SELECT lexeme, count(*) AS ndoc FROM (%s) AS docs, unnest(docs.vector)
+    LEFT JOIN se_wordstats ON se_wordstats.word = lexeme
+    GROUP BY lexeme, se_wordstats.ndoc
+    ORDER BY count(*) * ln(greatest((%%s + 1.0) / (coalesce(se_wordstats.ndoc, 0) + 1), 1)) DESC, ndoc DESC, lexeme ASC LIMIT %%s'''
+
+
+def get_word_stats(request, form, count=100):
+    # Returns the most frequent words of the documents matching a search as a list of (word, number of documents).
+    # Only the SOSSE_WORD_STATS_SAMPLE best ranked documents are analyzed, the counts are not extrapolated to all results
+    # since the best ranked documents are not representative of them
+    if settings.SOSSE_SEARCH_CACHE_TIMEOUT:
+        cache = caches['search']
+        key = search_cache_key(request, form) + ':words'
+        words = cache.get(key)
+        if words is not None:
+            return words
+
+    has_query, docs, query = get_documents(request, form, True)
+    if not has_query:
+        return []
+
+    docs = docs.order_by()
+    sample = settings.SOSSE_WORD_STATS_SAMPLE
+    if sample:
+        if query:
+            docs = docs.order_by('-rank')
+        docs = docs[:sample]
+
+    sql, params = docs.values('vector').query.sql_with_params()
+    params = list(params)
+    if settings.SOSSE_WORD_STATS_IDF and WordStats.objects.exists():
+        sql = WORD_STATS_IDF_SQL % sql
+        params.append(estimate_count(Document.objects.all()))
+    else:
+        sql = WORD_STATS_SQL % sql
+    params.append(count)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        words = cursor.fetchall()
+
+    if settings.SOSSE_SEARCH_CACHE_TIMEOUT:
+        cache.set(key, words)
+    return words
+
+
+def get_first_lines(doc_ids):
+    # Returns the first line of the content of each document in one query, used as headline when there is no text query
+    first_lines = Document.objects.filter(id__in=doc_ids).annotate(
+        first_line=models.Func(models.F('content'), models.Value('\n'), models.Value(1), function='split_part',
+                               output_field=models.TextField())
+    ).values_list('id', 'first_line')
+    return dict(first_lines)
+
+
+class Headline:
+    def __init__(self, headline, pos, offsets, content, first_line):
+        self.headline = headline
+        self.pos = pos - 1
+        self.offsets = offsets
+        self.content = content
+        self.first_line = first_line
+
+        # position of self.content in the document's content
+        self.content_pos = 0
+        if offsets == []:
+            self.content_pos = self.pos
+        elif offsets is None:
+            self.offsets = remove_accent_offsets(content)
+
+    def content_slice(self, start, end):
+        start = content_pos(self.offsets, start) - self.content_pos
+        end = content_pos(self.offsets, end) - self.content_pos
+        return self.content[start:end]
+
+    def build(self, start_sel, stop_sel):
+        # rebuild the headline using non-normalized content
+        src = self.headline
+        if self.pos == -1 or start_sel not in src or stop_sel not in src:
+            return self.first_line
+
+        headline_idx = self.pos
+        dest = escape('')
+        while src:
+            txt, src = src.split(start_sel, 1)
+            start = headline_idx
+            headline_idx += len(txt)
+            dest += escape(self.content_slice(start, headline_idx))
+
+            match, src = src.split(stop_sel, 1)
+            start = headline_idx
+            headline_idx += len(match)
+            dest += '<span class="res-highlight">'
+            dest += escape(self.content_slice(start, headline_idx))
+            dest += '</span>'
+
+            if start_sel not in src or stop_sel not in src:
+                break
+        return mark_safe(dest)
+
+
+def get_headlines(doc_ids, query, start_sel, stop_sel):
+    # Returns the headline of each document in one query, along with the inputs required to rebuild it from the
+    # non-normalized content. This avoids loading the whole content of each result:
+    # - the position of the headline in the normalized content,
+    # - the normalized offsets,
+    # - the part of the content matching the headline, or the whole content when the offsets are unknown or when
+    #   the normalized content is not aligned with the content,
+    # - the first line of the content, as a fallback.
+    if not doc_ids:
+        return {}
+
+    headlines = Document.objects.filter(id__in=doc_ids).annotate(
+        headline=SearchHeadline(
+            'normalized_content',
+            query,
+            start_sel=start_sel,
+            stop_sel=stop_sel,
+        )
+    ).values('id', 'content', 'normalized_content', 'normalized_offsets', 'headline')
+    sql, params = headlines.query.sql_with_params()
+
+    # OFFSET 0 prevents the subquery from being inlined, which would compute the headlines twice
+    with connection.cursor() as cursor:
+        cursor.execute(f'''SELECT id, headline, pos, normalized_offsets,
+                              CASE WHEN pos = 0 THEN ''
+                                   WHEN normalized_offsets = '{{}}' THEN substr(content, pos, length(plain))
+                                   ELSE content
+                              END,
+                              split_part(content, %s, 1)
+                          FROM (SELECT *, strpos(normalized_content, plain) AS pos
+                                FROM (SELECT *, replace(replace(headline, %s, ''), %s, '') AS plain
+                                      FROM ({sql} OFFSET 0) AS headlines
+                                ) AS plain_headlines
+                          ) AS positioned_headlines''', ['\n', start_sel, stop_sel] + list(params))
+        return {
+            row[0]: Headline(*row[1:])
+            for row in cursor.fetchall()
+        }
 
 
 def add_headlines(paginated, query):
+    doc_ids = [res.id for res in paginated]
+    if query:
+        rnd = uuid.uuid1().hex
+        headlines = get_headlines(doc_ids, query, 's' + rnd, 'e' + rnd)
+    elif doc_ids:
+        first_lines = get_first_lines(doc_ids)
+
     for res in paginated:
-        # rebuild the headline using non-normalized content
         if query:
-            rnd = uuid.uuid1().hex
-            pg_headline = Document.objects.filter(id=res.id).annotate(
-                headline=SearchHeadline(
-                    'normalized_content',
-                    query,
-                    start_sel='s' + rnd,
-                    stop_sel='e' + rnd,
-                )
-            ).first()
-
-            # find the location of the headline in the normalized content
-            headline = pg_headline.headline.replace('s' + rnd, '')
-            headline = headline.replace('e' + rnd, '')
-
-            if headline not in res.normalized_content or \
-                    's' + rnd not in pg_headline.headline or \
-                    'e' + rnd not in pg_headline.headline:
-                res.headline = fallback_headline(res)
-                continue
-
-            headline_idx = res.normalized_content.index(headline)
-            src = pg_headline.headline
-            dest = escape('')
-            while src:
-                txt, src = src.split('s' + rnd, 1)
-                dest += escape(res.content[headline_idx:headline_idx + len(txt)])
-                headline_idx += len(txt)
-
-                match, src = src.split('e' + rnd, 1)
-                dest += '<span class="res-highlight">'
-                dest += escape(res.content[headline_idx:headline_idx + len(match)])
-                headline_idx += len(match)
-                dest += '</span>'
-
-                if 's' + rnd not in src or 'e' + rnd not in src:
-                    dest += res.content[headline_idx:len(src)]
-                    break
-            res.headline = mark_safe(dest)
+            res.headline = headlines[res.id].build('s' + rnd, 'e' + rnd)
         else:
-            res.headline = fallback_headline(res)
+            res.headline = first_lines.get(res.id, '')
     return paginated
@@ -25,7 +25,7 @@ import pygal
 
 from .document import Document
 from .login import login_required
-from .models import CrawlerStats, DAILY, MINUTELY
+from .models import CrawlerStats, DAILY, LangStats, MINUTELY
 from .utils import get_unit, human_filesize
 from .views import get_context
 
@@ -146,6 +146,26 @@ def dir_size(d):
     return size
 
 
+def html_dir_size(d):
+    # Returns the size of the HTML snapshots, and the size saved by compression
+    size = 0
+    saved = 0
+    for dirpath, dirnames, filenames in os.walk(d):
+        for f in filenames:
+            fp = os.path.join(dirpath, f)
+            if os.path.islink(fp):
+                continue
+            file_size = os.path.getsize(fp)
+            size += file_size
+
+            if f.endswith('.gz') and file_size >= 4:
+                # The gzip trailer holds the uncompressed size (modulo 2^32)
+                with open(fp, 'rb') as fd:
+                    fd.seek(-4, os.SEEK_END)
+                    saved += int.from_bytes(fd.read(4), 'little') - file_size
+    return size, saved
+
+
 @login_required
 def stats(request):
     if not request.user.is_staff and not request.user.is_superuser:
@@ -169,7 +189,7 @@ def stats(request):
         db_size = cursor.fetchall()[0][0]
 
     doc_count = Document.objects.count()
-    indexed_langs = Document.objects.exclude(lang_iso_639_1__isnull=True).values('lang_iso_639_1').annotate(count=models.Count('lang_iso_639_1')).order_by('-count')
+    indexed_langs = LangStats.objects.filter(doc_count__gt=0).order_by('-doc_count')
 
     # Language chart
     lang_chart = None
@@ -177,17 +197,17 @@ def stats(request):
         lang_chart = pygal.Bar(pygal_config, style=pygal_style, disable_xml_declaration=True, range=(0, None))
         lang_chart.title = "Document's language"
 
-        factor, unit = get_unit(indexed_langs[0]['count'])
+        factor, unit = get_unit(indexed_langs[0].doc_count)
         if unit:
             lang_chart.title += ' (%s)' % unit
 
         for lang in indexed_langs[:8]:
-            lang_iso = lang['lang_iso_639_1']
+            lang_iso = lang.lang_iso_639_1
             lang_desc = settings.SOSSE_LANGDETECT_TO_POSTGRES.get(lang_iso, {})
             title = lang_iso.title()
             if lang_desc.get('flag'):
                 title = title + ' ' + lang_desc['flag']
-            percent = lang['count'] / factor
+            percent = lang.doc_count / factor
             lang_chart.add(title, percent)
         lang_chart = lang_chart.render()
 
@@ -198,7 +218,7 @@ def stats(request):
     factor, unit = get_unit(hdd_size)
 
     screenshot_size = dir_size(settings.SOSSE_SCREENSHOTS_DIR)
-    html_size = dir_size(settings.SOSSE_HTML_SNAPSHOT_DIR)
+    html_size, html_saved = html_dir_size(settings.SOSSE_HTML_SNAPSHOT_DIR)
     hdd_other = hdd_size - hdd_free - db_size - screenshot_size - html_size
 
     hdd_pie = pygal.Pie(pygal_config, style=pygal_style, disable_xml_declaration=True)
@@ -222,6 +242,7 @@ def stats(request):
         'lang_parsable': [lang.title() for lang in sorted(Document.get_supported_langs())],
         'lang_chart': lang_chart,
         'hdd_pie': hdd_pie.render(),
+        'html_saved': html_saved and human_filesize(html_saved),
     })
 
     context.update(crawler_stats(pygal_config, pygal_style, MINUTELY))
@@ -0,0 +1,84 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from .atom import atom
+from .document import Document
+
+
+class AtomTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='atom_user')
+        self.factory = RequestFactory()
+        self.now = timezone.now().replace(microsecond=0)
+        for n in range(3):
+            Document.objects.create(url=f'http://127.0.0.1/{n}',
+                                    normalized_url=f'http://127.0.0.1/{n}',
+                                    title=f'Page {n}',
+                                    normalized_title=f'Page {n}',
+                                    content='\n'.join([f'Line {line} of {n}' for line in range(7)]),
+                                    normalized_content='\n'.join([f'Line {line} of {n}' for line in range(7)]),
+                                    crawl_first=self.now + timedelta(seconds=n),
+                                    crawl_last=self.now + timedelta(seconds=n))
+
+    def _atom(self, params, **headers):
+        request = self.factory.get('/atom/?' + params, **headers)
+        request.META['REQUEST_SCHEME'] = 'http'
+        request.META['HTTP_HOST'] = '127.0.0.1'
+        request.user = self.user
+        return atom(request)
+
+    def _content(self, response):
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_10_feed(self):
+        content = self._content(self._atom('q=line'))
+        self.assertTrue(content.startswith('<feed xmlns="http://www.w3.org/2005/Atom">\n<title>SOSSE · line</title>\n'), content)
+        self.assertTrue(content.endswith('</feed>\n'), content)
+        self.assertIn(f'<updated>{(self.now + timedelta(seconds=2)).isoformat()}</updated>', content)
+        self.assertLess(content.index('Page 2'), content.index('Page 1'))
+        self.assertLess(content.index('Page 1'), content.index('Page 0'))
+        self.assertIn('<summary>Line 0 of 2\nLine 1 of 2\nLine 2 of 2\nLine 3 of 2\nLine 4 of 2</summary>', content)
+        self.assertNotIn('rel="next"', content)
+
+    @override_settings(SOSSE_ATOM_FEED_SIZE=2)
+    def test_20_next(self):
+        content = self._content(self._atom('q=line'))
+        self.assertIn('Page 1', content)
+        self.assertNotIn('Page 0', content)
+        self.assertIn('rel="next"', content)
+
+    def test_30_not_modified(self):
+        response = self._atom('q=line')
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # the rank threshold check and the ordering values, documents are not read
+        with self.assertNumQueries(2):
+            response = self._atom('q=line', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self._atom('q=line', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        Document.objects.filter(url='http://127.0.0.1/0').update(crawl_first=self.now + timedelta(seconds=10))
+        response = self._atom('q=line', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
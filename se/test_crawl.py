@@ -13,15 +13,17 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from base64 import b64decode
 from datetime import datetime, timedelta, timezone
 from unittest import mock
 
 from django.test import TestCase, override_settings
+import requests
 
 from .browser import AuthElemFailed, Page, SkipIndexing
 from .document import Document
-from .models import DomainSetting, Link, CrawlPolicy
-from .test_mock import BrowserMock
+from .models import DomainSetting, FavIcon, Link, CrawlPolicy
+from .test_mock import BrowserMock, PNG64
 
 
 class CrawlerTest(TestCase):
@@ -55,7 +57,8 @@ class CrawlerTest(TestCase):
 
     def _crawl(self, url='http://127.0.0.1/'):
         Document.queue(url, None, None)
-        while Document.crawl(0):
+        # Favicons are downloaded along the crawl by the favicon worker
+        while FavIcon.fetch_queued() or Document.crawl(0):
             pass
 
     @mock.patch('se.browser.RequestBrowser.get')
@@ -386,6 +389,7 @@ class CrawlerTest(TestCase):
         self.assertEqual(link.doc_from, doc)
         self.assertIsNone(link.doc_to)
         self.assertEqual(link.extern_url, 'http://127.0.0.1/extern.html')
+        self.assertEqual(bytes(link.extern_url_hash), Document.url_hash_digest('http://127.0.0.1/extern.html'))
 
         self.crawl_policy.url_regex = 'http://127.0.0.1/.*$'
         self.crawl_policy.save()
@@ -405,6 +409,7 @@ class CrawlerTest(TestCase):
         self.assertEqual(link.doc_from, doc1)
         self.assertEqual(link.doc_to, doc2)
         self.assertIsNone(link.extern_url)
+        self.assertIsNone(link.extern_url_hash)
 
     @mock.patch('se.browser.RequestBrowser.get')
     def test_050_binary_indexing(self, RequestBrowser):
@@ -477,3 +482,83 @@ class CrawlerTest(TestCase):
         self.assertEqual(link.doc_from, doc)
         self.assertEqual(link.text, 'link')
         self.assertEqual(link.extern_url, 'http://[invalid IPV6/')
+
+    @mock.patch('se.browser.RequestBrowser.get')
+    def test_110_favicon_queue(self, RequestBrowser):
+        RequestBrowser.side_effect = BrowserMock({'http://127.0.0.1/': b'Hello world'})
+        with mock.patch('se.models.now') as now:
+            now.side_effect = lambda: self.fake_now
+            self._crawl()
+
+            doc = Document.objects.get()
+            favicon = FavIcon.objects.get()
+            self.assertEqual(doc.favicon, favicon)
+            self.assertTrue(favicon.missing)
+            self.assertEqual(favicon.fetch_retries, 1)
+            self.assertEqual(favicon.fetch_next, self.fake_now + timedelta(hours=1))
+            self.assertFalse(FavIcon.fetch_queued())
+
+            # the delay doubles after each failure
+            now.side_effect = lambda: self.fake_next
+            self.assertTrue(FavIcon.fetch_queued())
+            favicon.refresh_from_db()
+            self.assertEqual(favicon.fetch_retries, 2)
+            self.assertEqual(favicon.fetch_next, self.fake_next + timedelta(hours=2))
+
+            FavIcon.objects.update(fetch_retries=4, fetch_next=self.fake_next)
+            self.assertTrue(FavIcon.fetch_queued())
+            favicon.refresh_from_db()
+            self.assertEqual(favicon.fetch_retries, 5)
+            self.assertIsNone(favicon.fetch_next)
+
+            FavIcon.objects.update(fetch_next=self.fake_next)
+            RequestBrowser.side_effect = BrowserMock({'http://127.0.0.1/favicon.ico': b64decode(PNG64)})
+            with mock.patch('se.models.FavIcon.export'):
+                self.assertTrue(FavIcon.fetch_queued())
+            favicon.refresh_from_db()
+            self.assertFalse(favicon.missing)
+            self.assertEqual(favicon.mimetype, 'image/png')
+            self.assertIsNone(favicon.fetch_next)
+
+    @mock.patch('se.browser.RequestBrowser.get')
+    def test_111_favicon_unreachable_host(self, RequestBrowser):
+        RequestBrowser.side_effect = BrowserMock({
+            'http://127.0.0.1/': b'Hello world',
+            'http://127.0.0.1/favicon.ico': requests.ConnectionError(),
+        })
+        with mock.patch('se.models.now') as now:
+            now.side_effect = lambda: self.fake_now
+            Document.queue('http://127.0.0.1/', None, None)
+            while Document.crawl(0):
+                pass
+
+            # favicons are not downloaded by crawlers
+            self.assertNotIn(mock.call('http://127.0.0.1/favicon.ico', check_status=True), RequestBrowser.call_args_list)
+            other = FavIcon.objects.create(url='http://127.0.0.1/other.ico', fetch_next=self.fake_now)
+            unrelated = FavIcon.objects.create(url='http://127.0.0.2/favicon.ico', fetch_next=self.fake_now)
+
+            self.assertTrue(FavIcon.fetch_queued())
+            self.assertEqual(FavIcon.objects.get(url='http://127.0.0.1/favicon.ico').fetch_next, self.fake_now + timedelta(hours=1))
+            other.refresh_from_db()
+            self.assertEqual(other.fetch_next, self.fake_now + timedelta(hours=1))
+            unrelated.refresh_from_db()
+            self.assertEqual(unrelated.fetch_next, self.fake_now)
+
+    @mock.patch('se.browser.RequestBrowser.get')
+    def test_112_index_generation_batch(self, RequestBrowser):
+        RequestBrowser.side_effect = BrowserMock({
+            'http://127.0.0.1/': b'Root <a href="/page1/">Link1</a> <a href="/page2/">Link2</a>',
+            'http://127.0.0.1/page1/': b'Page1',
+            'http://127.0.0.1/page2/': b'Page2',
+        })
+        Document.flush_index_generation()
+        generation = Document.index_generation()
+        self._crawl()
+        self.assertEqual(Document.objects.count(), 3)
+        self.assertEqual(Document.index_generation(), generation)
+
+        # the generation advances once for the whole batch
+        self.assertTrue(Document.flush_index_generation())
+        self.assertEqual(Document.index_generation(), generation + 1)
+        self.assertFalse(Document.flush_index_generation())
+        self.assertEqual(Document.index_generation(), generation + 1)
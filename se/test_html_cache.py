@@ -21,14 +21,17 @@ from django.test import TestCase
 from django.utils import timezone
 
 from .browser import Page
-from .html_asset import HTMLAsset
-from .html_cache import CacheHit, CacheMiss, HTMLCache
+from .html_asset import HTMLAsset, HTMLCacheIndex
+from .html_cache import CacheHit, CacheMiss, HTMLCache, worker_cache
 from .test_mock import BrowserMock
 from .url import sanitize_url
 from .utils import http_date_format
 
 
 class HTMLCacheTest(TestCase):
+    def setUp(self):
+        worker_cache.clear()
+
     def test_010_html_filenames(self):
         for url, fn in (
             ('http://127.0.0.1/test.html', 'http,3A/127.0.0.1/test.html_~~~.html'),
@@ -366,3 +369,38 @@ class HTMLCacheTest(TestCase):
             mock.call(asset, settings.SOSSE_MAX_HTML_ASSET_SIZE)
         ], _max_age_check.call_args_list)
         self.assertTrue(_heuristic_check.call_args_list == [], _heuristic_check.call_args_list)
+
+    @mock.patch('se.browser.RequestBrowser.get')
+    @mock.patch('se.html_cache.HTMLCache._heuristic_check', wraps=HTMLCache._heuristic_check)
+    @mock.patch('se.html_cache.HTMLCache._max_age_check', wraps=HTMLCache._max_age_check)
+    def test_110_worker_cache(self, _max_age_check, _heuristic_check, RequestBrowser):
+        now = timezone.now()
+        now = now.replace(microsecond=0)
+        RequestBrowser.side_effect = BrowserMock({
+            'http://127.0.0.1/to_cache.png': (b'PNG', {
+                'Date': http_date_format(now),
+                'Cache-Control': 'max-age=60',
+                'Age': '1',
+            })
+        })
+
+        asset = self._download_miss(RequestBrowser)
+        self.assertEqual(HTMLCacheIndex.objects.count(), 1)
+        self.assertEqual(HTMLCacheIndex.get_asset('http://127.0.0.1/to_cache.png'), asset)
+        self.assertIsNone(HTMLCacheIndex.get_asset('http://127.0.0.1/other.png'))
+
+        _asset = self._download_hit(RequestBrowser)
+        self.assertEqual(asset, _asset)
+        self.assertEqual(len(_max_age_check.call_args_list), 1)
+
+        # Only the reference is taken in the database
+        with self.assertNumQueries(1):
+            _asset = self._download_hit(RequestBrowser)
+        self.assertEqual(asset, _asset)
+        self.assertEqual(len(_max_age_check.call_args_list), 1)
+        self.assertEqual(asset.ref_count(), 3)
+
+        # Expired entries are checked again
+        worker_cache['http://127.0.0.1/to_cache.png'] = (asset, now)
+        _asset = self._download_hit(RequestBrowser)
+        self.assertEqual(len(_max_age_check.call_args_list), 2)
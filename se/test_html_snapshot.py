@@ -13,18 +13,25 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import gzip
+import os
+
+from io import StringIO
+from tempfile import TemporaryDirectory
 from unittest import mock
 
 import cssutils
 from django.conf import settings
+from django.core.management import call_command
 from django.shortcuts import reverse
+from django.urls import resolve
 from django.test import TestCase, override_settings
 from django.utils.html import format_html
 from requests import HTTPError
 
 from .browser import Page
 from .document import Document
-from .html_asset import HTMLAsset
+from .html_asset import HTMLAsset, HTMLAssetFile, HTMLPack, html_asset_file_exists
 from .html_cache import HTML_SNAPSHOT_HASH_LEN, max_filename_size
 from .html_snapshot import css_parser, HTMLSnapshot
 from .models import CrawlPolicy, DomainSetting
@@ -670,27 +677,26 @@ class HTMLSnapshotTest:
         asset_png = assets.first()
         self.assertEqual(asset_png.url, 'http://127.0.0.1/image.png')
         self.assertEqual(asset_png.filename, 'http,3A/127.0.0.1/image.png_62d75f74b8.png')
-        self.assertEqual(asset_png.ref_count, 1)
+        self.assertEqual(asset_png.ref_count(), 1)
         asset_html1 = assets.last()
         self.assertEqual(asset_html1.url, 'http://127.0.0.1/page1.html')
         self.assertEqual(asset_html1.filename, 'http,3A/127.0.0.1/page1.html_81faf90c0b.html')
-        self.assertEqual(asset_html1.ref_count, 1)
+        self.assertEqual(asset_html1.ref_count(), 1)
 
         self._snapshot_page('page2.html')
         assets = HTMLAsset.objects.order_by('download_date')
         self.assertEqual(len(assets), 3)
         self.assertEqual(assets[0], asset_html1)
-        asset_html1.refresh_from_db()
-        self.assertEqual(asset_html1.ref_count, 1)
+        self.assertEqual(asset_html1.ref_count(), 1)
 
         self.assertEqual(assets[1], asset_png)
-        asset_png.refresh_from_db()
-        self.assertEqual(asset_png.ref_count, 2)
+        self.assertEqual(asset_png.ref_count(), 2)
 
         asset_html2 = assets.last()
         self.assertEqual(asset_html2.url, 'http://127.0.0.1/page2.html')
         self.assertEqual(asset_html2.filename, 'http,3A/127.0.0.1/page2.html_81faf90c0b.html')
-        self.assertEqual(asset_html2.ref_count, 1)
+        self.assertEqual(asset_html2.ref_count(), 1)
+        self.assertEqual(HTMLAssetFile.objects.count(), 3)
 
     @mock.patch('se.browser.RequestBrowser.get')
     @mock.patch('os.makedirs')
@@ -720,7 +726,9 @@ class HTMLSnapshotTest:
                                  mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'http,3A/127.0.0.1/page%i.html_3acae9ed94.html' % no, 'wb'))
 
         self.assertEqual(HTMLAsset.objects.count(), 3)
-        self.assertEqual(HTMLAsset.objects.get(url='http://127.0.0.1/image.png').ref_count, 2)
+        self.assertEqual(HTMLAsset.objects.get(url='http://127.0.0.1/image.png').ref_count(), 2)
+        self.assertEqual(HTMLAssetFile.objects.get(filename='http,3A/127.0.0.1/page1.html_3acae9ed94.html').assets, [PNG_URL])
+        self.assertEqual(HTMLAssetFile.objects.get(filename=PNG_URL).assets, None)
 
         png_url_bytes = (settings.SOSSE_HTML_SNAPSHOT_URL + PNG_URL).encode('utf-8')
         mock_open = mock.mock_open(read_data=HTML % png_url_bytes)
@@ -728,8 +736,17 @@ class HTMLSnapshotTest:
             obj = Document.objects.first()
             obj.delete_html()
             obj.delete()
+
+            # The manifest is used, the snapshot is not parsed
+            self.assertEqual(mock_open.mock_calls, [])
+
+            # Files are only deleted by the garbage collector
+            self.assertEqual(HTMLAsset.objects.count(), 3)
+            self.assertTrue(unlink.call_args_list == [], unlink.call_args_list)
+            self.assertEqual(HTMLAssetFile.gc(), 1)
+
             self.assertEqual(HTMLAsset.objects.count(), 2)
-            self.assertEqual(HTMLAsset.objects.get(url='http://127.0.0.1/image.png').ref_count, 1)
+            self.assertEqual(HTMLAsset.objects.get(url='http://127.0.0.1/image.png').ref_count(), 1)
             self.assertTrue(unlink.call_args_list == [
                 mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'http,3A/127.0.0.1/page1.html_3acae9ed94.html')
             ], unlink.call_args_list)
@@ -738,7 +755,9 @@ class HTMLSnapshotTest:
             obj = Document.objects.first()
             obj.delete_html()
             obj.delete()
+            self.assertEqual(HTMLAssetFile.gc(), 2)
             self.assertEqual(HTMLAsset.objects.count(), 0)
+            self.assertEqual(HTMLAssetFile.objects.count(), 0)
             self.assertTrue(unlink.call_args_list == [
                 mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'http,3A/127.0.0.1/image.png_62d75f74b8.png'),
                 mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'http,3A/127.0.0.1/page2.html_3acae9ed94.html'),
@@ -748,77 +767,93 @@ class HTMLSnapshotTest:
     def test_230_asset_duplicate_fn(self, remove_html_asset_file):
         self.assertEqual(HTMLAsset.objects.count(), 0)
         asset1 = HTMLAsset.objects.create(url='url1', filename='filename')
-        asset1.init_ref_count()
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 0)
-        asset1.increment_ref()
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 1)
+        self.assertEqual(asset1.ref_count(), 0)
+        HTMLAssetFile.add_refs([asset1.filename])
+        self.assertEqual(asset1.ref_count(), 1)
 
         asset2 = HTMLAsset.objects.create(url='url2', filename='filename')
-        self.assertEqual(asset2.ref_count, 0)
-        asset2.init_ref_count()
-        asset2.refresh_from_db()
-        self.assertEqual(asset2.ref_count, 1)
-        asset2.increment_ref()
-        asset2.refresh_from_db()
+        self.assertEqual(asset2.ref_count(), 1)
+        self.assertTrue(asset2.increment_ref())
 
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 2)
-        self.assertEqual(asset2.ref_count, 2)
+        self.assertEqual(asset1.ref_count(), 2)
+        self.assertEqual(asset2.ref_count(), 2)
+        self.assertEqual(HTMLAssetFile.objects.count(), 1)
 
-        self.assertTrue(remove_html_asset_file.call_args_list == [], remove_html_asset_file.call_args_list)
-
-        HTMLAsset.remove_file_ref('filename')
+        self.assertEqual(HTMLAssetFile.remove_refs(['filename']), 1)
+        self.assertEqual(HTMLAssetFile.gc(), 0)
         self.assertEqual(HTMLAsset.objects.count(), 2)
-        self.assertEqual(list(HTMLAsset.objects.values_list('ref_count', flat=True)), [1, 1])
+        self.assertEqual(asset1.ref_count(), 1)
         self.assertTrue(remove_html_asset_file.call_args_list == [], remove_html_asset_file.call_args_list)
 
-        HTMLAsset.remove_file_ref('filename')
+        self.assertEqual(HTMLAssetFile.remove_refs(['filename']), 1)
+        self.assertEqual(HTMLAssetFile.remove_refs(['filename']), 0)
+        self.assertTrue(remove_html_asset_file.call_args_list == [], remove_html_asset_file.call_args_list)
+        self.assertEqual(HTMLAssetFile.gc(), 1)
         self.assertEqual(HTMLAsset.objects.count(), 0)
+        self.assertEqual(HTMLAssetFile.objects.count(), 0)
         self.assertTrue(remove_html_asset_file.call_args_list == [
             mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'filename')
         ], remove_html_asset_file.call_args_list)
 
+        # The file was garbage collected
+        self.assertFalse(asset1.increment_ref())
+
     @mock.patch('se.html_asset.remove_html_asset_file')
     def test_240_asset_duplicate_url(self, remove_html_asset_file):
         self.assertEqual(HTMLAsset.objects.count(), 0)
         asset1 = HTMLAsset.objects.create(url='url', filename='filename1')
-        asset1.init_ref_count()
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 0)
-        asset1.increment_ref()
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 1)
-
         asset2 = HTMLAsset.objects.create(url='url', filename='filename2')
-        self.assertEqual(asset2.ref_count, 0)
-        asset2.init_ref_count()
-        asset2.refresh_from_db()
-        self.assertEqual(asset2.ref_count, 0)
-        asset2.increment_ref()
-        asset2.refresh_from_db()
-
-        asset1.refresh_from_db()
-        self.assertEqual(asset1.ref_count, 1)
-        self.assertEqual(asset2.ref_count, 1)
-
-        self.assertTrue(remove_html_asset_file.call_args_list == [], remove_html_asset_file.call_args_list)
+        HTMLAssetFile.add_refs([asset1.filename, asset2.filename])
+        self.assertEqual(asset1.ref_count(), 1)
+        self.assertEqual(asset2.ref_count(), 1)
 
-        HTMLAsset.remove_file_ref('filename1')
+        HTMLAssetFile.remove_refs(['filename1'])
+        self.assertEqual(HTMLAssetFile.gc(), 1)
         self.assertEqual(HTMLAsset.objects.count(), 1)
-        self.assertEqual(list(HTMLAsset.objects.values_list('ref_count', flat=True)), [1])
+        self.assertEqual(asset2.ref_count(), 1)
         self.assertTrue(remove_html_asset_file.call_args_list == [
             mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'filename1')
         ], remove_html_asset_file.call_args_list)
         remove_html_asset_file.reset_mock()
 
-        HTMLAsset.remove_file_ref('filename2')
+        HTMLAssetFile.remove_refs(['filename2'])
+        self.assertEqual(HTMLAssetFile.gc(), 1)
         self.assertEqual(HTMLAsset.objects.count(), 0)
         self.assertTrue(remove_html_asset_file.call_args_list == [
             mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'filename2')
         ], remove_html_asset_file.call_args_list)
 
+    @mock.patch('se.html_asset.remove_html_asset_file')
+    def test_245_asset_manifest(self, remove_html_asset_file):
+        HTML = b'<html><body><img src="%s"/></body></html>' % (settings.SOSSE_HTML_SNAPSHOT_URL + 'image.png').encode('utf-8')
+        page1 = HTMLAsset.objects.create(url='url1', filename='page1.html')
+        page2 = HTMLAsset.objects.create(url='url2', filename='page2.html')
+        HTMLAsset.objects.create(url='url3', filename='image.png')
+        HTMLAssetFile.add_refs(['page1.html', 'page2.html', 'image.png'])
+        HTMLAssetFile.add_refs(['image.png'])
+
+        # Snapshots without manifest are parsed on deletion
+        mock_open = mock.mock_open(read_data=HTML)
+        with mock.patch('se.html_asset.open', mock_open):
+            page1.html_delete()
+        self.assertEqual(mock_open.call_args_list, [mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'page1.html', 'rb')])
+        self.assertEqual(HTMLAssetFile.objects.get(filename='image.png').ref_count, 1)
+
+        # The management command stores the manifest
+        mock_open = mock.mock_open(read_data=HTML)
+        with mock.patch('se.html_asset.open', mock_open):
+            call_command('update_html_manifests', stdout=StringIO())
+        self.assertEqual(HTMLAssetFile.objects.get(filename='page2.html').assets, ['image.png'])
+        self.assertEqual(HTMLAssetFile.objects.get(filename='image.png').assets, None)
+
+        mock_open = mock.mock_open()
+        with mock.patch('se.html_asset.open', mock_open):
+            page2.html_delete()
+            page2.html_delete()
+        self.assertEqual(mock_open.call_args_list, [])
+        self.assertEqual(HTMLAssetFile.objects.get(filename='image.png').ref_count, 0)
+        self.assertEqual(HTMLAssetFile.gc(), 3)
+
     @override_settings(TEST_HTML_ERROR_HANDLING=True)
     @mock.patch('se.browser.RequestBrowser.get')
     @mock.patch('os.makedirs')
@@ -842,6 +877,8 @@ class HTMLSnapshotTest:
             mock.call('http://127.0.0.1/image.png', check_status=True, max_file_size=settings.SOSSE_MAX_HTML_ASSET_SIZE, headers={'Accept': '*/*'}),
         ], RequestBrowser.call_args_list)
 
+        self.assertTrue(unlink.call_args_list == [], unlink.call_args_list)
+        self.assertEqual(HTMLAssetFile.gc(), 1)
         self.assertTrue(unlink.call_args_list == [
             mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + 'http,3A/127.0.0.1/image.png_62d75f74b8.png'),
         ], unlink.call_args_list)
@@ -856,7 +893,7 @@ class HTMLSnapshotTest:
         asset = HTMLAsset.objects.first()
         self.assertEqual(asset.url, 'http://127.0.0.1/')
         self.assertRegex(asset.filename, r'http,3A/127\.0\.0\.1/_[^.]+\.html')
-        self.assertEqual(asset.ref_count, 1)
+        self.assertEqual(asset.ref_count(), 1)
 
     @mock.patch('se.browser.RequestBrowser.get')
     @mock.patch('os.makedirs')
@@ -902,6 +939,135 @@ class HTMLSnapshotTest:
         self.assertEqual(HTMLAsset.html_extract_assets(OUTPUT),
                          set(('http,3A/127.0.0.1/style.css_72f0eee2c7.css', 'http,3A/127.0.0.1/image.png_62d75f74b8.png')))
 
+    @mock.patch('se.browser.RequestBrowser.get')
+    def test_270_compression(self, RequestBrowser):
+        RequestBrowser.side_effect = BrowserMock({})
+        HTML = b'''<html><head>
+            <link rel="stylesheet" href="/style.css"/>
+        </head><body>
+            <img src="/image.png"/>
+        </body></html>'''
+        CSS = 'http,3A/127.0.0.1/style.css_72f0eee2c7.css'
+        PNG = 'http,3A/127.0.0.1/image.png_62d75f74b8.png'
+
+        with TemporaryDirectory() as snapshot_dir:
+            snapshot_dir += '/'
+            with override_settings(SOSSE_HTML_SNAPSHOT_DIR=snapshot_dir, SOSSE_HTML_SNAPSHOT_COMPRESS=True):
+                page = Page('http://127.0.0.1/page.html', HTML, None)
+                HTMLSnapshot(page, self.policy).snapshot()
+                html = HTMLAsset.objects.get(url='http://127.0.0.1/page.html')
+
+                self.assertFalse(os.path.exists(snapshot_dir + html.filename))
+                self.assertTrue(os.path.exists(snapshot_dir + html.filename + '.gz'))
+                self.assertFalse(os.path.exists(snapshot_dir + CSS))
+                self.assertTrue(os.path.exists(snapshot_dir + CSS + '.gz'))
+                self.assertTrue(os.path.exists(snapshot_dir + PNG))
+                self.assertEqual(html.extract_file_assets(), set((CSS, PNG)))
+
+                html.html_delete()
+                self.assertEqual(HTMLAssetFile.gc(), 3)
+                self.assertEqual(os.listdir(snapshot_dir), [])
+
+            # Snapshots stored uncompressed
+            with override_settings(SOSSE_HTML_SNAPSHOT_DIR=snapshot_dir):
+                page = Page('http://127.0.0.1/page.html', HTML, None)
+                HTMLSnapshot(page, self.policy).snapshot()
+                self.assertTrue(os.path.exists(snapshot_dir + html.filename))
+
+                call_command('compress_html_snapshots', stdout=StringIO())
+                self.assertFalse(os.path.exists(snapshot_dir + html.filename))
+                self.assertTrue(os.path.exists(snapshot_dir + html.filename + '.gz'))
+                self.assertFalse(os.path.exists(snapshot_dir + CSS))
+                self.assertTrue(os.path.exists(snapshot_dir + PNG))
+                self.assertEqual(HTMLAsset(filename=html.filename).extract_file_assets(), set((CSS, PNG)))
+
+    @mock.patch('se.browser.RequestBrowser.get')
+    def test_280_packs(self, RequestBrowser):
+        RequestBrowser.side_effect = BrowserMock({})
+        HTML = b'''<html><head>
+            <link rel="stylesheet" href="/style.css"/>
+        </head><body>
+            <img src="/image.png"/>
+        </body></html>'''
+        CSS = 'http,3A/127.0.0.1/style.css_72f0eee2c7.css'
+
+        with TemporaryDirectory() as snapshot_dir:
+            snapshot_dir += '/'
+            with override_settings(SOSSE_HTML_SNAPSHOT_DIR=snapshot_dir, SOSSE_HTML_SNAPSHOT_PACK_SIZE=1):
+                for no in (1, 2):
+                    page = Page('http://127.0.0.1/page%i.html' % no, HTML, None)
+                    HTMLSnapshot(page, self.policy).snapshot()
+
+                self.assertEqual(os.listdir(snapshot_dir), ['packs'])
+                self.assertEqual(HTMLPack.objects.count(), 1)
+                pack = HTMLPack.objects.get()
+                self.assertFalse(pack.sealed)
+                self.assertEqual(pack.size, os.path.getsize(pack.path()))
+                self.assertEqual(HTMLAssetFile.objects.filter(pack=pack).count(), 4)
+
+                html = HTMLAsset.objects.get(url='http://127.0.0.1/page1.html')
+                self.assertTrue(html_asset_file_exists(snapshot_dir + html.filename))
+                self.assertEqual(html.extract_file_assets(), set((CSS, 'http,3A/127.0.0.1/image.png_62d75f74b8.png')))
+
+                response = self.client.get(settings.SOSSE_HTML_SNAPSHOT_URL + CSS)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'text/css')
+                self.assertEqual(response.content, HTMLAssetFile.read_packed(CSS))
+                response = self.client.get(settings.SOSSE_HTML_SNAPSHOT_URL + 'http,3A/127.0.0.1/unknown.css')
+                self.assertEqual(response.status_code, 404)
+
+                html.html_delete()
+                length = HTMLAssetFile.objects.get(filename=html.filename).length
+                self.assertEqual(HTMLAssetFile.gc(), 1)
+                pack.refresh_from_db()
+                self.assertEqual(pack.dead_bytes, length)
+
+                # Only sealed packs are compacted
+                call_command('compact_html_packs', '--ratio', '0', stdout=StringIO())
+                self.assertEqual(HTMLPack.objects.count(), 1)
+
+                HTMLPack.objects.update(sealed=True)
+                call_command('compact_html_packs', '--ratio', '0', stdout=StringIO())
+                self.assertFalse(HTMLPack.objects.filter(id=pack.id).exists())
+                self.assertFalse(os.path.exists(pack.path()))
+                new_pack = HTMLPack.objects.get()
+                self.assertEqual(new_pack.size, pack.size - length)
+                self.assertEqual(HTMLAssetFile.objects.filter(pack=new_pack).count(), 3)
+
+                html = HTMLAsset.objects.get(url='http://127.0.0.1/page2.html')
+                self.assertEqual(html.extract_file_assets(), set((CSS, 'http,3A/127.0.0.1/image.png_62d75f74b8.png')))
+
+    def test_290_pack_view(self):
+        # Snapshot paths may contain the path of other views
+        for path in ('http,3A/127.0.0.1/html/page.html_0123456789.html', 'http,3A/127.0.0.1/cache/a.css_0123456789.css',
+                     'http,3A/127.0.0.1/favicon/12.png_0123456789.png'):
+            self.assertEqual(resolve(settings.SOSSE_HTML_SNAPSHOT_URL + path).url_name, 'html_pack')
+
+        with TemporaryDirectory() as snapshot_dir:
+            snapshot_dir += '/'
+            os.makedirs(snapshot_dir + 'http,3A/127.0.0.1/')
+            os.makedirs(snapshot_dir + 'packs/')
+            with open(snapshot_dir + 'http,3A/127.0.0.1/page.html_0123456789.html', 'wb') as f:
+                f.write(b'<html>disk</html>')
+            with gzip.open(snapshot_dir + 'http,3A/127.0.0.1/style.css_0123456789.css.gz', 'wb') as f:
+                f.write(b'body {}')
+            with open(snapshot_dir + 'packs/00000001.pack', 'wb') as f:
+                f.write(b'pack')
+
+            with override_settings(SOSSE_HTML_SNAPSHOT_DIR=snapshot_dir, SOSSE_HTML_SNAPSHOT_PACK_SIZE=1):
+                response = self.client.get(settings.SOSSE_HTML_SNAPSHOT_URL + 'http,3A/127.0.0.1/page.html_0123456789.html')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Type'], 'text/html')
+                self.assertEqual(response.content, b'<html>disk</html>')
+
+                response = self.client.get(settings.SOSSE_HTML_SNAPSHOT_URL + 'http,3A/127.0.0.1/style.css_0123456789.css')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.content, b'body {}')
+
+                for path in ('packs/00000001.pack', 'http,3A/../packs/00000001.pack', 'http,3A/127.0.0.1/'):
+                    response = self.client.get(settings.SOSSE_HTML_SNAPSHOT_URL + path)
+                    self.assertEqual(response.status_code, 404, path)
+
 
 class HTMLSnapshotCSSUtilsParser(HTMLSnapshotTest, TestCase):
     @classmethod
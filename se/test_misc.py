@@ -13,9 +13,16 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from django.test import TestCase, override_settings
+import os
+from io import StringIO
+from tempfile import TemporaryDirectory
 
-from se.models import DomainSetting
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import RequestFactory, TestCase, override_settings
+
+from se.admin import DocumentAdmin
+from se.models import CrawlPolicy, DomainSetting, FavIcon, LangStats
 from .document import Document
 
 
@@ -52,3 +59,105 @@ class MiscTest(TestCase):
     def test_external_link_no_opt(self):
         doc = Document(url='http://test/')
         self.assertEqual(doc.get_source_link(), '<a href="http://test/">🌍 Source page</a>')
+
+    def test_lang_stats(self):
+        Document.objects.create(url='http://127.0.0.1/1', lang_iso_639_1='en')
+        Document.objects.create(url='http://127.0.0.1/2', lang_iso_639_1='en')
+        Document.objects.create(url='http://127.0.0.1/3', lang_iso_639_1='fr')
+        doc = Document.objects.create(url='http://127.0.0.1/4')
+        self.assertEqual(list(LangStats.objects.order_by('lang_iso_639_1').values_list('lang_iso_639_1', 'doc_count')),
+                         [('en', 2), ('fr', 1)])
+
+        doc.lang_iso_639_1 = 'fr'
+        doc.save()
+        doc.save()
+        Document.objects.filter(url='http://127.0.0.1/1').update(lang_iso_639_1='de')
+        Document.objects.filter(url='http://127.0.0.1/2').delete()
+        self.assertEqual(list(LangStats.objects.order_by('lang_iso_639_1').values_list('lang_iso_639_1', 'doc_count')),
+                         [('de', 1), ('en', 0), ('fr', 2)])
+
+        LangStats.cached_langs = None
+        self.assertEqual(LangStats.get_langs(), {'de', 'fr'})
+        with self.assertNumQueries(0):
+            self.assertEqual(LangStats.get_langs(), {'de', 'fr'})
+        LangStats.cached_langs = None
+
+    def test_favicon_export(self):
+        missing = FavIcon.objects.create(url='http://127.0.0.1/missing.ico')
+        favicon = FavIcon.objects.create(url='http://127.0.0.1/favicon.ico', content=b'icon', mimetype='image/png', missing=False)
+        self.assertEqual(favicon.get_absolute_url(), f'/favicon/{favicon.id}')
+
+        with TemporaryDirectory() as tmp_dir:
+            with override_settings(SOSSE_FAVICONS_DIR=tmp_dir + '/favicon/', SOSSE_FAVICONS_URL='/screenshots/favicon/'):
+                out = StringIO()
+                call_command('export_favicons', stdout=out)
+                self.assertEqual(out.getvalue(), '1 favicons exported\n')
+
+                favicon.refresh_from_db()
+                self.assertEqual(favicon.filename, 'baec6461b0d69dde1b861aefbe375d8a.png')
+                self.assertEqual(favicon.get_absolute_url(), '/screenshots/favicon/baec6461b0d69dde1b861aefbe375d8a.png')
+                with open(os.path.join(tmp_dir, 'favicon', favicon.filename), 'rb') as f:
+                    self.assertEqual(f.read(), b'icon')
+
+                missing.refresh_from_db()
+                self.assertIsNone(missing.filename)
+
+    def test_crawl_policy_cache(self):
+        CrawlPolicy.clear_url_cache()
+        policy = CrawlPolicy.objects.create(url_regex='http://127.0.0.1/.*')
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/'), policy)
+        with self.assertNumQueries(1):
+            self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/'), policy)
+
+        # the generation is read once per request
+        request = RequestFactory().get('/')
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/', request), policy)
+        with self.assertNumQueries(0):
+            cached = CrawlPolicy.get_from_url_cached('http://127.0.0.1/', request)
+        self.assertEqual(cached, policy)
+
+        # callers get their own copy of the policy
+        cached.snapshot_html = not policy.snapshot_html
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/', request).snapshot_html, policy.snapshot_html)
+
+        # policies changed by another process
+        CrawlPolicy.objects.filter(id=policy.id).update(url_regex='http://127.0.0.1/other.*')
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/'), policy)
+        CrawlPolicy.bump_generation()
+        self.assertNotEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/'), policy)
+        CrawlPolicy.objects.filter(id=policy.id).update(url_regex='http://127.0.0.1/.*')
+        CrawlPolicy.clear_url_cache()
+
+        # other processes are notified once the policy is committed
+        generation = CrawlPolicy.generation()
+        with self.captureOnCommitCallbacks(execute=True):
+            policy2 = CrawlPolicy.objects.create(url_regex='http://127.0.0.1/page.*')
+            self.assertEqual(CrawlPolicy.generation(), generation)
+        self.assertEqual(CrawlPolicy.generation(), generation + 1)
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/page'), policy2)
+
+        policy2.delete()
+        self.assertEqual(CrawlPolicy.get_from_url_cached('http://127.0.0.1/page'), policy)
+        CrawlPolicy.clear_url_cache()
+
+    def test_admin_domain_read_only(self):
+        doc = Document.objects.create(url='http://127.0.0.1/')
+        self.assertEqual(DocumentAdmin.domain(doc), '-')
+        self.assertEqual(DomainSetting.objects.count(), 0)
+
+        domain = DomainSetting.objects.create(domain='127.0.0.1')
+        self.assertIn(f'/admin/se/domainsetting/{domain.id}/change/', DocumentAdmin.domain(doc))
+
+    def test_document_url_hash(self):
+        doc = Document.objects.create(url='http://127.0.0.1/')
+        self.assertEqual(bytes(doc.url_hash), Document.url_hash_digest('http://127.0.0.1/'))
+        self.assertEqual(Document.objects.filter(**Document.url_lookup('http://127.0.0.1/')).get(), doc)
+
+        doc.url = 'http://127.0.0.1/page'
+        doc.save()
+        self.assertFalse(Document.objects.filter(**Document.url_lookup('http://127.0.0.1/')).exists())
+        self.assertEqual(Document.objects.filter(**Document.url_lookup('http://127.0.0.1/page')).get(), doc)
+
+        with transaction.atomic():
+            with self.assertRaises(IntegrityError):
+                Document.objects.create(url='http://127.0.0.1/page')
@@ -13,14 +13,22 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from io import StringIO
+
+from django.contrib.postgres.search import SearchQuery, SearchVector
+from django.core.cache import caches
 from django.core.handlers.wsgi import WSGIRequest
+from django.core.management import call_command
+from django.db import connection, models
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
-from .document import Document
+from .document import Document, content_pos, remove_accent, remove_accent_offsets
 from .forms import SearchForm
-from .models import Link, SearchEngine
-from .search import add_headlines, get_documents
+from .models import Link, SearchEngine, WordStats
+from .paginator import CachedResults, SearchPaginator, count_results
+from .search import RESULT_DEFERRED_FIELDS, add_headlines, get_documents, get_results, get_word_stats, rank_documents
 
 
 class SearchTest(TestCase):
@@ -180,6 +188,327 @@ class SearchTest(TestCase):
         self.assertEqual(docs[0], self.page)
         self.assertEqual(docs[0].headline, 'Page1, World <span class="res-highlight">Télé</span>')
 
+    def test_022_headline_offsets(self):
+        content = 'Page2, Te\u0301le\u0301 한국 one world three'
+        self.assertEqual(remove_accent_offsets('Page1, World Télé one three'), [])
+        offsets = remove_accent_offsets(content)
+        self.assertEqual(offsets, [9, 1, 11, 2, 15, 0, 18, -2])
+        normalized = remove_accent(content)
+        for word in ('Te\u0301le\u0301', 'one', 'world'):
+            norm_word = remove_accent(word)
+            start = normalized.index(norm_word)
+            self.assertEqual(content[content_pos(offsets, start):content_pos(offsets, start + len(norm_word))], word)
+
+        for normalized_offsets in (offsets, None):
+            Document.objects.filter(id=self.page.id).update(content=content,
+                                                            normalized_content=normalized,
+                                                            normalized_offsets=normalized_offsets,
+                                                            vector=SearchVector(models.Value(normalized)))
+            request = WSGIRequest({
+                'REQUEST_METHOD': 'GET',
+                'QUERY_STRING': 'q=world',
+                'wsgi.input': ''
+            })
+            form = SearchForm(request.GET)
+            self.assertTrue(form.is_valid())
+            _, docs, query = get_documents(request, form)
+            with self.assertNumQueries(2):
+                docs = add_headlines(docs.filter(id=self.page.id), query)
+            self.assertEqual(docs[0].headline, 'Page2, Te\u0301le\u0301 한국 one <span class="res-highlight">world</span>')
+
+    def test_023_deferred_fields(self):
+        Document.objects.filter(id=self.root.id).update(normalized_offsets=[])
+        request = WSGIRequest({
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': 'q=world',
+            'wsgi.input': ''
+        })
+        form = SearchForm(request.GET)
+        self.assertTrue(form.is_valid())
+        _, docs, query = get_documents(request, form)
+        docs = docs.select_related('favicon').defer(*RESULT_DEFERRED_FIELDS)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = SearchPaginator(docs, 10).get_page(1)
+            page = add_headlines(page, query)
+            for doc in page:
+                doc.get_absolute_url()
+                doc.image_name()
+                doc.lang_flag()
+                doc.favicon
+        self.assertEqual(len(queries), 3)
+        for column in ('"se_document"."content"', '"se_document"."normalized_content"', '"se_document"."error"',
+                       '"se_favicon"."content"'):
+            self.assertNotIn(column, queries[1]['sql'])
+
+        headlines = {doc.id: doc.headline for doc in page}
+        self.assertEqual(headlines, {
+            self.root.id: 'Hello <span class="res-highlight">world</span>',
+            self.page.id: 'Page1, <span class="res-highlight">World</span>'
+        })
+
+    def test_024_deferred_fields_no_query(self):
+        docs = self._search_docs('ft1=inc&ff1=doc&fo1=contain&fv1=one')
+        docs = docs.defer(*RESULT_DEFERRED_FIELDS)
+
+        with CaptureQueriesContext(connection) as queries:
+            page = SearchPaginator(docs, 10).get_page(1)
+            page = add_headlines(page, None)
+            headlines = {doc.id: doc.headline for doc in page}
+        self.assertEqual(len(queries), 3)
+        self.assertNotIn('"se_document"."content"', queries[1]['sql'].split(' FROM ')[0])
+        self.assertEqual(headlines, {
+            self.root.id: 'Hello world one two three',
+            self.page.id: 'Page1, World Télé one three'
+        })
+
+    def test_030_result_count(self):
+        docs = self._search_docs('ft1=inc&ff1=doc&fo1=contain&fv1=one')
+        with override_settings(SOSSE_RESULT_COUNT='exact'):
+            self.assertEqual(count_results(docs), (2, True))
+        with override_settings(SOSSE_RESULT_COUNT='capped', SOSSE_RESULT_COUNT_CAP=2):
+            self.assertEqual(count_results(docs), (2, True))
+        with override_settings(SOSSE_RESULT_COUNT='capped', SOSSE_RESULT_COUNT_CAP=1):
+            self.assertEqual(count_results(docs), (1, False))
+        with override_settings(SOSSE_RESULT_COUNT='estimate', SOSSE_RESULT_COUNT_CAP=1):
+            count, exact = count_results(docs)
+            self.assertGreaterEqual(count, 1)
+            self.assertFalse(exact)
+
+    @override_settings(SOSSE_RESULT_COUNT='capped', SOSSE_RESULT_COUNT_CAP=1)
+    def test_031_paginator(self):
+        docs = self._search_docs('ft1=inc&ff1=doc&fo1=contain&fv1=one')
+        paginator = SearchPaginator(docs, 1)
+        self.assertEqual(paginator.num_pages, 1)
+
+        with self.assertNumQueries(1):
+            page = paginator.page(1)
+        self.assertEqual(list(page), [self.page])
+        self.assertTrue(page.has_next())
+        self.assertEqual(page.next_page_number(), 2)
+
+        # The page after the counted results can be browsed
+        page = paginator.get_page(2)
+        self.assertEqual(page.number, 2)
+        self.assertEqual(list(page), [self.root])
+        self.assertFalse(page.has_next())
+
+        page = paginator.get_page(3)
+        self.assertEqual(page.number, 1)
+
+        with override_settings(SOSSE_RESULT_COUNT='exact'):
+            paginator = SearchPaginator(docs, 1)
+            self.assertEqual(paginator.num_pages, 2)
+            self.assertEqual(paginator.get_page(3).number, 2)
+
+    def _get_results(self, params):
+        request = WSGIRequest({
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': params,
+            'wsgi.input': ''
+        })
+        form = SearchForm(request.GET)
+        self.assertTrue(form.is_valid())
+        return get_results(request, form)[1]
+
+    def test_032_search_cache(self):
+        caches['search'].clear()
+        results = self._get_results('q=world&s=title')
+        self.assertIsInstance(results, CachedResults)
+        self.assertEqual(results.count_info, (2, True))
+        self.assertEqual(results[0:10], [self.page, self.root])
+        self.assertTrue(results[0:1][0].rank > 0)
+
+        # the same normalized query is served from the cache
+        with self.assertNumQueries(2):
+            results = self._get_results('q=%20world%20%20&s=title')
+            paginator = SearchPaginator(results, 1)
+            page = paginator.page(2)
+        self.assertEqual(paginator.count, 2)
+        self.assertEqual(list(page), [self.root])
+        self.assertFalse(page.has_next())
+
+        # filters are part of the key
+        results = self._get_results('ft1=inc&ff1=doc&fo1=contain&fv1=one')
+        self.assertEqual(results.count_info, (2, True))
+        results = self._get_results('ft1=inc&ff1=doc&fo1=contain&fv1=one&ft2=exc&ff2=doc&fo2=contain&fv2=hello')
+        self.assertEqual(results.count_info, (1, True))
+        self.assertEqual(results[0:10], [self.page])
+
+        # reindexing invalidates the cache
+        Document.objects.filter(id=self.root.id).update(content='Hello', normalized_content='Hello')
+        self.assertEqual(self._get_results('q=world&s=title')[0:10], [self.page, self.root])
+        Document.bump_index_generation()
+        self.assertEqual(self._get_results('q=world&s=title')[0:10], [self.page])
+
+    @override_settings(SOSSE_RESULT_COUNT_CAP=1)
+    def test_033_search_cache_capped(self):
+        caches['search'].clear()
+        results = self._get_results('ft1=inc&ff1=doc&fo1=contain&fv1=one&s=title')
+        self.assertEqual(results.count_info, (1, False))
+        self.assertEqual(results.ranks, [(self.page.id, None)])
+        # results past the cached ids are read from the database
+        self.assertEqual(results[0:2], [self.page, self.root])
+
+    @override_settings(SOSSE_SEARCH_CACHE_TIMEOUT=0)
+    def test_034_search_cache_disabled(self):
+        results = self._get_results('q=world')
+        self.assertNotIsInstance(results, CachedResults)
+
+    def _browse_cursors(self, paginator):
+        page = paginator.get_page(1)
+        pages = [list(page)]
+        while page.has_next():
+            page = paginator.get_cursor_page(page.next_cursor())
+            self.assertEqual(page.number, len(pages) + 1)
+            pages.append(list(page))
+
+        back = [list(page)]
+        while page.has_previous():
+            page = paginator.get_cursor_page(page.previous_cursor())
+            back.insert(0, list(page))
+        self.assertEqual(back, pages)
+        return pages
+
+    @override_settings(SOSSE_SEARCH_CACHE_TIMEOUT=0)
+    def test_035_cursor_pagination(self):
+        third = Document.objects.create(url='http://127.0.0.1/page3',
+                                        normalized_url='http://127.0.0.1/page3',
+                                        content='Hello world',
+                                        normalized_content='Hello world',
+                                        title='Page1',
+                                        normalized_title='Page1',
+                                        crawl_last=timezone.now())
+        for params, expected in (('q=world', [self.page, third, self.root]),
+                                 ('q=world&s=title', [self.page, third, self.root]),
+                                 ('q=world&s=-title', [self.root, self.page, third]),
+                                 ('ft1=inc&ff1=doc&fo1=contain&fv1=o&s=-url', [third, self.page, self.root])):
+            docs = self._get_results(params)
+            pages = self._browse_cursors(SearchPaginator(docs, 1))
+            self.assertEqual(pages, [[doc] for doc in expected], params)
+
+        # Rows having a NULL value are sorted last in ascending order
+        Document.objects.filter(id=self.page.id).update(crawl_first=timezone.now())
+        Document.objects.filter(id=third.id).update(crawl_first=timezone.now())
+        docs = self._get_results('q=world&s=crawl_first')
+        self.assertEqual(self._browse_cursors(SearchPaginator(docs, 1)), [[self.page], [third], [self.root]])
+        docs = self._get_results('q=world&s=-crawl_first')
+        self.assertEqual(self._browse_cursors(SearchPaginator(docs, 2)), [[self.root, third], [self.page]])
+
+        docs = self._get_results('q=world')
+        with self.assertNumQueries(2):
+            page = SearchPaginator(docs, 1).get_cursor_page('invalid')
+        self.assertEqual(page.number, 1)
+
+    def test_036_cursor_pagination_cache(self):
+        caches['search'].clear()
+        docs = self._get_results('q=world&s=title')
+        paginator = SearchPaginator(docs, 1)
+        cursor = paginator.get_page(1).next_cursor()
+        with self.assertNumQueries(1):
+            page = paginator.get_cursor_page(cursor)
+        self.assertEqual(list(page), [self.root])
+
+        with override_settings(SOSSE_RESULT_COUNT_CAP=1):
+            caches['search'].clear()
+            docs = self._get_results('q=world&s=title')
+            self.assertEqual(self._browse_cursors(SearchPaginator(docs, 1)), [[self.page], [self.root]])
+
+    def test_037_rank_candidates(self):
+        title = Document.objects.create(url='http://127.0.0.1/hello',
+                                        normalized_url='http://127.0.0.1/hello',
+                                        content='Nothing',
+                                        normalized_content='Nothing',
+                                        title='World',
+                                        normalized_title='World',
+                                        crawl_last=timezone.now())
+        query = SearchQuery('world', config='english', search_type='websearch')
+        self.assertEqual(rank_documents(query).count(), 3)
+
+        # documents matching in their title are ranked first
+        docs = rank_documents(query, 1)
+        self.assertEqual(list(docs), [title])
+        self.assertEqual(docs[0].rank, rank_documents(query).get(id=title.id).rank)
+
+        # other matching documents fill the candidates
+        docs = rank_documents(query, 2)
+        self.assertEqual(docs.count(), 2)
+        self.assertIn(title, docs)
+
+        with override_settings(SOSSE_SEARCH_RANK_CANDIDATES=1, SOSSE_SEARCH_CACHE_TIMEOUT=0):
+            self.assertEqual(self._get_results('q=world').count(), 1)
+
+        out = StringIO()
+        call_command('benchmark_ranking', 'world', '--candidates', '3', stdout=out)
+        self.assertIn('world: all documents', out.getvalue())
+        self.assertIn('precision 1.00', out.getvalue())
+
+    def test_038_filter_escape(self):
+        docs = self._search_docs('ft1=inc&ff1=doc&fo1=contain&fv1=%25')
+        self.assertEqual(docs.count(), 0)
+        docs = self._search_docs('ft1=inc&ff1=title&fo1=equal&fv1=r_ot')
+        self.assertEqual(docs.count(), 0)
+        docs = self._search_docs('ft1=inc&ff1=title&fo1=equal&fv1=rOOT')
+        self.assertEqual(list(docs), [self.root])
+
+    def test_039_filter_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            if cursor.fetchone() is None:
+                self.skipTest('pg_trgm is not installed')
+
+        for field in ('doc', 'content', 'title', 'url', 'mimetype', 'lto_url', 'lto_txt', 'lby_url', 'lby_txt'):
+            for operator in ('contain', 'equal', 'regexp'):
+                for case in ('', '&fc1=on'):
+                    params = f'ft1=inc&ff1={field}&fo1={operator}&fv1=hello{case}'
+                    sql, sql_params = self._search_docs(params).query.sql_with_params()
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET LOCAL enable_seqscan = off')
+                        cursor.execute('EXPLAIN ' + sql, sql_params)
+                        plan = '\n'.join(row[0] for row in cursor.fetchall())
+                    self.assertNotIn('Seq Scan', plan, params)
+
+    def _get_word_stats(self, params):
+        request = WSGIRequest({
+            'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': params,
+            'wsgi.input': ''
+        })
+        form = SearchForm(request.GET)
+        self.assertTrue(form.is_valid())
+        return get_word_stats(request, form)
+
+    @override_settings(SOSSE_SEARCH_CACHE_TIMEOUT=0)
+    def test_040_word_stats(self):
+        words = self._get_word_stats('q=world')
+        self.assertEqual(words[:4], [('127.0.0.1', 2), ('one', 2), ('three', 2), ('world', 2)])
+        self.assertIn(('hello', 1), words)
+        self.assertIn(('tele', 1), words)
+
+        # only the best ranked document is analyzed
+        with override_settings(SOSSE_WORD_STATS_SAMPLE=1):
+            words = self._get_word_stats('q=hello or world')
+        self.assertEqual(dict(words), {'127.0.0.1': 1, 'hello': 1, 'one': 1, 'root': 1, 'three': 1, 'two': 1, 'world': 1})
+
+        self.assertEqual(self._get_word_stats('q='), [])
+
+    def test_041_word_stats_cache(self):
+        caches['search'].clear()
+        words = self._get_word_stats('q=world')
+        with self.assertNumQueries(1):
+            self.assertEqual(self._get_word_stats('q=world'), words)
+
+    @override_settings(SOSSE_SEARCH_CACHE_TIMEOUT=0, SOSSE_WORD_STATS_IDF=True)
+    def test_042_word_stats_idf(self):
+        WordStats.refresh(100)
+        self.assertEqual(WordStats.objects.get(word='world').ndoc, 2)
+        self.assertEqual(WordStats.objects.get(word='hello').ndoc, 1)
+
+        WordStats.objects.filter(word='world').update(ndoc=1000000)
+        words = self._get_word_stats('q=world')
+        self.assertEqual(words[:3], [('127.0.0.1', 2), ('one', 2), ('three', 2)])
+        self.assertEqual(words[-1], ('world', 2))
+
 
 class ShortcutTest(TestCase):
     def setUp(self):
@@ -214,3 +543,27 @@ class ShortcutTest(TestCase):
         self.assertEqual(SearchEngine.should_redirect('!f test'), self._search_url('test'))
         self.assertEqual(SearchEngine.should_redirect('!g test'), self._search_url('test', 'test2.com'))
         self.assertEqual(SearchEngine.should_redirect('!s test'), None)
+
+    def test_50_shortcuts_cache(self):
+        self.assertEqual(SearchEngine.should_redirect('!f test'), self._search_url('test'))
+        with self.assertNumQueries(0):
+            self.assertEqual(SearchEngine.should_redirect('!f test'), self._search_url('test'))
+            self.assertEqual(SearchEngine.should_redirect('!g test'), self._search_url('test', 'test2.com'))
+
+        se = SearchEngine.objects.get(short_name='fake')
+        se.html_template = self._search_url('{searchTerms}', 'test3.com')
+        se.save()
+        self.assertEqual(SearchEngine.should_redirect('!f test'), self._search_url('test', 'test3.com'))
+
+        se.delete()
+        self.assertEqual(SearchEngine.should_redirect('!f test'), None)
+
+    def test_60_templates(self):
+        for template, url in (('http://test.com/{searchTerms}', 'http://test.com/a+b%26'),
+                              ('http://test.com/{searchTermsBase64}', 'http://test.com/YSBiJg%3D%3D'),
+                              ('http://test.com/#q={searchTerms}', 'http://test.com/#q=a+b%26'),
+                              ('http://test.com/#q={searchTermsBase64}', 'http://test.com/#q=YSBiJg=='),
+                              ('http://test.com/?q={searchTerms}&l=en', 'http://test.com/?q=a+b%26&l=en'),
+                              ('http://test.com/?l=en&q={searchTermsBase64}', 'http://test.com/?l=en&q=YSBiJg%3D%3D')):
+            se = SearchEngine(html_template=template)
+            self.assertEqual(se.get_search_url('a b&'), url)
@@ -0,0 +1,100 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from io import BytesIO
+from tempfile import TemporaryDirectory
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from PIL import Image
+
+from .document import Document
+from .thumbnails import add_thumbnails, thumbnails
+
+
+class ThumbnailsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='thumbnails_user')
+        self.factory = RequestFactory()
+        self.tmp_dir = TemporaryDirectory()
+        self.docs = []
+        for n, color in enumerate(('red', 'blue')):
+            doc = Document.objects.create(url=f'http://127.0.0.1/{n}', has_thumbnail=True)
+            filename = os.path.join(self.tmp_dir.name, doc.image_name()) + '.jpg'
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            Image.new('RGB', (160, 100), color).save(filename, 'jpeg')
+            self.docs.append(doc)
+        self.docs.append(Document.objects.create(url='http://127.0.0.1/no_thumb'))
+        caches['thumbnails'].clear()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _thumbnails(self, ids):
+        request = self.factory.get('/thumbnails/', {'ids': ids})
+        request.user = self.user
+        return thumbnails(request)
+
+    def test_10_files(self):
+        with override_settings(SOSSE_THUMBNAILS_DIR=self.tmp_dir.name + '/', SOSSE_THUMBNAILS_MODE='files'):
+            add_thumbnails(self.docs)
+        self.assertEqual(self.docs[0].thumbnail_src, f'/screenshots/thumb/{self.docs[0].image_name()}.jpg')
+        self.assertFalse(hasattr(self.docs[0], 'thumbnail_sprite'))
+        self.assertFalse(hasattr(self.docs[2], 'thumbnail_src'))
+
+    def test_20_inline(self):
+        with override_settings(SOSSE_THUMBNAILS_DIR=self.tmp_dir.name + '/', SOSSE_THUMBNAILS_MODE='inline'):
+            add_thumbnails(self.docs)
+        self.assertTrue(self.docs[0].thumbnail_src.startswith('data:image/jpeg;base64,/9j/'))
+        self.assertFalse(hasattr(self.docs[2], 'thumbnail_src'))
+
+    def test_30_sprite(self):
+        with override_settings(SOSSE_THUMBNAILS_DIR=self.tmp_dir.name + '/', SOSSE_THUMBNAILS_MODE='sprite'):
+            add_thumbnails(self.docs)
+            ids = f'{self.docs[1].id},{self.docs[0].id}'
+            response = self._thumbnails(ids)
+
+            with self.assertNumQueries(0):
+                cached = self._thumbnails(ids)
+
+        self.assertEqual(self.docs[0].thumbnail_sprite, f'/thumbnails/?ids={self.docs[0].id},{self.docs[1].id}')
+        self.assertEqual(self.docs[0].thumbnail_offset, 0)
+        self.assertEqual(self.docs[1].thumbnail_offset, 100)
+        self.assertFalse(hasattr(self.docs[2], 'thumbnail_sprite'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], 'private, max-age=300')
+        self.assertEqual(cached.content, response.content)
+        with Image.open(BytesIO(response.content)) as img:
+            self.assertEqual(img.size, (160, 200))
+            blue = img.getpixel((80, 50))
+            red = img.getpixel((80, 150))
+        self.assertGreater(blue[2], 200)
+        self.assertLess(blue[0], 50)
+        self.assertGreater(red[0], 200)
+        self.assertLess(red[2], 50)
+
+    def test_35_sprite_cache_timeout(self):
+        self.assertEqual(settings.CACHES['thumbnails']['TIMEOUT'], settings.SOSSE_THUMBNAILS_SPRITE_CACHE_TIMEOUT)
+
+    def test_40_sprite_invalid(self):
+        for ids in ('', 'a,1', ','.join(['1'] * 201)):
+            with self.assertRaises(Http404):
+                self._thumbnails(ids)
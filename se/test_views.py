@@ -29,6 +29,7 @@ from se.html import html, html_excluded
 from se.models import CrawlerStats, CrawlPolicy, DomainSetting
 from se.screenshot import screenshot, screenshot_full
 from se.stats import stats
+from se.thumbnails import thumbnails
 from se.views import about, history, opensearch, prefs, search, search_redirect, word_stats
 from se.words import words
 from se.www import www
@@ -92,6 +93,7 @@ class ViewsTest(TestCase):
                                   ('/atom/?q=page&cached=1', atom, tuple()),
                                   ('/word_stats/?q=page', word_stats, tuple()),
                                   ('/opensearch.xml', opensearch, tuple()),
+                                  (f'/thumbnails/?ids={self.doc.id}', thumbnails, tuple()),
                                   ('/html/' + CRAWL_URL, html, tuple()),
                                   ('/www/' + CRAWL_URL, www, tuple()),
                                   ('/www/http://unknown/', www, tuple()),
@@ -109,7 +111,7 @@ class ViewsTest(TestCase):
 
     def test_new_urls(self):
         from sosse.urls import urlpatterns
-        self.assertEqual(len(urlpatterns), 20)
+        self.assertEqual(len(urlpatterns), 22)
 
     def test_cache_redirect(self):
         request = self._request_from_factory('/cache/' + CRAWL_URL)
@@ -0,0 +1,212 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from django.utils import timezone
+
+from .document import Document
+from .models import Link, WWWFragment
+from .words import words
+from .www import www
+
+
+class WWWTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='www_user')
+        self.target = Document.objects.create(url='http://127.0.0.1/target')
+        self.factory = RequestFactory()
+
+    def _create_doc(self, url, links_count):
+        content = '\n'.join([f'line {n} link {n} end' for n in range(links_count)])
+        doc = Document.objects.create(url=url, content=content)
+        pos = 0
+        for n in range(links_count):
+            line = f'line {n} link {n} end'
+            text = f'link {n}'
+            Link.objects.create(doc_from=doc,
+                                doc_to=self.target if n % 2 else None,
+                                extern_url=None if n % 2 else f'http://extern/{n}',
+                                text=text,
+                                pos=pos + line.index(text),
+                                link_no=n)
+            pos += len(line) + 1
+        return doc
+
+    def _www(self, url, **headers):
+        request = self.factory.get('/www/' + url, **headers)
+        request.META['REQUEST_URI'] = '/www/' + url
+        request.user = self.user
+        with CaptureQueriesContext(connection) as queries:
+            response = www(request)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8'), len(queries)
+
+    def _www_response(self, url, **headers):
+        request = self.factory.get('/www/' + url, **headers)
+        request.META['REQUEST_URI'] = '/www/' + url
+        request.user = self.user
+        return www(request)
+
+    def test_10_links(self):
+        self._create_doc('http://127.0.0.1/', 2)
+        content, _ = self._www('http://127.0.0.1/')
+        self.assertIn('line 0  [link 0] · <a href="http://extern/0">🌍</a> end<br/>', content)
+        self.assertIn('line 1 <a href="/www/http://127.0.0.1/target">link 1</a> · <a href="http://127.0.0.1/target">🌍</a> end<br/>', content)
+
+    def test_20_query_count(self):
+        self._create_doc('http://127.0.0.1/warmup', 2)
+        self._create_doc('http://127.0.0.1/few', 2)
+        self._create_doc('http://127.0.0.1/many', 50)
+        self._www('http://127.0.0.1/warmup')  # warms up process level caches
+        _, few_queries = self._www('http://127.0.0.1/few')
+        content, many_queries = self._www('http://127.0.0.1/many')
+        self.assertEqual(content.count('· <a href='), 50)
+        self.assertEqual(few_queries, many_queries)
+
+    def test_30_fragment(self):
+        doc = self._create_doc('http://127.0.0.1/', 2)
+        doc.content_hash = 'hash1'
+        doc.save()
+        content, _ = self._www('http://127.0.0.1/')
+        fragment = WWWFragment.objects.get(doc=doc)
+        self.assertEqual(fragment.content_hash, 'hash1')
+        self.assertIn(fragment.get_content(), content)
+
+        # links saved again by the crawler
+        links = list(Link.objects.filter(doc_from=doc).order_by('link_no'))
+        for link in links:
+            link.pk = None
+            link.text = 'modified'
+        doc._save_links(links)
+        content, _ = self._www('http://127.0.0.1/')
+        self.assertIn('[modified]', content)
+        self.assertNotIn('link 0', content)
+
+        # the target of a link changes
+        Document.objects.filter(id=self.target.id).update(has_html_snapshot=True)
+        WWWFragment.clear_linking_to([self.target])
+        content, _ = self._www('http://127.0.0.1/')
+        self.assertIn('<a href="/html/http://127.0.0.1/target">modified</a>', content)
+
+        doc.content_hash = 'hash2'
+        doc.save()
+        Link.objects.filter(doc_from=doc).update(text='link')
+        content, _ = self._www('http://127.0.0.1/')
+        self.assertNotIn('modified', content)
+        self.assertEqual(WWWFragment.objects.get(doc=doc).content_hash, 'hash2')
+
+    def test_40_not_modified(self):
+        doc = self._create_doc('http://127.0.0.1/', 2)
+        response = self._www_response('http://127.0.0.1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+        doc.crawl_last = timezone.now()
+        doc.save()
+        response = self._www_response('http://127.0.0.1/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        etag = response['ETag']
+
+        # the document is resolved from its url once
+        with CaptureQueriesContext(connection) as queries:
+            self._www_response('http://127.0.0.1/')
+        self.assertEqual(len([q for q in queries if '"url_hash" =' in q['sql']]), 1)
+        last_modified = response['Last-Modified']
+
+        with self.assertNumQueries(1):
+            response = self._www_response('http://127.0.0.1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self._www_response('http://127.0.0.1/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # an external link is resolved
+        extern_links = Link.objects.filter(doc_from=doc, doc_to__isnull=True)
+        WWWFragment.clear_linking_extern(extern_links)
+        extern_links.update(extern_url=None, doc_to=self.target)
+        response = self._www_response('http://127.0.0.1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+
+        # a linked document is crawled
+        with mock.patch('se.models.now') as now:
+            now.side_effect = lambda: timezone.now() + timezone.timedelta(seconds=2)
+            WWWFragment.clear_linking_to([self.target])
+        response = self._www_response('http://127.0.0.1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        response = self._www_response('http://127.0.0.1/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+
+        doc.crawl_last = timezone.now() + timezone.timedelta(seconds=4)
+        doc.save()
+        response = self._www_response('http://127.0.0.1/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_50_words_not_modified(self):
+        Document.objects.create(url='http://127.0.0.1/',
+                                normalized_content='Hello world',
+                                crawl_last=timezone.now())
+        request = self.factory.get('/words/http://127.0.0.1/')
+        request.META['REQUEST_URI'] = '/words/http://127.0.0.1/'
+        request.user = self.user
+        response = words(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('hello', response.content.decode('utf-8'))
+
+        request = self.factory.get('/words/http://127.0.0.1/', HTTP_IF_NONE_MATCH=response['ETag'])
+        request.META['REQUEST_URI'] = '/words/http://127.0.0.1/'
+        request.user = self.user
+        with self.assertNumQueries(1):
+            response = words(request)
+        self.assertEqual(response.status_code, 304)
+
+    def _words(self, path):
+        request = self.factory.get(path)
+        request.META['REQUEST_URI'] = path
+        request.user = self.user
+        response = words(request)
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode('utf-8')
+
+    @mock.patch('se.words.WORDS_PAGE_SIZE', 2)
+    def test_60_words_pages(self):
+        Document.objects.create(url='http://127.0.0.1/?a=1',
+                                normalized_title='title',
+                                content='apple banana banana cherry',
+                                normalized_content='apple banana banana cherry')
+        content = self._words('/words/http://127.0.0.1/?a=1')
+        self.assertIn('The document has 4 words', content)
+        self.assertIn('The document has 4 unique words', content)
+        self.assertIn('1 of 2', content)
+        self.assertLess(content.index('<b>title</b>'), content.index('<b>banana</b>'))
+        self.assertNotIn('<b>apple</b>', content)
+        self.assertIn('href="/words/2/http://127.0.0.1/?a=1"', content)
+
+        content = self._words('/words/2/http://127.0.0.1/?a=1')
+        self.assertIn('2 of 2', content)
+        self.assertIn('<b>apple</b>', content)
+        self.assertIn('<b>cherry</b>', content)
+        self.assertIn('href="/words/1/http://127.0.0.1/?a=1"', content)
@@ -0,0 +1,105 @@
+# Copyright 2022-2023 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from base64 import b64encode
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import Http404, HttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from PIL import Image
+
+from .document import Document
+from .login import login_required
+
+
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 100
+
+
+def thumbnail_path(doc):
+    return os.path.join(settings.SOSSE_THUMBNAILS_DIR, doc.image_name()) + '.jpg'
+
+
+def add_thumbnails(paginated):
+    # Sets the source of the thumbnail of each result, according to the thumbnails_mode option
+    results = [r for r in paginated if r.has_thumbnail]
+    if settings.SOSSE_THUMBNAILS_MODE == 'sprite' and results:
+        sprite_url = reverse('thumbnails') + '?ids=' + ','.join([str(r.id) for r in results])
+        for no, r in enumerate(results):
+            r.thumbnail_sprite = sprite_url
+            r.thumbnail_offset = no * THUMBNAIL_HEIGHT
+        return
+
+    for r in results:
+        r.thumbnail_src = settings.SOSSE_THUMBNAILS_URL + r.image_name() + '.jpg'
+        if settings.SOSSE_THUMBNAILS_MODE == 'inline':
+            try:
+                with open(thumbnail_path(r), 'rb') as f:
+                    r.thumbnail_src = 'data:image/jpeg;base64,' + b64encode(f.read()).decode('ascii')
+            except OSError:
+                pass
+
+
+def create_sprite(doc_ids):
+    # Stacks the thumbnails of the documents vertically, in the order of the ids
+    docs = Document.objects.filter(id__in=doc_ids, has_thumbnail=True).only('id', 'url')
+    docs = {doc.id: doc for doc in docs}
+    sprite = Image.new('RGB', (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT * len(doc_ids)), 'white')
+
+    for no, doc_id in enumerate(doc_ids):
+        doc = docs.get(doc_id)
+        if doc is None:
+            continue
+        try:
+            with Image.open(thumbnail_path(doc)) as img:
+                img = img.convert('RGB').resize((THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+                sprite.paste(img, (0, no * THUMBNAIL_HEIGHT))
+        except OSError:
+            pass
+
+    content = BytesIO()
+    sprite.save(content, 'jpeg')
+    return content.getvalue()
+
+
+@login_required
+def thumbnails(request):
+    try:
+        doc_ids = [int(doc_id) for doc_id in request.GET.get('ids', '').split(',')]
+    except ValueError:
+        raise Http404()
+
+    if len(doc_ids) > settings.SOSSE_MAX_PAGE_SIZE:
+        raise Http404()
+
+    cache = caches['thumbnails']
+    key = 'sprite:' + ','.join([str(doc_id) for doc_id in doc_ids])
+    content = cache.get(key)
+    if content is None:
+        content = create_sprite(doc_ids)
+        cache.set(key, content)
+
+    response = HttpResponse(content, content_type='image/jpeg')
+    # Thumbnails change when documents are crawled again
+    timeout = settings.SOSSE_THUMBNAILS_SPRITE_CACHE_TIMEOUT
+    if settings.SOSSE_ANONYMOUS_SEARCH:
+        patch_cache_control(response, public=True, max_age=timeout)
+    else:
+        patch_cache_control(response, private=True, max_age=timeout)
+    return response
@@ -17,6 +17,7 @@ import os
 import re
 
 from copy import copy
+from functools import lru_cache
 from urllib.parse import urlparse as base_urlparse
 from urllib.parse import quote, quote_plus, unquote, unquote_plus
 
@@ -64,6 +65,8 @@ def url_remove_fragment(url):
     return url.split('#', 1)[0]
 
 
+# The same urls are sanitized repeatedly when resolving links and cached pages
+@lru_cache(maxsize=4096)
 def sanitize_url(_url):
     url = urlparse(_url)
 
@@ -21,15 +21,16 @@ from urllib.parse import urlparse, parse_qs, quote_plus
 from django.conf import settings
 from django.contrib.auth.views import LoginView
 from django.core.paginator import Paginator
-from django.db import connection
 from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 
 from .document import Document, extern_link_flags, remove_accent
 from .forms import SearchForm
 from .login import login_required
-from .models import FavIcon, SearchEngine, SearchHistory
-from .search import add_headlines, get_documents
+from .models import FavIcon, LangStats, SearchEngine, SearchHistory
+from .paginator import SearchPage, SearchPaginator
+from .search import add_headlines, get_results, get_word_stats
+from .thumbnails import add_thumbnails
 
 
 ANIMALS = '🦓🦬🦣🦒🦦🦥🦘🦌🐢🦝🦭🦫🐆🐅🦎🐍🐘🦙🐫🐪🐏🐐🦛🦏🐂🐃🐎🐑🐒🦇🐖🐄🐛🐝🦧🦍🐜🐞🐌🦋🦗🐨🐯🦁🐮🐰🐻🐻‍❄️🐼🐶🐱🐭🐹🐗🐴🐷🐣🐥🐺🦊🐔🐧🐦🐤🐋🐊🐸🐵🐡🐬🦈🐳🦐🦪🐠🐟🐙🦑🦞🦀🦅🕊🦃🐓🦉🦤🦢🦆🪶🦜🦚🦩🐩🐕‍🦮🐕🐁🐀🐇🐈🦔🦡🦨🐿'
@@ -45,6 +46,15 @@ def human_nb(nb):
     return '%i%s' % (nb, unit[unit_no])
 
 
+def human_count(paginator):
+    count = human_nb(paginator.count)
+    if paginator.count_is_exact:
+        return count
+    if settings.SOSSE_RESULT_COUNT == 'estimate':
+        return '~' + count
+    return count + '+'
+
+
 def format_url(request, params):
     parsed_url = urlparse(request.get_full_path())
     query_string = parse_qs(parsed_url.query)
@@ -70,14 +80,22 @@ def format_url(request, params):
 def get_pagination(request, paginated):
     context = {}
     if paginated and paginated.has_previous():
+        if isinstance(paginated, SearchPage) and paginated.number > 2:
+            page_previous = format_url(request, 'p=&cursor=%s' % paginated.previous_cursor())
+        else:
+            page_previous = format_url(request, 'p=%i&cursor=' % paginated.previous_page_number())
         context.update({
-            'page_first': format_url(request, 'p='),
-            'page_previous': format_url(request, 'p=%i' % paginated.previous_page_number()),
+            'page_first': format_url(request, 'p=&cursor='),
+            'page_previous': page_previous,
         })
     if paginated and paginated.has_next():
+        if isinstance(paginated, SearchPage):
+            page_next = format_url(request, 'p=&cursor=%s' % paginated.next_cursor())
+        else:
+            page_next = format_url(request, 'p=%i' % paginated.next_page_number())
         context.update({
-            'page_next': format_url(request, 'p=%i' % paginated.next_page_number()),
-            'page_last': format_url(request, 'p=%i' % paginated.paginator.num_pages)
+            'page_next': page_next,
+            'page_last': format_url(request, 'p=%i&cursor=' % paginated.paginator.num_pages)
         })
     return context
 
@@ -97,7 +115,6 @@ def get_context(ctx):
 
 @login_required
 def search(request):
-    results = []
     paginated = None
     q = None
     has_query = False
@@ -111,18 +128,22 @@ def search(request):
         if redirect_url:
             return redirect(redirect_url)
 
-        has_query, results, query = get_documents(request, form)
-        paginator = Paginator(results, form.cleaned_data['ps'])
-        page_number = request.GET.get('p')
-        paginated = paginator.get_page(page_number)
+        has_query, results, query = get_results(request, form)
+        paginator = SearchPaginator(results, form.cleaned_data['ps'])
+        cursor = request.GET.get('cursor')
+        if cursor:
+            paginated = paginator.get_cursor_page(cursor)
+        else:
+            paginated = paginator.get_page(request.GET.get('p'))
         paginated = add_headlines(paginated, query)
     else:
         form = SearchForm({})
         form.is_valid()
 
+    doc_langs = LangStats.get_langs()
     sosse_langdetect_to_postgres = OrderedDict()
     for key, val in sorted(settings.SOSSE_LANGDETECT_TO_POSTGRES.items(), key=lambda x: x[1]['name']):
-        if not Document.objects.filter(lang_iso_639_1=key).exists():
+        if key not in doc_langs:
             continue
         sosse_langdetect_to_postgres[key] = val
 
@@ -138,6 +159,7 @@ def search(request):
                 r.link_flag = extern_link_flags()
                 r.extra_link = r.get_absolute_url()
                 r.extra_link_flag = ''
+        add_thumbnails(paginated)
 
     extra_link_txt = 'cached'
     if form.cleaned_data['c']:
@@ -150,8 +172,7 @@ def search(request):
     context = get_context({
         'hide_title': True,
         'form': form,
-        'results': results,
-        'results_count': human_nb(len(results)),
+        'results_count': human_count(paginated.paginator) if paginated else '0',
         'paginated': paginated,
         'has_query': has_query,
         'home_entries': home_entries,
@@ -179,19 +200,8 @@ def word_stats(request):
     if form.is_valid():
         q = form.cleaned_data['q']
         q = remove_accent(q)
-        _, doc_query, _ = get_documents(request, form, True)
-        doc_query = doc_query.values('vector')
-
-        # Hack to obtain final SQL query, as described there:
-        # https://code.djangoproject.com/ticket/17741#comment:4
-        sql, params = doc_query.query.sql_with_params()
-        cursor = connection.cursor()
-        cursor.execute('EXPLAIN ' + sql, params)
-        raw_query = cursor.db.ops.last_executed_query(cursor, sql, params)
-        raw_query = raw_query[len('EXPLAIN '):]
-
-        results = Document.objects.raw('SELECT 1 AS id, word, ndoc FROM ts_stat(%s) ORDER BY ndoc DESC, word ASC LIMIT 100', (raw_query,))
-        results = [(e.word, human_nb(e.ndoc), format_url(request, 'q=%s %s' % (q, e.word))[len('/word_stats'):]) for e in list(results)]
+        results = get_word_stats(request, form)
+        results = [(word, human_nb(ndoc), format_url(request, 'q=%s %s' % (q, word))[len('/word_stats'):]) for word, ndoc in results]
         results = json.dumps(results)
 
     return HttpResponse(results, content_type='application/json')
@@ -13,27 +13,66 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from django.core.paginator import Paginator
+from django.db import connection
 from django.shortcuts import render
 
-from .cached import get_document, get_context, unknown_url_view
+from .cached import conditional_cached_doc, get_context, page_from_request, unknown_url_view
+from .document import Document
 from .login import login_required
+from .utils import reverse_no_escape
+
+
+WORDS_PAGE_SIZE = 500
+
+# Lexemes sorted by their highest weight, then by their number of occurrences
+WORDS_SQL = '''SELECT lexeme, positions, weights FROM se_document, unnest(vector)
+    WHERE id = %s
+    ORDER BY (SELECT min(w) FROM unnest(weights) AS w) ASC NULLS LAST, cardinality(positions) DESC NULLS LAST, lexeme ASC
+    LIMIT %s OFFSET %s'''
+
+
+class DocumentWords:
+    # Lexemes of a document, only the slice of a page is fetched
+    def __init__(self, doc):
+        self.doc = doc
+
+    def count(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT coalesce(length(vector), 0) FROM se_document WHERE id = %s', [self.doc.id])
+            return cursor.fetchone()[0]
+
+    def __getitem__(self, key):
+        with connection.cursor() as cursor:
+            cursor.execute(WORDS_SQL, [self.doc.id, key.stop - key.start, key.start])
+            words = []
+            for lexeme, positions, weights in cursor.fetchall():
+                # Same format as the text representation of the vector, weight D is the default
+                weights = ','.join([f'{pos}{weight if weight != "D" else ""}' for pos, weight in zip(positions or [], weights or [])])
+                words.append((lexeme, weights))
+            return words
 
 
 @login_required
-def words(request):
-    doc = get_document(request)
+@conditional_cached_doc
+def words(request, doc_id):
+    # The vector is read by slices
+    doc = Document.objects.filter(id=doc_id).defer('vector', 'normalized_content').first()
     if doc is None:
         return unknown_url_view(request)
 
-    context = get_context(doc, 'words')
-    words = []
-    for w in doc.vector.split():
-        word, weights = w.split(':', 1)
-        word = word.strip("'")
-        words.append((word, weights))
+    paginator = Paginator(DocumentWords(doc), WORDS_PAGE_SIZE)
+    paginated = paginator.get_page(page_from_request(request))
 
+    context = get_context(doc, 'words', request)
     context.update({
-        'words': words,
-        'lang': doc.lang_flag(True)
+        'words': paginated,
+        'word_count': len(doc.content.split()),
+        'lang': doc.lang_flag(True),
+        'paginated': paginated
     })
+    if paginated.has_previous():
+        context['page_previous'] = reverse_no_escape('words', args=[f'{paginated.previous_page_number()}/{doc.url}'])
+    if paginated.has_next():
+        context['page_next'] = reverse_no_escape('words', args=[f'{paginated.next_page_number()}/{doc.url}'])
     return render(request, 'se/words.html', context)
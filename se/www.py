@@ -15,49 +15,19 @@
 
 from django.http import HttpResponse
 from django.shortcuts import render
-from django.utils.html import format_html
 
-from .cached import get_cached_doc, get_context
+from .cached import conditional_cached_doc, get_cached_doc, get_context
 from .login import login_required
-from .models import Link
+from .models import WWWFragment
 
 
 @login_required
-def www(request):
-    doc = get_cached_doc(request, 'www')
+@conditional_cached_doc
+def www(request, doc_id):
+    doc = get_cached_doc(request, 'www', doc_id)
     if isinstance(doc, HttpResponse):
         return doc
 
-    content = format_html('')
-    content_pos = 0
-
-    links = Link.objects.filter(doc_from=doc).order_by('link_no')
-    links_count = Link.objects.filter(doc_from=doc).count()
-    link_no = 0
-    for line in doc.content.splitlines():
-        while link_no < links_count and links[link_no].pos < content_pos + len(line):
-            link = links[link_no]
-            link_pos = link.pos - content_pos
-            txt = line[:link_pos]
-            line = line[link_pos + len(link.text or ''):]
-            content_pos += len(txt) + len(link.text or '')
-
-            if link.doc_to:
-                content += format_html('{}<a href="{}">{}</a> · <a href="{}">🌍</a>',
-                                       txt,
-                                       link.doc_to.get_absolute_url(),
-                                       link.text or '<no text link>',
-                                       link.doc_to.url)
-            else:
-                content += format_html('{} [{}] · <a href="{}">🌍</a>',
-                                       txt,
-                                       link.text or '<no text link>',
-                                       link.extern_url)
-            link_no += 1
-
-        content_pos += len(line) + 1  # +1 for the \n stripped by splitlines()
-        content += format_html('{}<br/>', line)
-
-    context = get_context(doc, 'www')
-    context['content'] = content
+    context = get_context(doc, 'www', request)
+    context['content'] = WWWFragment.get(doc).get_content()
     return render(request, 'se/www.html', context)
@@ -151,6 +151,54 @@ DEFAULTS = OrderedDict([
             'default': 200,
             'type': int
         }],
+        ['result_count', {
+            'comment': 'Method used to count search results:\n``exact`` counts all results,\n``capped`` counts up to ``result_count_cap`` results,\n``estimate`` counts up to ``result_count_cap`` results, and uses the database planner estimation above.',
+            'default': 'capped'
+        }],
+        ['result_count_cap', {
+            'comment': 'Maximum number of search results counted exactly, when ``result_count`` is ``capped`` or ``estimate``.',
+            'default': 1000,
+            'type': int
+        }],
+        ['search_rank_candidates', {
+            'comment': 'Maximum number of documents matching a search that are ranked, set to 0 to rank all of them.\nDocuments matching in their title or URL are selected first, the remaining candidates are retrieved from the\nindex in no particular order. A low value reduces the time taken by searches matching many documents, at the\nexpense of relevant results being missed.\nCandidates are ranked the same way as when all documents are ranked, and results with a rank lower than 0.01\nare hidden in both cases, unless no result is above it.\nThe ``benchmark_ranking`` command helps choosing a value.',
+            'default': 0,
+            'type': int
+        }],
+        ['search_cache_timeout', {
+            'comment': 'Time in seconds search results are kept in cache, set to 0 to disable the cache.\nThe cache is invalidated when crawlers finish a batch of documents, or every minute while they are indexing.',
+            'default': 300,
+            'type': int
+        }],
+        ['search_cache_size', {
+            'comment': 'Maximum number of searches kept in cache by each web server process.',
+            'default': 300,
+            'type': int
+        }],
+        ['word_stats_sample', {
+            'comment': 'Maximum number of best ranked documents analyzed to compute the words statistics of a search,\nthe number of documents containing a word are counted among these documents only. Set to 0 to analyze all results.',
+            'default': 1000,
+            'type': int
+        }],
+        ['word_stats_idf', {
+            'comment': 'Words statistics of a search are sorted by their frequency in the results weighted by their rarity among all documents,\nso that common words are displayed last. The frequency of words among all documents is computed by the ``update_word_stats`` command.',
+            'default': False,
+            'type': bool
+        }],
+        ['thumbnails_mode', {
+            'comment': 'How thumbnails are loaded by search results pages:\n``files`` loads each thumbnail as a separate image,\n``sprite`` packs the thumbnails of a results page into a single image generated on demand,\n``inline`` embeds the thumbnails in the page as base64 data.',
+            'default': 'files'
+        }],
+        ['thumbnails_sprite_cache_size', {
+            'comment': 'Maximum number of thumbnail sprites kept in cache by each web server process, when ``thumbnails_mode`` is ``sprite``.',
+            'default': 50,
+            'type': int
+        }],
+        ['thumbnails_sprite_cache_timeout', {
+            'comment': 'Time in seconds thumbnail sprites are kept in cache by the web server and by browsers, set to 0 to disable the cache.',
+            'default': 300,
+            'type': int
+        }],
         ['data_upload_max_memory_size', {
             'comment': 'See https://docs.djangoproject.com/en/3.2/ref/settings/#data-upload-max-memory-size',
             'default': 2621440,
@@ -279,6 +327,16 @@ DEFAULTS = OrderedDict([
             'default': 5000,
             'type': int
         }],
+        ['html_snapshot_compress', {
+            'comment': 'Store the text files of HTML snapshots (HTML, CSS, Javascript...) compressed with gzip.\nThe web server needs to serve the compressed files, see :ref:`HTML snapshots <archive_html_compression>`.',
+            'default': False,
+            'type': bool
+        }],
+        ['html_snapshot_pack_size', {
+            'comment': 'Store the files of HTML snapshots in pack files of ``html_snapshot_pack_size`` MB, instead of one file per asset\n(0 to disable).\nThe web server needs to pass requests to snapshots to SOSSE, see :ref:`HTML snapshots <archive_html_packs>`.',
+            'default': 0,
+            'type': int
+        }],
         ['max_redirects', {
             'comment': 'Maximum numbers of redirect before aborting.\n(this is accurate when using Requests only,\nsome redirects may be missed on Chromium)',
             'default': 5,
@@ -425,6 +483,14 @@ class Conf:
         if css_parser not in ('internal', 'cssutils'):
             raise Exception('Configuration parsing error: invalid css_parser value "%s", it must be either "internal" or "cssutils"')
 
+        result_count = settings.get('SOSSE_RESULT_COUNT')
+        if result_count not in ('exact', 'capped', 'estimate'):
+            raise Exception('Configuration parsing error: invalid result_count value "%s", it must be either "exact", "capped" or "estimate"' % result_count)
+
+        thumbnails_mode = settings.get('SOSSE_THUMBNAILS_MODE')
+        if thumbnails_mode not in ('files', 'sprite', 'inline'):
+            raise Exception('Configuration parsing error: invalid thumbnails_mode value "%s", it must be either "files", "sprite" or "inline"' % thumbnails_mode)
+
         crawler_count = settings.pop('SOSSE_CRAWLER_COUNT')
         if not crawler_count:
             crawler_count = None
@@ -457,6 +523,27 @@ class Conf:
             'DATA_UPLOAD_MAX_MEMORY_SIZE': settings.pop('SOSSE_DATA_UPLOAD_MAX_MEMORY_SIZE'),
             'DATA_UPLOAD_MAX_NUMBER_FIELDS': settings.pop('SOSSE_DATA_UPLOAD_MAX_NUMBER_FIELDS'),
             'SOSSE_CRAWLER_COUNT': crawler_count,
+            'CACHES': {
+                'default': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                },
+                'search': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'LOCATION': 'search',
+                    'TIMEOUT': settings['SOSSE_SEARCH_CACHE_TIMEOUT'],
+                    'OPTIONS': {
+                        'MAX_ENTRIES': settings['SOSSE_SEARCH_CACHE_SIZE'],
+                    }
+                },
+                'thumbnails': {
+                    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                    'LOCATION': 'thumbnails',
+                    'TIMEOUT': settings['SOSSE_THUMBNAILS_SPRITE_CACHE_TIMEOUT'],
+                    'OPTIONS': {
+                        'MAX_ENTRIES': settings['SOSSE_THUMBNAILS_SPRITE_CACHE_SIZE'],
+                    }
+                }
+            },
             'LOGGING': LOGGING
         })
 
@@ -468,6 +555,8 @@ class Conf:
 
         settings['SOSSE_THUMBNAILS_DIR'] = settings['SOSSE_SCREENSHOTS_DIR'] + 'thumb/'
         settings['SOSSE_THUMBNAILS_URL'] = settings['SOSSE_SCREENSHOTS_URL'] + 'thumb/'
+        settings['SOSSE_FAVICONS_DIR'] = settings['SOSSE_SCREENSHOTS_DIR'] + 'favicon/'
+        settings['SOSSE_FAVICONS_URL'] = settings['SOSSE_SCREENSHOTS_URL'] + 'favicon/'
         return settings
 
     @classmethod
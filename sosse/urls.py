@@ -28,15 +28,19 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.views import LogoutView
 from django.urls import path, re_path
 from se.views import about, favicon, history, opensearch, prefs, search, search_redirect, word_stats, SELoginView
 from se.atom import atom
 from se.cached import cache_redirect
-from se.html import html, html_excluded
+from se.html import html, html_excluded, html_pack
 from se.screenshot import screenshot, screenshot_full
 from se.stats import stats
+from se.thumbnails import thumbnails
 from se.words import words
 from se.www import www
 
@@ -49,10 +53,12 @@ urlpatterns = [
     path('stats/', stats),
     path('atom/', atom),
     path('word_stats/', word_stats),
+    path('thumbnails/', thumbnails, name='thumbnails'),
     path('history/', history, name='history'),
     path('login/', SELoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('opensearch.xml', opensearch, name='opensearch'),
+    re_path(r'^%s(?P<filename>.+)' % re.escape(settings.SOSSE_HTML_SNAPSHOT_URL.lstrip('/')), html_pack, name='html_pack'),
     re_path(r'favicon/(?P<favicon_id>[0-9]+)', favicon, name='favicon'),
     re_path(r'html/.*', html, name='html'),
     re_path(r'screenshot/.*', screenshot, name='screenshot'),